@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for decoding the protobuf messages stored in the database
+
+Decodes a corpus of reactions, mentions and group updates shaped like those
+in real backups with pure_protobuf and with the fast decoder.
+
+Usage: python benchmarks/bench_dbproto.py
+
+License: See LICENSE file.
+
+"""
+
+import random
+import time
+import uuid
+
+from signal2html.dbproto import StructuredDecryptedMember
+from signal2html.dbproto import StructuredDecryptedString
+from signal2html.dbproto import StructuredGroupDataV2
+from signal2html.dbproto import StructuredGroupV2Change
+from signal2html.dbproto import StructuredGroupV2State
+from signal2html.dbproto import StructuredMemberRole
+from signal2html.dbproto import StructuredMention
+from signal2html.dbproto import StructuredMentions
+from signal2html.dbproto import StructuredReaction
+from signal2html.dbproto import StructuredReactions
+from signal2html.dbproto import decode_message
+
+N_BLOBS = 5000
+TIMESTAMP = 1600000000000
+
+
+def make_uuid(rng):
+    return uuid.UUID(int=rng.getrandbits(128))
+
+
+def make_reactions(rng):
+    return StructuredReactions(
+        reactions=[
+            StructuredReaction(
+                what=rng.choice(["👍", "❤️", "😂", "😮"]),
+                who=rng.randint(1, 500),
+                time_sent=TIMESTAMP + rng.getrandbits(32),
+                time_received=TIMESTAMP + rng.getrandbits(32),
+            )
+            for _ in range(rng.randint(1, 4))
+        ]
+    )
+
+
+def make_mentions(rng):
+    return StructuredMentions(
+        mentions=[
+            StructuredMention(
+                start=rng.randint(0, 200),
+                length=1,
+                who_uuid=str(make_uuid(rng)),
+            )
+            for _ in range(rng.randint(1, 3))
+        ]
+    )
+
+
+def make_group_update(rng):
+    members = [
+        StructuredDecryptedMember(
+            uuid=make_uuid(rng).bytes,
+            role=StructuredMemberRole.MEMBER_ROLE_DEFAULT,
+        )
+        for _ in range(rng.randint(2, 50))
+    ]
+    return StructuredGroupDataV2(
+        change=StructuredGroupV2Change(
+            by=members[0].uuid,
+            new_members=members[-1:],
+            new_title=StructuredDecryptedString(value="Family"),
+        ),
+        state=StructuredGroupV2State(
+            title="Family", rev=rng.randint(1, 100), members=members
+        ),
+    )
+
+
+def bench(corpus, decode):
+    start = time.perf_counter()
+    for cls, data in corpus:
+        decode(cls, data)
+    return time.perf_counter() - start
+
+
+def main():
+    rng = random.Random(42)
+    for name, make in [
+        ("reactions", make_reactions),
+        ("mentions", make_mentions),
+        ("group updates", make_group_update),
+    ]:
+        corpus = []
+        for _ in range(N_BLOBS):
+            msg = make(rng)
+            corpus.append((type(msg), msg.dumps()))
+        t_old = bench(corpus, lambda cls, data: cls.loads(data))
+        t_new = bench(corpus, decode_message)
+        print(
+            f"{N_BLOBS} {name:13}: pure_protobuf "
+            f"{t_old * 1e6 / N_BLOBS:6.1f} us/blob, "
+            f"fast decoder {t_new * 1e6 / N_BLOBS:6.1f} us/blob"
+        )
+
+
+if __name__ == "__main__":
+    main()
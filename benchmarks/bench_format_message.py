@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for formatting long message bodies
+
+Compares format_message against the previous character-by-character
+implementation on 100 KB message bodies, such as pasted logs.
+
+Usage: python benchmarks/bench_format_message.py
+
+License: See LICENSE file.
+
+"""
+
+import random
+import timeit
+
+from emoji import emoji_list
+
+from signal2html.html import format_message
+from signal2html.html import is_all_emoji
+from signal2html.linkify import linkify
+
+BODY_SIZE = 100 * 1024
+REPEAT = 3
+
+
+def legacy_format_message(body, mentions=None):
+    """The character-by-character implementation of format_message"""
+    if body is None:
+        return None
+
+    if mentions is None:
+        mentions = {}
+
+    emoji_pos = emoji_list(body)
+    new_body = ""
+    emoji_lookup = {p["match_start"]: p["emoji"] for p in emoji_pos}
+    skip = 0
+    for i, c in enumerate(body):
+        if skip > 0:
+            skip = skip - 1
+        elif i in emoji_lookup:
+            new_body += "<span class='msg-emoji'>%s</span>" % emoji_lookup[i]
+            skip = len(emoji_lookup[i]) - 1
+        elif c == "&":
+            new_body += "&amp;"
+        elif c == "<":
+            new_body += "&lt;"
+        elif c == ">":
+            new_body += "&gt;"
+        elif c == "￼":
+            mention = mentions.get(i)
+            if mention:
+                new_body += (
+                    "<span class='msg-mention'>@%s</span>"
+                    % legacy_format_message(mention.name)
+                )
+                skip = mention.length - 1
+            else:
+                new_body += c
+        else:
+            new_body += c
+
+    return linkify(new_body)
+
+
+def make_body(words, size, seed=42):
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)[:size]
+
+
+BODIES = {
+    "plain text": make_body(
+        ["lorem", "ipsum", "dolor", "sit", "amet", "\n"], BODY_SIZE
+    ),
+    "log output": make_body(
+        ["[INFO]", "<module>", "a && b", "x -> y", "12:03:44", "\n"],
+        BODY_SIZE,
+    ),
+    "emoji and links": make_body(
+        ["hi", "\U0001f600", "\U0001f44d\U0001f3fd", "www.example.com"],
+        BODY_SIZE,
+    ),
+}
+
+
+def main():
+    for name, body in BODIES.items():
+        assert format_message(body) == legacy_format_message(body)
+        t_old = min(
+            timeit.repeat(
+                lambda: (legacy_format_message(body), is_all_emoji(body)),
+                number=1,
+                repeat=REPEAT,
+            )
+        )
+        t_new = min(
+            timeit.repeat(
+                lambda: format_message(body), number=1, repeat=REPEAT
+            )
+        )
+        print(
+            f"{name:>16}: legacy {t_old * 1000:8.1f} ms, "
+            f"single pass {t_new * 1000:8.1f} ms, "
+            f"speedup {t_old / t_new:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the memory used by the messages of a thread
+
+Builds a synthetic thread of 1,000,000 messages, of which every tenth is an
+MMS with an image attachment, with the previous models (dataclasses with a
+__dict__ per instance and the recipient and thread ID in every message) and
+with the current slotted models, and reports the bytes per message.
+
+Usage: python benchmarks/bench_models.py [N_MESSAGES]
+
+License: See LICENSE file.
+
+"""
+
+import sys
+import tracemalloc
+
+from dataclasses import dataclass
+
+from typing import List
+
+from signal2html.models import Attachment
+from signal2html.models import MMSMessageRecord
+from signal2html.models import Recipient
+from signal2html.models import SMSMessageRecord
+
+N_MESSAGES = 1_000_000
+
+
+@dataclass
+class LegacyAttachment:
+    contentType: str
+    fileName: str
+    voiceNote: bool
+    width: int
+    height: int
+    quote: bool
+    unique_id: str
+    thumbnail: str = None
+
+
+@dataclass
+class LegacySMSMessageRecord:
+    addressRecipient: Recipient
+    recipient: Recipient
+    dateSent: int
+    dateReceived: int
+    threadId: int
+    body: str
+    _type: int
+    _id: int
+    data: any
+    delivery_receipt_count: int
+    read_receipt_count: int
+
+
+@dataclass
+class LegacyMMSMessageRecord(LegacySMSMessageRecord):
+    quote: object
+    attachments: List[LegacyAttachment]
+    reactions: list
+    viewed_receipt_count: int
+
+
+def content_type():
+    """A new string for every row, as returned by sqlite"""
+    return "".join(["image/", "jpeg"])
+
+
+def make_legacy(i, recipient):
+    kwargs = dict(
+        addressRecipient=recipient,
+        recipient=recipient,
+        dateSent=1600000000000 + i,
+        dateReceived=1600000000000 + i,
+        threadId=1,
+        body=f"Message {i}",
+        _type=20,
+        _id=i,
+        data=None,
+        delivery_receipt_count=0,
+        read_receipt_count=0,
+    )
+    if i % 10:
+        return LegacySMSMessageRecord(**kwargs)
+    attachment = LegacyAttachment(
+        content_type(), f"Attachment_{i}_1.jpg", False, 800, 600, False, "1"
+    )
+    return LegacyMMSMessageRecord(
+        quote=None,
+        attachments=[attachment],
+        reactions=[],
+        viewed_receipt_count=0,
+        **kwargs,
+    )
+
+
+def make_current(i, recipient):
+    kwargs = dict(
+        addressRecipient=recipient,
+        dateSent=1600000000000 + i,
+        dateReceived=1600000000000 + i,
+        body=f"Message {i}",
+        _type=20,
+        _id=i,
+        data=None,
+        delivery_receipt_count=0,
+        read_receipt_count=0,
+    )
+    if i % 10:
+        return SMSMessageRecord(**kwargs)
+    attachment = Attachment(
+        sys.intern(content_type()),
+        f"Attachment_{i}_1.jpg",
+        False,
+        800,
+        600,
+        False,
+        "1",
+    )
+    return MMSMessageRecord(
+        quote=None,
+        attachments=[attachment],
+        reactions=[],
+        viewed_receipt_count=0,
+        **kwargs,
+    )
+
+
+def measure(make, n_messages):
+    """Return the bytes per message used by a thread of messages"""
+    recipient = Recipient(1, "Contact", "blue", False, "+1", "")
+    tracemalloc.start()
+    messages = [make(i, recipient) for i in range(n_messages)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return size / n_messages
+
+
+def main():
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else N_MESSAGES
+    before = measure(make_legacy, n_messages)
+    after = measure(make_current, n_messages)
+    print(
+        f"{n_messages} messages: previous models {before:5.0f} bytes/message, "
+        f"slotted models {after:5.0f} bytes/message"
+    )
+
+
+if __name__ == "__main__":
+    main()
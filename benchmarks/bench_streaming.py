@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the memory used to export a long thread
+
+Creates backups with a single thread of increasing length, with an SMS and
+an MMS message in turn, and exports them with and without streaming. Reports
+the peak memory allocated by Python (traced with tracemalloc) and the time
+taken.
+
+Usage: python benchmarks/bench_streaming.py
+
+License: See LICENSE file.
+
+"""
+
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from pathlib import Path
+
+from signal2html.core import BATCH_SIZE
+from signal2html.core import process_backup
+
+THREAD_LENGTHS = [5_000, 20_000, 80_000]
+DATABASE_VERSION = 110
+
+SCHEMA = """
+CREATE TABLE thread (_id INTEGER PRIMARY KEY, thread_recipient_id INTEGER);
+CREATE TABLE recipient (_id INTEGER PRIMARY KEY, group_id TEXT, uuid TEXT,
+    phone TEXT, system_display_name TEXT, profile_joined_name TEXT,
+    color TEXT);
+CREATE TABLE groups (_id INTEGER PRIMARY KEY, group_id TEXT, title TEXT,
+    members TEXT);
+CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id INTEGER, address TEXT,
+    date INTEGER, date_sent INTEGER, body TEXT, type INTEGER,
+    delivery_receipt_count INTEGER, read_receipt_count INTEGER);
+CREATE TABLE mms (_id INTEGER PRIMARY KEY, thread_id INTEGER, address TEXT,
+    date INTEGER, date_received INTEGER, body TEXT, quote_id INTEGER,
+    quote_author TEXT, quote_body TEXT, quote_mentions BLOB,
+    msg_box INTEGER, reactions BLOB, delivery_receipt_count INTEGER,
+    read_receipt_count INTEGER, viewed_receipt_count INTEGER);
+CREATE TABLE part (_id INTEGER PRIMARY KEY, mid INTEGER, ct TEXT,
+    unique_id INTEGER, voice_note INTEGER, width INTEGER, height INTEGER,
+    quote INTEGER);
+CREATE TABLE mention (_id INTEGER PRIMARY KEY, thread_id INTEGER,
+    message_id INTEGER, recipient_id INTEGER, range_start INTEGER,
+    range_length INTEGER);
+CREATE INDEX sms_thread_id_index ON sms (thread_id);
+CREATE INDEX mms_thread_id_index ON mms (thread_id);
+CREATE INDEX part_mms_id_index ON part (mid);
+"""
+
+
+def make_backup(backup_dir, n_messages):
+    """Create a backup with a thread with a contact of n_messages"""
+    os.makedirs(backup_dir)
+    with open(os.path.join(backup_dir, "DatabaseVersion.sbf"), "w") as fp:
+        fp.write(f"databaseVersion:{DATABASE_VERSION}")
+    conn = sqlite3.connect(os.path.join(backup_dir, "database.sqlite"))
+    conn.executescript(SCHEMA)
+    conn.execute(
+        "INSERT INTO recipient VALUES (1, NULL, NULL, '+31600000000', "
+        "'Alice', NULL, 'blue')"
+    )
+    conn.execute("INSERT INTO thread VALUES (1, 1)")
+    date = 1600000000000
+    body = "Did you see www.example.com? It's about <html> & emoji 👍"
+    sms, mms = [], []
+    for i in range(n_messages):
+        date += 60_000
+        if i % 2:
+            mms.append((i, date, date, body, 20 if i % 4 == 1 else 23))
+        else:
+            sms.append((i, date, date, body, 20 if i % 4 == 0 else 23))
+    conn.executemany(
+        "INSERT INTO sms VALUES (?, 1, '1', ?, ?, ?, ?, 1, 1)", sms
+    )
+    conn.executemany(
+        "INSERT INTO mms VALUES (?, 1, '1', ?, ?, ?, NULL, NULL, NULL, NULL, "
+        "?, NULL, 1, 1, 0)",
+        mms,
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(backup_dir, output_dir, batch_size):
+    tracemalloc.start()
+    start = time.perf_counter()
+    process_backup(Path(backup_dir), Path(output_dir), batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak, elapsed
+
+
+def main():
+    logging.disable(logging.INFO)
+    for n_messages in THREAD_LENGTHS:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup_dir = os.path.join(tmpdir, "backup")
+            make_backup(backup_dir, n_messages)
+            peak, elapsed = measure(
+                backup_dir, os.path.join(tmpdir, "full"), None
+            )
+            peak_stream, elapsed_stream = measure(
+                backup_dir, os.path.join(tmpdir, "stream"), BATCH_SIZE
+            )
+        print(
+            f"{n_messages:7d} messages: "
+            f"in memory {peak / 2**20:6.1f} MB peak ({elapsed:5.1f} s), "
+            f"streaming {peak_stream / 2**20:6.1f} MB peak "
+            f"({elapsed_stream:5.1f} s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
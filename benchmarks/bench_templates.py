@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark for the fixed overhead of writing a thread
+
+Writes 5,000 threads with a single message each, creating a new Jinja
+environment for every thread (as before) and sharing one environment. Also
+compares compiling the template in a new process with loading it from the
+bytecode cache.
+
+Usage: python benchmarks/bench_templates.py
+
+License: See LICENSE file.
+
+"""
+
+import os
+import tempfile
+import time
+
+from unittest import mock
+
+from jinja2 import Environment
+from jinja2 import PackageLoader
+from jinja2 import select_autoescape
+
+from signal2html import html
+from signal2html.models import Recipient
+from signal2html.models import SMSMessageRecord
+from signal2html.models import Thread
+
+N_THREADS = 5000
+
+
+def make_threads():
+    threads = []
+    for i in range(N_THREADS):
+        recipient = Recipient(i, f"Contact {i}", "blue", False, f"+{i}", "")
+        message = SMSMessageRecord(
+            addressRecipient=recipient,
+            dateSent=1600000000000 + i,
+            dateReceived=1600000000000 + i,
+            body="Hi!",
+            _type=20 | 0x800000,
+            _id=i,
+            data=None,
+            delivery_receipt_count=0,
+            read_receipt_count=0,
+        )
+        threads.append(Thread(_id=i, recipient=recipient, sms=[message]))
+    return threads
+
+
+def new_environment(bytecode_cache_dir=None):
+    """Create a new environment on every call, as dump_thread used to"""
+    return Environment(
+        loader=PackageLoader("signal2html", "templates"),
+        autoescape=select_autoescape(["html", "xml"]),
+    )
+
+
+def write_threads(threads, output_dir):
+    start = time.perf_counter()
+    for thread in threads:
+        output_file = os.path.join(output_dir, f"{thread._id}.html")
+        html.dump_thread(thread, output_dir, output_file=output_file)
+    return time.perf_counter() - start
+
+
+def load_template(cache_dir):
+    html.get_environment.cache_clear()
+    start = time.perf_counter()
+    html.get_environment(cache_dir).get_template("thread.html")
+    return time.perf_counter() - start
+
+
+def main():
+    threads = make_threads()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with mock.patch.object(html, "get_environment", new_environment):
+            t_old = write_threads(threads, tmpdir)
+        html.get_environment.cache_clear()
+        t_new = write_threads(threads, tmpdir)
+        print(
+            f"{N_THREADS} threads: new environment per thread "
+            f"{t_old * 1e6 / N_THREADS:7.0f} us/thread, "
+            f"shared environment {t_new * 1e6 / N_THREADS:7.0f} us/thread"
+        )
+
+        cache_dir = os.path.join(tmpdir, "cache")
+        t_compile = load_template(None)
+        load_template(cache_dir)  # fill the cache
+        t_cached = load_template(cache_dir)
+        print(
+            f"Loading the template: compiled {t_compile * 1000:5.1f} ms, "
+            f"from bytecode cache {t_cached * 1000:5.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -36,6 +36,7 @@ EXTRAS = {
     "docs": docs_require,
     "tests": test_require,
     "dev": docs_require + test_require + dev_require,
+    "thumbnails": ["Pillow"],
 }
 
 # The rest you shouldn't have to touch too much :)
@@ -7,6 +7,7 @@ License: See LICENSE file.
 """
 
 import abc
+import hashlib
 import logging
 
 from .html_colors import get_random_color
@@ -30,10 +31,23 @@ class Addressbook(metaclass=abc.ABCMeta):
         self.uuid_to_rid: dict[str, str] = {}
         self.groups: dict[int, str] = {}
 
+        self._inputs = hashlib.sha256()
         self._load_groups()
         self._load_recipients()  # Must be implemented by subclass
         self.next_rid = 10000
 
+        # Digest of the rows the addressbook is loaded from, to detect
+        # changes to contacts and groups between exports
+        self.inputs_hash = self._inputs.hexdigest()
+        del self._inputs
+
+    def __getstate__(self):
+        """Exclude the database cursor when pickling, the addressbook is
+        sent to worker processes which use their own connection."""
+        state = self.__dict__.copy()
+        state["db"] = None
+        return state
+
     @abc.abstractmethod
     def _load_recipients():
         """Load all recipients in the recipient_preferences table."""
@@ -128,6 +142,7 @@ class Addressbook(metaclass=abc.ABCMeta):
         """Loads all group names (a.k.a. titles)."""
         qry = self.db.execute("SELECT group_id, title FROM groups")
         qry_res = qry.fetchall()
+        self._inputs.update(repr(qry_res).encode())
         for group_id, title in qry_res:
             self.groups[self._get_unique_group_id(group_id)] = title
 
@@ -189,6 +204,7 @@ class AddressbookV1(Addressbook):
             "FROM recipient_preferences "
         )
         qry_res = qry.fetchall()
+        self._inputs.update(repr(qry_res).encode())
 
         for (
             recipient_id,
@@ -252,6 +268,7 @@ class AddressbookV2(Addressbook):
             "FROM recipient "
         )
         qry_res = qry.fetchall()
+        self._inputs.update(repr(qry_res).encode())
         for (
             recipient_id,
             group_id,
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+
+"""Exporting attachments to the output directory
+
+Checking the type of an attachment and copying it are done on a pool of I/O
+threads, so that reading the database doesn't wait for the disk.
+
+License: See LICENSE file.
+
+"""
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from dataclasses import dataclass
+from dataclasses import field
+
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import filetype
+
+from .models import Attachment
+from .thumbnails import get_thumbnail_path
+from .thumbnails import needs_thumbnail
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of attachments queued per I/O thread
+QUEUE_SIZE_PER_THREAD = 64
+
+# Size of the chunks in which attachments are read for hashing, this must be
+# larger than what filetype reads to determine the file type.
+HASH_CHUNK_SIZE = 1 << 20
+
+# MIME types that say nothing about the file type, attachments with these
+# types are sniffed to determine the extension
+GENERIC_CONTENT_TYPES = {
+    "application/octet-stream",
+    "application/unknown",
+    "application/x-binary",
+    "binary/octet-stream",
+}
+
+# Ways to create the attachment files in the output directory
+ATTACHMENT_MODES = ("copy", "hardlink", "symlink", "reflink")
+
+# Ways to check whether an attachment in the output matches the backup
+SYNC_MODES = ("mtime", "hash")
+
+# Difference in seconds up to which modification times are considered equal,
+# as some file systems (FAT, SMB) store them with a 2 second resolution
+MTIME_TOLERANCE = 2
+
+# ioctl request to clone a file on Linux (FICLONE from linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors that indicate that cloning or copy_file_range isn't supported for
+# the files at hand, in which case we fall back to a regular copy
+_UNSUPPORTED_ERRNOS = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+
+def get_attachment_source(_id, unique_id, backup_dir) -> str:
+    """Get the absolute path of an attachment in the backup directory"""
+    fname = f"Attachment_{_id}_{unique_id}.bin"
+    return os.path.abspath(os.path.join(backup_dir, fname))
+
+
+def get_extension(source) -> str:
+    """Get the file extension that matches the type of a file, given its
+    path or its first bytes"""
+    filetype_kind = filetype.guess(source)
+    if filetype_kind is None:
+        return "bin"
+    return filetype_kind.extension
+
+
+def get_content_type_extension(content_type) -> Optional[str]:
+    """Get the file extension for a MIME type, or None if the type is
+    missing, generic, or unknown (and the file has to be sniffed)"""
+    if not content_type:
+        return None
+    mime = content_type.split(";", 1)[0].strip().lower()
+    if mime in GENERIC_CONTENT_TYPES:
+        return None
+    filetype_kind = filetype.get_type(mime=mime)
+    if filetype_kind is None:
+        return None
+    return filetype_kind.extension
+
+
+def get_attachment_filename(_id, unique_id, source, extension=None) -> str:
+    """Get the filename of an attachment in the output directory, with an
+    extension that matches the file type. The file is only sniffed if no
+    extension is given."""
+    if extension is None:
+        extension = get_extension(source)
+    return f"Attachment_{_id}_{unique_id}.{extension}"
+
+
+def get_url(path, thread_dir) -> str:
+    """Get the relative URL of a file in the output directory from the page
+    of a thread"""
+    url = os.path.relpath(path, os.path.abspath(thread_dir))
+    if not url.startswith(os.pardir):
+        url = os.path.join(os.curdir, url)
+    return url.replace(os.sep, "/")
+
+
+def load_sniff_cache(path) -> Dict[str, list]:
+    """Load the cache of sniffed file extensions
+
+    The cache maps "<id>_<unique_id>" of an attachment to its size,
+    modification time (in ns), and extension. An entry is only used while
+    the size and modification time of the file are unchanged."""
+    try:
+        with open(path, "r", encoding="utf-8") as fp:
+            cache = json.load(fp)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring invalid sniff cache '{path}': {e}")
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def save_sniff_cache(path, cache: Dict[str, list]):
+    """Write the cache of sniffed file extensions"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fp:
+        json.dump(cache, fp, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _copy_file_range(fsrc, fdst) -> bool:
+    """Copy a file in the kernel using os.copy_file_range, if supported"""
+    if not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+            pass
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        fsrc.seek(0)
+        fdst.seek(0)
+        fdst.truncate()
+        return False
+    return True
+
+
+def _reflink(fsrc, fdst) -> bool:
+    """Clone a file using the FICLONE ioctl, if supported"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        return False
+    return True
+
+
+def reflink_file(source, target):
+    """Create target as a copy-on-write clone of source.
+
+    Falls back to os.copy_file_range, and then to a regular copy if the file
+    system doesn't support cloning."""
+    with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+        if not (_reflink(fsrc, fdst) or _copy_file_range(fsrc, fdst)):
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(source, target)
+
+
+def place_file(source, target, mode="copy"):
+    """Create the target file from the source using the given mode (one of
+    ATTACHMENT_MODES), replacing an existing target. Copies keep the
+    modification time of the source, see is_synced().
+
+    An existing target is removed first rather than overwritten, since it
+    may be a link to the source left by an export in another mode, and
+    writing through it would destroy the backup."""
+    if mode not in ATTACHMENT_MODES:
+        raise ValueError(f"Unknown attachment mode: {mode}")
+    if os.path.lexists(target):
+        if mode == "hardlink" and os.path.samefile(source, target):
+            return
+        os.unlink(target)
+    if mode == "copy":
+        shutil.copy2(source, target)
+    elif mode == "reflink":
+        reflink_file(source, target)
+    elif mode == "hardlink":
+        os.link(source, target)
+    else:
+        os.symlink(source, target)
+
+
+def file_digest(path) -> bytes:
+    """Compute the SHA-256 digest of a file in chunks"""
+    sha = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.digest()
+
+
+def is_synced(source, target, mode="copy", sync="mtime") -> bool:
+    """Check whether the target was placed from the source before and is
+    unchanged, in which case it doesn't have to be placed again.
+
+    Links are compared to the source directly. Copies match if they have the
+    same size as the source and the same modification time (sync="mtime")
+    or the same content (sync="hash")."""
+    try:
+        target_stat = os.lstat(target)
+    except FileNotFoundError:
+        return False
+    if mode == "hardlink":
+        return os.path.samestat(os.stat(source), target_stat)
+    if mode == "symlink":
+        return os.path.islink(target) and os.readlink(target) == source
+    if not stat.S_ISREG(target_stat.st_mode):
+        return False
+    source_stat = os.stat(source)
+    if source_stat.st_size != target_stat.st_size:
+        return False
+    if sync == "hash":
+        return file_digest(source) == file_digest(target)
+    delta = abs(source_stat.st_mtime - target_stat.st_mtime)
+    return delta < MTIME_TOLERANCE
+
+
+@dataclass
+class ExportReport:
+    """Summary of the attachments exported by an AttachmentExporter
+
+    The copy times are the wall and CPU time spent in the I/O threads, in
+    seconds."""
+
+    errors: List[str] = field(default_factory=list)
+    stored: int = 0
+    deduplicated: int = 0
+    bytes_saved: int = 0
+    unchanged: int = 0
+    bytes_copied: int = 0
+    copy_time: float = 0.0
+    copy_cpu_time: float = 0.0
+    sniffed: Dict[str, list] = field(default_factory=dict)
+    thumbnails: Dict[str, str] = field(default_factory=dict)
+
+    def update(self, other: "ExportReport"):
+        """Add the numbers of another report to this one"""
+        self.errors.extend(other.errors)
+        self.sniffed.update(other.sniffed)
+        self.thumbnails.update(other.thumbnails)
+        self.stored += other.stored
+        self.deduplicated += other.deduplicated
+        self.bytes_saved += other.bytes_saved
+        self.unchanged += other.unchanged
+        self.bytes_copied += other.bytes_copied
+        self.copy_time += other.copy_time
+        self.copy_cpu_time += other.copy_cpu_time
+
+    def log(self):
+        """Log the summary and the errors that occurred"""
+        if self.stored or self.deduplicated:
+            logger.info(
+                f"Media store: {self.stored} file(s) written, "
+                f"{self.deduplicated} duplicate(s) skipped, "
+                f"{self.bytes_saved / 2**20:.1f} MB saved."
+            )
+        if self.unchanged:
+            logger.info(f"Left {self.unchanged} unchanged attachment(s).")
+        if self.errors:
+            logger.error(
+                f"Failed to export {len(self.errors)} attachment(s):\n"
+                + "\n".join(self.errors)
+            )
+
+
+def hash_attachment(source, extension=None) -> Tuple[str, str]:
+    """Compute the SHA-256 digest of an attachment and determine its file
+    extension, reading the file once in chunks. The file is only sniffed if
+    no extension is given."""
+    sha = hashlib.sha256()
+    with open(source, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            if extension is None:
+                extension = get_extension(chunk)
+            sha.update(chunk)
+    return sha.hexdigest(), extension or get_extension(b"")
+
+
+class AttachmentExporter:
+    """Export attachments from the backup to the output directory.
+
+    Attachments are submitted while the messages are read from the database.
+    Checking that the file exists, determining its filename, and copying it
+    are done by a bounded pool of I/O threads. The filename is set on the
+    Attachment once known, wait_for_filenames() must be called before it is
+    used. Copying continues in the background until drain() or close() is
+    called, these methods return an ExportReport with the errors.
+
+    The mode determines how the files are created in the output directory,
+    see place_file(). Links point to the absolute path of the attachment in
+    the backup, so they remain valid wherever the output is opened.
+
+    By default, attachments are placed in the attachments directory of their
+    thread. If a media directory is given, they are stored there instead
+    under the hash of their content, so that an attachment that occurs in
+    several messages or threads is only written once.
+
+    The extension of an attachment is derived from its content type where
+    possible. Otherwise the file is sniffed, and the result is added to the
+    sniff cache (see load_sniff_cache) and to the report, so the caller can
+    save it for the next export.
+
+    With a sync mode (one of SYNC_MODES), attachments that are already in
+    the output directory and match the backup are left alone, see
+    is_synced().
+
+    With a thumbnail size, the thumbnails of large images are added to the
+    report, to be made by thumbnails.make_thumbnails() after the export."""
+
+    def __init__(
+        self,
+        backup_dir,
+        max_workers=4,
+        mode="copy",
+        media_dir=None,
+        sniff_cache=None,
+        sync=None,
+        thumbnail_size=None,
+    ):
+        if mode not in ATTACHMENT_MODES:
+            raise ValueError(f"Unknown attachment mode: {mode}")
+        if sync is not None and sync not in SYNC_MODES:
+            raise ValueError(f"Unknown sync mode: {sync}")
+        self.sync = sync
+        self.thumbnail_size = thumbnail_size
+        self.backup_dir = backup_dir
+        self.mode = mode
+        self.media_dir = (
+            None if media_dir is None else os.path.abspath(media_dir)
+        )
+        self.sniff_cache = {} if sniff_cache is None else sniff_cache
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="signal2html-io"
+        )
+        self._slots = threading.BoundedSemaphore(
+            max_workers * QUEUE_SIZE_PER_THREAD
+        )
+        self._lock = threading.Lock()
+        self._named: List[Future] = []
+        self._pending = set()
+        self._stored = set()
+        self._report = ExportReport()
+
+    def submit(self, attachment: Attachment, _id, unique_id, thread_dir):
+        """Queue an attachment for export to the thread directory"""
+        named = Future()
+        self._slots.acquire()
+        future = self._pool.submit(
+            self._export, attachment, _id, unique_id, thread_dir, named
+        )
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        self._named.append(named)
+
+    def wait_for_filenames(self):
+        """Wait until the filenames of all submitted attachments are set"""
+        for named in self._named:
+            named.result()
+        self._named.clear()
+
+    def drain(self) -> ExportReport:
+        """Wait until all submitted attachments are exported and return the
+        report since the previous call"""
+        self.wait_for_filenames()
+        with self._lock:
+            pending = list(self._pending)
+        for future in wait(pending).done:
+            future.result()
+        with self._lock:
+            report, self._report = self._report, ExportReport()
+        return report
+
+    def close(self) -> ExportReport:
+        """Drain the queue and stop the I/O threads"""
+        report = self.drain()
+        self._pool.shutdown()
+        return report
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+    def _error(self, source, error):
+        with self._lock:
+            self._report.errors.append(f"{source}: {error}")
+
+    def _export(self, attachment, _id, unique_id, thread_dir, named):
+        """Set the filename of the attachment and copy it (in an I/O
+        thread)"""
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            self._export_file(attachment, _id, unique_id, thread_dir, named)
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - start_cpu
+            with self._lock:
+                self._report.copy_time += wall
+                self._report.copy_cpu_time += cpu
+
+    def _export_file(self, attachment, _id, unique_id, thread_dir, named):
+        source = get_attachment_source(_id, unique_id, self.backup_dir)
+        try:
+            try:
+                source_stat = os.stat(source)
+            except FileNotFoundError:
+                logger.warning(
+                    f"Couldn't find attachment '{source}'. "
+                    "Maybe it was deleted or never downloaded?"
+                )
+                return
+            except Exception as e:
+                self._error(source, e)
+                return
+
+            # Any error is recorded in the report, so that the export goes on
+            # with the other attachments
+            try:
+                extension = get_content_type_extension(attachment.contentType)
+                if self.media_dir is None:
+                    target_dir = os.path.abspath(
+                        os.path.join(thread_dir, "attachments")
+                    )
+                    if extension is None:
+                        extension = self._sniff(
+                            _id, unique_id, source, source_stat
+                        )
+                    new_fname = get_attachment_filename(
+                        _id, unique_id, source, extension=extension
+                    )
+                else:
+                    # The file is read anyway, so it is sniffed while hashing
+                    target_dir = self.media_dir
+                    digest, extension = hash_attachment(source, extension)
+                    new_fname = f"{digest}.{extension}"
+                target = os.path.join(target_dir, new_fname)
+                attachment.fileName = get_url(target, thread_dir)
+                if self.thumbnail_size and needs_thumbnail(
+                    attachment, self.thumbnail_size
+                ):
+                    thumbnail = get_thumbnail_path(target, self.thumbnail_size)
+                    attachment.thumbnail = get_url(thumbnail, thread_dir)
+                    with self._lock:
+                        self._report.thumbnails[thumbnail] = source
+            except Exception as e:
+                self._error(source, e)
+                return
+        finally:
+            named.set_result(None)
+
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+            if self.media_dir is not None:
+                self._store(source, target, source_stat.st_size)
+            elif self.sync and is_synced(source, target, self.mode, self.sync):
+                with self._lock:
+                    self._report.unchanged += 1
+            else:
+                place_file(source, target, mode=self.mode)
+                with self._lock:
+                    self._report.bytes_copied += source_stat.st_size
+        except Exception as e:
+            self._error(source, e)
+
+    def _sniff(self, _id, unique_id, source, source_stat) -> str:
+        """Get the extension of an attachment from the sniff cache, or sniff
+        the file if it isn't cached or has changed"""
+        key = f"{_id}_{unique_id}"
+        size, mtime = source_stat.st_size, source_stat.st_mtime_ns
+        entry = self.sniff_cache.get(key)
+        if entry is not None and entry[:2] == [size, mtime]:
+            return entry[2]
+        extension = get_extension(source)
+        entry = [size, mtime, extension]
+        with self._lock:
+            self.sniff_cache[key] = self._report.sniffed[key] = entry
+        return extension
+
+    def _store(self, source, target, size):
+        """Place a file in the media directory, unless it is already there"""
+        with self._lock:
+            exists = target in self._stored or os.path.exists(target)
+            self._stored.add(target)
+            if exists:
+                self._report.deduplicated += 1
+                self._report.bytes_saved += size
+                return
+
+        # Other processes may store the same file, so write it under a
+        # temporary name and move it into place.
+        tmp = f"{target}.{os.getpid()}-{threading.get_ident()}.tmp"
+        place_file(source, tmp, mode=self.mode)
+        os.replace(tmp, target)
+        with self._lock:
+            self._report.stored += 1
+            self._report.bytes_copied += size
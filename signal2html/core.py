@@ -8,50 +8,94 @@ License: See LICENSE file.
 
 import base64
 import binascii
+import contextlib
 import datetime as dt
+import functools
+import itertools
 import logging
 import os
-import shutil
 import sqlite3
+import sys
+import time
 import uuid
-import filetype
 
+from dataclasses import dataclass
+from dataclasses import field
+from operator import itemgetter
 from pathlib import Path
 
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
+from typing import Set
 from typing import Tuple
 
 from .__version__ import __version__
 from .addressbook import Addressbook
 from .addressbook import make_addressbook
+from .attachments import AttachmentExporter
+from .attachments import load_sniff_cache
+from .attachments import save_sniff_cache
+from .database import Database
+from .database import QueryStats
 from .dbproto import StructuredGroupCall
 from .dbproto import StructuredGroupDataV1
 from .dbproto import StructuredGroupDataV2
 from .dbproto import StructuredMemberRole
 from .dbproto import StructuredMentions
 from .dbproto import StructuredReactions
+from .dbproto import clear_message_cache
+from .dbproto import decode_message
+from .dbproto import get_message_cache_info
 from .exceptions import DatabaseEmptyError
 from .exceptions import DatabaseNotFoundError
 from .exceptions import DatabaseVersionNotFoundError
 from .html import dump_thread
+from .html import merge_messages
+from .manifest import Manifest
+from .manifest import get_thread_fingerprints
+from .memory import DUMP
+from .memory import POPULATE
+from .memory import disable_memory_profile
+from .memory import enable_memory_profile
+from .memory import memory_stage
+from .memory import thread_memory
 from .models import Attachment
 from .models import GroupCallData
 from .models import GroupUpdateData
 from .models import MemberInfo
 from .models import Mention
+from .models import MessageHeader
 from .models import MMSMessageRecord
 from .models import Quote
 from .models import Reaction
 from .models import Recipient
 from .models import SMSMessageRecord
 from .models import Thread
+from .stats import ADDRESSBOOK
+from .stats import ATTACHMENTS
+from .stats import FETCH
+from .stats import disable_stats
+from .stats import enable_stats
+from .stats import save_stats
+from .stats import stage
+from .stats import thread_stats
+from .stats import timed
+from .thumbnails import make_thumbnails
+from .types import BASE_TYPE_MASK
+from .types import JOINED_TYPE
 from .types import is_group_call
 from .types import is_group_ctrl
 from .types import is_group_v2_data
+from .types import is_joined_type
 from .versioninfo import VersionInfo
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of group members whose names are cached, by binary UUID
+MEMBER_CACHE_SIZE = 4096
+
 
 def check_backup(backup_dir: Path) -> Tuple[Path, VersionInfo]:
     """Check that we have the necessary files and return VersionInfo"""
@@ -82,16 +126,142 @@ def get_color(db, recipient_id):
     return color
 
 
-def get_sms_records(db, thread, addressbook):
-    """Collect all the SMS records for a given thread"""
-    sms_records = []
-    sms_qry = db.execute(
-        "SELECT _id, address, date, date_sent, body, type, "
-        "delivery_receipt_count, read_receipt_count "
-        "FROM sms WHERE thread_id=?",
-        (thread._id,),
+SMS_COLUMNS = (
+    "_id, address, date, date_sent, body, type, "
+    "delivery_receipt_count, read_receipt_count"
+)
+
+MENTION_COLUMNS = "_id, message_id, recipient_id, range_start, range_length"
+
+# Order of the messages of a thread, by the dates used as Thread.sms and
+# Thread.mms are merged by dateSent (see html.dump_thread)
+SMS_ORDER = "date_sent, _id"
+MMS_ORDER = "date, _id"
+
+# Number of rows that are read at a time when streaming threads
+BATCH_SIZE = 500
+
+
+def get_mms_columns(versioninfo) -> str:
+    """Returns the columns to select from the mms table"""
+    reaction_expr = versioninfo.get_reactions_query_column()
+    quote_mentions_expr = versioninfo.get_quote_mentions_query_column()
+    viewed_receipt_count_expr = versioninfo.get_viewed_receipt_count_column()
+    return (
+        "_id, address, date, date_received, body, quote_id, "
+        f"quote_author, quote_body, {quote_mentions_expr}, msg_box, "
+        f"{reaction_expr}, delivery_receipt_count, read_receipt_count, "
+        f"{viewed_receipt_count_expr}"
     )
-    qry_res = sms_qry.fetchall()
+
+
+@dataclass
+class ThreadRows:
+    """Raw database rows of a single thread, as produced by BulkReader
+
+    When only the mentions are read, the message rows are None."""
+
+    sms: Optional[list]
+    mms: Optional[list]
+    parts: Optional[list]
+    mentions: list
+
+
+class ThreadBatches:
+    """Split the result of a query ordered by thread_id into per-thread
+    batches.
+
+    The first column of the query must be the thread_id, it is stripped from
+    the rows that are returned. Batches must be requested in increasing order
+    of thread_id, threads without rows get an empty batch."""
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._groups = itertools.groupby(cursor, key=itemgetter(0))
+        self._current = next(self._groups, None)
+
+    def pop(self, thread_id: int) -> list:
+        while self._current is not None and (
+            self._current[0] is None or self._current[0] < thread_id
+        ):
+            self._current = next(self._groups, None)
+        if self._current is None or self._current[0] != thread_id:
+            return []
+        rows = [row[1:] for row in self._current[1]]
+        self._current = next(self._groups, None)
+        return rows
+
+
+class BulkReader:
+    """Read the sms, mms, part, and mention tables for all threads with a
+    single scan each.
+
+    Running one query per thread means one table scan per thread when the
+    thread_id column isn't indexed. Instead, the tables are read once in
+    order of thread_id and the rows are handed out per thread. Threads must
+    be requested in increasing order of their ID. Without messages, only the
+    mentions are read (for streaming, see stream_thread)."""
+
+    def __init__(
+        self, db: sqlite3.Cursor, versioninfo: VersionInfo, messages=True
+    ):
+        # Use separate cursors, as the one we're given is reused for other
+        # queries while these are being consumed.
+        conn = db.connection
+        self._mentions = None
+        if versioninfo.are_mentions_supported():
+            self._mentions = ThreadBatches(
+                conn.execute(
+                    f"SELECT thread_id, {MENTION_COLUMNS} FROM mention "
+                    "ORDER BY thread_id, _id"
+                )
+            )
+        self._sms = self._mms = self._parts = None
+        if not messages:
+            return
+        self._sms = ThreadBatches(
+            conn.execute(
+                f"SELECT thread_id, {SMS_COLUMNS} FROM sms "
+                f"ORDER BY thread_id, {SMS_ORDER}"
+            )
+        )
+        self._mms = ThreadBatches(
+            conn.execute(
+                f"SELECT thread_id, {get_mms_columns(versioninfo)} FROM mms "
+                f"ORDER BY thread_id, {MMS_ORDER}"
+            )
+        )
+        columns = ", ".join(f"p.{c}" for c in PART_COLUMNS.split(", "))
+        self._parts = ThreadBatches(
+            conn.execute(
+                f"SELECT m.thread_id, p.mid, {columns} FROM part p "
+                "JOIN mms m ON p.mid = m._id "
+                "ORDER BY m.thread_id, p.mid, p._id"
+            )
+        )
+
+    def get(self, thread_id: int) -> ThreadRows:
+        """Return the rows for the given thread"""
+        batches = (self._sms, self._mms, self._parts, self._mentions)
+        sms, mms, parts, mentions = (
+            None if batches is None else batches.pop(thread_id)
+            for batches in batches
+        )
+        return ThreadRows(
+            sms=sms, mms=mms, parts=parts, mentions=mentions or []
+        )
+
+
+def fetch_batches(cursor: sqlite3.Cursor, batch_size: int) -> Iterator[list]:
+    """Fetch the rows of a query batch_size rows at a time"""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def make_sms_records(rows, addressbook) -> Iterator[SMSMessageRecord]:
+    """Generate the SMS records for rows of the sms table"""
     for (
         _id,
         address,
@@ -101,72 +271,101 @@ def get_sms_records(db, thread, addressbook):
         _type,
         delivery_receipt_count,
         read_receipt_count,
-    ) in qry_res:
+    ) in rows:
         data = get_data_from_body(_type, body, addressbook, _id)
         sms_auth = addressbook.get_recipient_by_address(str(address))
-        sms = SMSMessageRecord(
+        yield SMSMessageRecord(
             _id=_id,
             data=data,
             delivery_receipt_count=delivery_receipt_count,
             read_receipt_count=read_receipt_count,
             addressRecipient=sms_auth,
-            recipient=thread.recipient,
             dateSent=date_sent,
             dateReceived=date,
-            threadId=thread._id,
             body=body,
             _type=_type,
         )
-        sms_records.append(sms)
-    return sms_records
 
 
-def get_attachment_filename(_id, unique_id, backup_dir, thread_dir):
-    """Get the absolute path of an attachment, warn if it doesn't exist"""
-    fname = f"Attachment_{_id}_{unique_id}.bin"
-    source = os.path.abspath(os.path.join(backup_dir, fname))
-    if not os.path.exists(source):
-        logger.warn(
-            f"Couldn't find attachment '{source}'. "
-            "Maybe it was deleted or never downloaded?"
+def get_sms_records(db, thread, addressbook, rows=None):
+    """Collect all the SMS records for a given thread
+
+    The rows can be provided by the caller (see BulkReader), otherwise they
+    are queried from the database."""
+    if rows is None:
+        sms_qry = db.execute(
+            f"SELECT {SMS_COLUMNS} FROM sms WHERE thread_id=? "
+            f"ORDER BY {SMS_ORDER}",
+            (thread._id,),
         )
-        return None
+        rows = sms_qry.fetchall()
+    return list(make_sms_records(rows, addressbook))
+
+
+def stream_sms_records(
+    db, thread, addressbook, batch_size=BATCH_SIZE
+) -> Iterator[SMSMessageRecord]:
+    """Generate the SMS records of a thread in order of sending, reading
+    batch_size rows at a time"""
+    cursor = db.connection.execute(
+        f"SELECT {SMS_COLUMNS} FROM sms WHERE thread_id=? "
+        f"ORDER BY {SMS_ORDER}",
+        (thread._id,),
+    )
+    for rows in fetch_batches(cursor, batch_size):
+        yield from make_sms_records(rows, addressbook)
 
-    filetype_kind = filetype.guess(source)
-    if filetype_kind is None:
-        new_fname = fname
-    else:
-        extension = filetype_kind.extension
-        new_fname =f"Attachment_{_id}_{unique_id}.{extension}"
 
-    # Copying here is a bit of a side-effect
-    target_dir = os.path.abspath(os.path.join(thread_dir, "attachments"))
-    os.makedirs(target_dir, exist_ok=True)
-    target = os.path.join(target_dir, new_fname)
-    shutil.copy(source, target)
-    url = "/".join([".", "attachments", new_fname])
-    return url
+PART_COLUMNS = "_id, ct, unique_id, voice_note, width, height, quote"
+
 
+def get_thread_parts(db, thread_id: int) -> list:
+    """Retrieve the attachment rows of all MMS messages in a thread
 
-def add_mms_attachments(db, mms, backup_dir, thread_dir):
-    """Add all attachment objects to MMS message"""
+    The rows are ordered by message, the first column is the message ID."""
+    columns = ", ".join(f"p.{c}" for c in PART_COLUMNS.split(", "))
     qry = db.execute(
-        "SELECT _id, ct, unique_id, voice_note, width, height, quote "
-        "FROM part WHERE mid=?",
-        (mms._id,),
+        f"SELECT p.mid, {columns} FROM part p "
+        "JOIN mms m ON p.mid = m._id "
+        "WHERE m.thread_id=? ORDER BY p.mid, p._id",
+        (thread_id,),
     )
-    for _id, ct, unique_id, voice_note, width, height, quote in qry:
+    return qry.fetchall()
+
+
+def index_parts(part_rows: list) -> Dict[int, list]:
+    """Group attachment rows by the ID of the message they belong to"""
+    return {
+        mid: [row[1:] for row in rows]
+        for mid, rows in itertools.groupby(part_rows, key=itemgetter(0))
+    }
+
+
+def add_mms_attachments(db, mms, exporter, thread_dir, rows=None):
+    """Add all attachment objects to MMS message
+
+    The attachments are queued for export to the thread directory, their
+    filename is set by the exporter. The attachment rows of the message can
+    be provided by the caller (see index_parts), otherwise they are queried
+    from the database."""
+    if rows is None:
+        qry = db.execute(
+            f"SELECT {PART_COLUMNS} FROM part WHERE mid=?",
+            (mms._id,),
+        )
+        rows = qry.fetchall()
+    for _id, ct, unique_id, voice_note, width, height, quote in rows:
         a = Attachment(
-            contentType=ct,
+            contentType=sys.intern(ct) if ct else ct,
             unique_id=unique_id,
-            fileName=get_attachment_filename(
-                _id, unique_id, backup_dir, thread_dir
-            ),
+            fileName=None,
             voiceNote=voice_note,
             width=width,
             height=height,
             quote=quote,
         )
+        with stage(ATTACHMENTS):
+            exporter.submit(a, _id, unique_id, thread_dir)
         mms.attachments.append(a)
 
 
@@ -186,7 +385,7 @@ def get_group_call_data(rawbody, addressbook, mid):
         return None
 
     try:
-        structured_call = StructuredGroupCall.loads(rawbody)
+        structured_call = decode_message(StructuredGroupCall, rawbody)
     except (ValueError, IndexError, TypeError) as e:
         logger.warn(
             f"Failed to load group call data for message {mid}:\n"
@@ -227,7 +426,7 @@ def get_group_update_data_v1(rawbody, addressbook, mid):
         return None
 
     try:
-        structured_group_data = StructuredGroupDataV1.loads(rawbody)
+        structured_group_data = decode_message(StructuredGroupDataV1, rawbody)
     except (ValueError, IndexError, TypeError) as e:
         logger.warn(
             f"Failed to load group update data (v1) for message {mid}:\n"
@@ -276,19 +475,77 @@ def get_group_update_data_v1(rawbody, addressbook, mid):
     return group_update_data
 
 
+@functools.lru_cache(maxsize=MEMBER_CACHE_SIZE)
+def _get_member_name(raw_uuid: bytes, addressbook) -> str:
+    """Get the name of a member from a binary UUID (cached, see
+    clear_caches)"""
+    text_uuid = str(uuid.UUID(bytes=raw_uuid))
+    recipient = addressbook.get_recipient_by_uuid(text_uuid)
+    return recipient.name if recipient else text_uuid
+
+
 def get_member_by_raw_uuid(raw_uuid: bytes, what: str, addressbook, mid: str):
     """Find a recipient from a binary UUID. Output their name from the
     addressbook or the textual UUID if not found."""
 
     try:
-        text_uuid = str(uuid.UUID(bytes=raw_uuid))
+        return _get_member_name(raw_uuid, addressbook)
     except ValueError as e:
         logger.warn(f"Failed to parse {what} UUID for message {mid}: {str(e)}")
         return None
 
-    recipient = addressbook.get_recipient_by_uuid(text_uuid)
-    member_name = recipient.name if recipient else text_uuid
-    return member_name
+
+@dataclass
+class CacheStats:
+    """Hits and misses of the caches used to decode messages
+
+    The counts are [hits, misses] by the name of the cache. They are taken
+    in every process and added up, to tune the sizes of the caches."""
+
+    counts: Dict[str, List[int]] = field(default_factory=dict)
+
+    def since(self, earlier: "CacheStats") -> "CacheStats":
+        """Get the counts since an earlier snapshot of the caches"""
+        return CacheStats(
+            {
+                name: [
+                    hits - earlier.counts[name][0],
+                    misses - earlier.counts[name][1],
+                ]
+                for name, (hits, misses) in self.counts.items()
+            }
+        )
+
+    def update(self, other: "CacheStats"):
+        """Add the counts of another instance to this one"""
+        for name, (hits, misses) in other.counts.items():
+            counts = self.counts.setdefault(name, [0, 0])
+            counts[0] += hits
+            counts[1] += misses
+
+    def log(self):
+        """Log the counts at debug level"""
+        for name, (hits, misses) in self.counts.items():
+            logger.debug(f"Cache of {name}: {hits} hits, {misses} misses")
+
+
+def get_cache_stats() -> CacheStats:
+    """Get the hits and misses of the caches used to decode messages in this
+    process"""
+    caches = {
+        "member names": _get_member_name.cache_info(),
+        "nested messages": get_message_cache_info(),
+    }
+    return CacheStats(
+        {name: [info.hits, info.misses] for name, info in caches.items()}
+    )
+
+
+def clear_caches():
+    """Empty the caches used to decode messages, which keep a reference to
+    the addressbook"""
+    _get_member_name.cache_clear()
+    clear_message_cache()
 
 
 def get_group_update_data_v2(rawbody, addressbook, mid):
@@ -308,7 +565,7 @@ def get_group_update_data_v2(rawbody, addressbook, mid):
         return None
 
     try:
-        structured_group_data = StructuredGroupDataV2.loads(rawbody)
+        structured_group_data = decode_message(StructuredGroupDataV2, rawbody)
     except (ValueError, IndexError, TypeError) as e:
         logger.warn(
             f"Failed to load group update data (v2) for message {mid}:\n"
@@ -416,7 +673,9 @@ def get_mms_mentions(encoded_mentions, addressbook, mid):
         return mentions
 
     try:
-        structured_mentions = StructuredMentions.loads(encoded_mentions)
+        structured_mentions = decode_message(
+            StructuredMentions, encoded_mentions
+        )
     except (ValueError, IndexError, TypeError) as e:
         logger.warn(
             f"Failed to load quote mentions for message {mid}:\n"
@@ -447,7 +706,9 @@ def get_mms_reactions(encoded_reactions, addressbook, mid):
         return reactions
 
     try:
-        structured_reactions = StructuredReactions.loads(encoded_reactions)
+        structured_reactions = decode_message(
+            StructuredReactions, encoded_reactions
+        )
     except (ValueError, IndexError, TypeError) as e:
         logger.warn(
             f"Failed to load reactions for message {mid}:\n"
@@ -459,9 +720,10 @@ def get_mms_reactions(encoded_reactions, addressbook, mid):
         recipient = addressbook.get_recipient_by_address(
             str(structured_reaction.who)
         )
+        what = structured_reaction.what
         reaction = Reaction(
             recipient=recipient,
-            what=structured_reaction.what,
+            what=sys.intern(what) if what else what,
             time_sent=dt.datetime.fromtimestamp(
                 structured_reaction.time_sent // 1000
             ),
@@ -480,24 +742,9 @@ def get_mms_reactions(encoded_reactions, addressbook, mid):
     return reactions
 
 
-def get_mms_records(
-    db, thread, addressbook, backup_dir, thread_dir, versioninfo
-):
-    """Collect all MMS records for a given thread"""
-    mms_records = []
-
-    reaction_expr = versioninfo.get_reactions_query_column()
-    quote_mentions_expr = versioninfo.get_quote_mentions_query_column()
-    viewed_receipt_count_expr = versioninfo.get_viewed_receipt_count_column()
-
-    qry = db.execute(
-        "SELECT _id, address, date, date_received, body, quote_id, "
-        f"quote_author, quote_body, {quote_mentions_expr}, msg_box, {reaction_expr}, "
-        f"delivery_receipt_count, read_receipt_count, {viewed_receipt_count_expr} "
-        "FROM mms WHERE thread_id=?",
-        (thread._id,),
-    )
-    qry_res = qry.fetchall()
+def make_mms_records(rows, addressbook) -> Iterator[MMSMessageRecord]:
+    """Generate the MMS records for rows of the mms table, without their
+    attachments"""
     for (
         _id,
         address,
@@ -513,7 +760,7 @@ def get_mms_records(
         delivery_receipt_count,
         read_receipt_count,
         viewed_receipt_count,
-    ) in qry_res:
+    ) in rows:
         quote = get_mms_quote(
             addressbook,
             quote_id,
@@ -527,16 +774,14 @@ def get_mms_records(
 
         data = get_data_from_body(msg_box, body, addressbook, _id)
         mms_auth = addressbook.get_recipient_by_address(str(address))
-        mms = MMSMessageRecord(
+        yield MMSMessageRecord(
             _id=_id,
             data=data,
             delivery_receipt_count=delivery_receipt_count,
             read_receipt_count=read_receipt_count,
             addressRecipient=mms_auth,
-            recipient=thread.recipient,
             dateSent=date,
             dateReceived=date_received,
-            threadId=thread._id,
             body=body,
             quote=quote,
             attachments=[],
@@ -544,14 +789,88 @@ def get_mms_records(
             _type=msg_box,
             viewed_receipt_count=viewed_receipt_count,
         )
-        mms_records.append(mms)
 
+
+def get_mms_records(
+    db,
+    thread,
+    addressbook,
+    exporter,
+    thread_dir,
+    versioninfo,
+    rows=None,
+    part_rows=None,
+):
+    """Collect all MMS records for a given thread
+
+    The message and attachment rows can be provided by the caller (see
+    BulkReader), otherwise they are queried from the database."""
+    if rows is None:
+        qry = db.execute(
+            f"SELECT {get_mms_columns(versioninfo)} "
+            f"FROM mms WHERE thread_id=? ORDER BY {MMS_ORDER}",
+            (thread._id,),
+        )
+        rows = qry.fetchall()
+    mms_records = list(make_mms_records(rows, addressbook))
+
+    if part_rows is None:
+        part_rows = get_thread_parts(db, thread._id)
+    parts = index_parts(part_rows)
     for mms in mms_records:
-        add_mms_attachments(db, mms, backup_dir, thread_dir)
+        add_mms_attachments(
+            db, mms, exporter, thread_dir, rows=parts.get(mms._id, [])
+        )
 
     return mms_records
 
 
+def stream_mms_records(
+    db,
+    thread,
+    addressbook,
+    exporter,
+    thread_dir,
+    versioninfo,
+    batch_size=BATCH_SIZE,
+) -> Iterator[MMSMessageRecord]:
+    """Generate the MMS records of a thread in order of sending, reading
+    batch_size rows at a time
+
+    The attachments are read in the same order as the messages, so the
+    attachments of a batch are the next ones in the query. The filenames of
+    the attachments of a batch are set before its messages are generated."""
+    conn = db.connection
+    cursor = conn.execute(
+        f"SELECT {get_mms_columns(versioninfo)} "
+        f"FROM mms WHERE thread_id=? ORDER BY {MMS_ORDER}",
+        (thread._id,),
+    )
+    columns = ", ".join(f"p.{c}" for c in PART_COLUMNS.split(", "))
+    order = ", ".join(f"m.{c}" for c in MMS_ORDER.split(", "))
+    parts = itertools.groupby(
+        conn.execute(
+            f"SELECT p.mid, {columns} FROM part p "
+            "JOIN mms m ON p.mid = m._id "
+            f"WHERE m.thread_id=? ORDER BY {order}, p._id",
+            (thread._id,),
+        ),
+        key=itemgetter(0),
+    )
+    current = next(parts, None)
+    for rows in fetch_batches(cursor, batch_size):
+        mms_records = list(make_mms_records(rows, addressbook))
+        for mms in mms_records:
+            part_rows = []
+            if current is not None and current[0] == mms._id:
+                part_rows = [row[1:] for row in current[1]]
+                current = next(parts, None)
+            add_mms_attachments(db, mms, exporter, thread_dir, rows=part_rows)
+        with stage(ATTACHMENTS):
+            exporter.wait_for_filenames()
+        yield from mms_records
+
+
 def get_mms_quote(
     addressbook, quote_id, quote_author, quote_body, quote_mentions, mid
 ):
@@ -569,36 +888,34 @@ def get_mms_quote(
     return quote
 
 
-def get_mentions(db, addressbook, thread_id, versioninfo):
-    """Retrieve all mentions in the DB for the requested thread into a dictionary."""
+def index_mentions(
+    rows: list, addressbook: Addressbook
+) -> Dict[int, Dict[int, Mention]]:
+    """Index rows of the mention table by message ID and range start"""
     mentions = {}
+    get_recipient = addressbook.get_recipient_by_address
+    for _id, message_id, recipient_id, range_start, range_length in rows:
+        name = get_recipient(str(recipient_id)).name
+        mention = Mention(mention_id=_id, name=name, length=range_length)
+        mentions.setdefault(message_id, {})[range_start] = mention
+    return mentions
 
-    if versioninfo.are_mentions_supported():
+
+def get_mentions(db, addressbook, thread_id, versioninfo, rows=None):
+    """Retrieve all mentions in the DB for the requested thread into a dictionary.
+
+    The mention rows can be provided by the caller (see BulkReader),
+    otherwise they are queried from the database."""
+    if rows is None:
+        if not versioninfo.are_mentions_supported():
+            return {}
         query = db.execute(
-            "SELECT _id, message_id, recipient_id, range_start, range_length "
-            "FROM mention WHERE thread_id=?",
+            f"SELECT {MENTION_COLUMNS} FROM mention WHERE thread_id=? "
+            "ORDER BY _id",
             (thread_id,),
         )
-        mentions_data = query.fetchall()
-
-        for (
-            _id,
-            message_id,
-            recipient_id,
-            range_start,
-            range_length,
-        ) in mentions_data:
-            name = addressbook.get_recipient_by_address(str(recipient_id)).name
-            mention = Mention(
-                mention_id=_id,
-                name=name,
-                length=range_length,
-            )
-            if not message_id in mentions.keys():
-                mentions[message_id] = {}
-            mentions[message_id][range_start] = mention
-
-    return mentions
+        rows = query.fetchall()
+    return index_mentions(rows, addressbook)
 
 
 def get_members(
@@ -652,60 +969,516 @@ def get_members(
 
 
 def populate_thread(
-    db, thread, addressbook, backup_dir, thread_dir, versioninfo=None
+    db,
+    thread,
+    addressbook,
+    exporter,
+    thread_dir,
+    versioninfo=None,
+    rows: Optional[ThreadRows] = None,
 ):
-    """Populate a thread with all corresponding messages"""
-    sms_records = get_sms_records(db, thread, addressbook)
+    """Populate a thread with all corresponding messages
+
+    Attachments are exported to the thread directory by the
+    AttachmentExporter. If the rows of the thread are not provided, they are
+    queried from the database."""
+    sms_records = get_sms_records(
+        db, thread, addressbook, rows=None if rows is None else rows.sms
+    )
     mms_records = get_mms_records(
         db,
         thread,
         addressbook,
-        backup_dir,
+        exporter,
         thread_dir,
         versioninfo,
+        rows=None if rows is None else rows.mms,
+        part_rows=None if rows is None else rows.parts,
     )
     thread.sms = sms_records
     thread.mms = mms_records
-    thread.mentions = get_mentions(db, addressbook, thread._id, versioninfo)
+    thread.mentions = get_mentions(
+        db,
+        addressbook,
+        thread._id,
+        versioninfo,
+        rows=None if rows is None else rows.mentions,
+    )
     thread.members = get_members(db, addressbook, thread._id, versioninfo)
+    with stage(ATTACHMENTS):
+        exporter.wait_for_filenames()
 
 
-def process_backup(backup_dir: Path, output_dir: Path):
-    """Main functionality to convert database into HTML"""
+def get_message_headers(db, thread, addressbook) -> Iterator[MessageHeader]:
+    """Generate the headers of the messages of a thread in order of sending,
+    without reading and decoding their content"""
+    conn = db.connection
+    sms = conn.execute(
+        "SELECT address, date_sent, type FROM sms WHERE thread_id=? "
+        f"ORDER BY {SMS_ORDER}",
+        (thread._id,),
+    )
+    mms = conn.execute(
+        "SELECT address, date, msg_box FROM mms WHERE thread_id=? "
+        f"ORDER BY {MMS_ORDER}",
+        (thread._id,),
+    )
+    get_recipient = addressbook.get_recipient_by_address
+    return merge_messages(
+        (MessageHeader(get_recipient(str(a)), d, t) for a, d, t in mms),
+        (MessageHeader(get_recipient(str(a)), d, t) for a, d, t in sms),
+    )
+
 
-    logger.info(f"This is signal2html version {__version__}")
+def stream_thread(
+    db,
+    thread,
+    addressbook,
+    exporter,
+    thread_dir,
+    versioninfo,
+    batch_size=BATCH_SIZE,
+    mention_rows=None,
+):
+    """Populate the mentions and members of a thread and stream its messages
+
+    Returns an iterator of the messages in order of sending, which are read
+    batch_size rows at a time while they are consumed, and a function that
+    returns a new iterator of their headers (see get_message_headers). These
+    can be given to html.dump_thread, so that only a batch of messages of
+    the thread is in memory at a time. The mention rows of the thread can be
+    provided by the caller (see BulkReader)."""
+    thread.mentions = get_mentions(
+        db, addressbook, thread._id, versioninfo, rows=mention_rows
+    )
+    thread.members = get_members(db, addressbook, thread._id, versioninfo)
+    messages = merge_messages(
+        stream_mms_records(
+            db,
+            thread,
+            addressbook,
+            exporter,
+            thread_dir,
+            versioninfo,
+            batch_size=batch_size,
+        ),
+        stream_sms_records(db, thread, addressbook, batch_size=batch_size),
+    )
+    return timed(messages, FETCH), lambda: timed(
+        get_message_headers(db, thread, addressbook), FETCH
+    )
 
-    # Verify backup and open database
-    db_file, versioninfo = check_backup(backup_dir)
-    db_conn = sqlite3.connect(db_file)
-    db = db_conn.cursor()
 
-    # Check if database is empty
-    qry = db.execute("SELECT COUNT(*) FROM sqlite_schema")
-    record = qry.fetchone()
-    if record == (0,):
-        raise DatabaseEmptyError()
+def get_visible_threads(db) -> Set[int]:
+    """Get the IDs of the threads with messages that end up in the HTML
+    output, like has_visible_messages does for the rows of a thread"""
+    qry = db.execute(
+        "SELECT thread_id FROM sms WHERE type & ? != ? "
+        "UNION SELECT thread_id FROM mms WHERE msg_box & ? != ?",
+        (BASE_TYPE_MASK, JOINED_TYPE) * 2,
+    )
+    return {thread_id for (thread_id,) in qry}
 
-    # Get and index all contact and group names
-    addressbook = make_addressbook(db, versioninfo)
 
-    # Start by getting the Threads from the database
-    recipient_id_expr = versioninfo.get_thread_recipient_id_column()
+def has_visible_messages(rows: ThreadRows) -> bool:
+    """Check whether a thread has messages that end up in the HTML output
 
-    query = db.execute(f"SELECT _id, {recipient_id_expr} FROM thread")
+    This mirrors dump_thread, which skips messages of the joined type and
+    doesn't write a page for threads without messages."""
+    # The message type is the sixth column for sms and the tenth for mms
+    return any(not is_joined_type(row[5]) for row in rows.sms) or any(
+        not is_joined_type(row[9]) for row in rows.mms
+    )
+
+
+def plan_threads(
+    db,
+    addressbook,
+    versioninfo,
+    output_dir,
+    manifest=None,
+    stream=False,
+    overwrite=False,
+) -> Iterator[Tuple[Thread, Optional[ThreadRows], str]]:
+    """Generate the threads to export with their rows and output file
+
+    The output file of a thread is chosen taking into account the files of
+    the preceding threads, even if these haven't been written yet. This
+    ensures the same files are used whether the threads are exported in
+    order or in parallel.
+
+    If a manifest of a previous export is given, threads that are unchanged
+    are skipped and changed threads keep their output file. The threads
+    that are generated are recorded in the manifest. Without a manifest,
+    overwrite makes the threads reuse the files of a previous export to the
+    output directory instead of being placed next to them (see
+    Thread.get_path).
+
+    When streaming, only the mention rows of the threads are read, as the
+    messages are streamed from the database when they are exported (see
+    stream_thread)."""
+    recipient_id_expr = versioninfo.get_thread_recipient_id_column()
+    query = db.execute(
+        f"SELECT _id, {recipient_id_expr} FROM thread ORDER BY _id"
+    )
     threads = query.fetchall()
 
+    # Read the messages and mentions of all threads in one pass over the
+    # tables
+    with stage(FETCH):
+        reader = BulkReader(db, versioninfo, messages=not stream)
+        if stream:
+            visible_threads = get_visible_threads(db)
+
     # Combine the recipient objects and the thread info into Thread objects
+    reserved = set()
+    skipped = 0
     for _id, recipient_id in threads:
         recipient = addressbook.get_recipient_by_address(str(recipient_id))
         if recipient is None:
             logger.warn(f"No recipient with address {recipient_id}")
 
+        if manifest is not None and manifest.is_unchanged(_id):
+            skipped += 1
+            continue
+
         t = Thread(_id=_id, recipient=recipient)
-        thread_dir = t.get_thread_dir(output_dir, make_dir=False)
-        populate_thread(
-            db, t, addressbook, backup_dir, thread_dir, versioninfo=versioninfo
+        with stage(FETCH):
+            rows = reader.get(_id)
+        output_file = None if manifest is None else manifest.output_file(_id)
+        if output_file is None or output_file in reserved:
+            output_file = t.get_path(
+                output_dir,
+                make_dir=False,
+                reserved=reserved,
+                # Unchanged threads aren't reserved, their files must stay
+                overwrite=overwrite and manifest is None,
+            )
+        if stream:
+            visible = _id in visible_threads
+        else:
+            visible = has_visible_messages(rows)
+        if visible:
+            reserved.add(output_file)
+        if manifest is not None:
+            manifest.record(_id, output_file if visible else None)
+        yield t, rows, output_file
+
+    if skipped:
+        logger.info(f"Skipped {skipped} unchanged thread(s).")
+
+
+def prepare_addressbook(db, addressbook, versioninfo):
+    """Add the recipients that are created while exporting the threads
+
+    Recipients that are not in the recipient table are added to the
+    addressbook when they are first encountered. This function looks up the
+    senders and members of all threads in the same order as the export does,
+    so that the recipients are identical when the threads are exported in
+    separate processes."""
+    conn = db.connection
+    recipient_id_expr = versioninfo.get_thread_recipient_id_column()
+    threads = conn.execute(
+        f"SELECT _id, {recipient_id_expr} FROM thread ORDER BY _id"
+    ).fetchall()
+    sms = ThreadBatches(
+        conn.execute(
+            "SELECT thread_id, address FROM sms "
+            f"ORDER BY thread_id, {SMS_ORDER}"
         )
-        dump_thread(t, output_dir)
+    )
+    mms = ThreadBatches(
+        conn.execute(
+            "SELECT thread_id, quote_id, quote_author, address FROM mms "
+            f"ORDER BY thread_id, {MMS_ORDER}"
+        )
+    )
+    mentions = None
+    if versioninfo.are_mentions_supported():
+        mentions = ThreadBatches(
+            conn.execute(
+                "SELECT thread_id, recipient_id FROM mention "
+                "ORDER BY thread_id, _id"
+            )
+        )
+    for _id, recipient_id in threads:
+        addressbook.get_recipient_by_address(str(recipient_id))
+        for (address,) in sms.pop(_id):
+            addressbook.get_recipient_by_address(str(address))
+        for quote_id, quote_author, address in mms.pop(_id):
+            if quote_id:
+                addressbook.get_recipient_by_address(quote_author)
+            addressbook.get_recipient_by_address(str(address))
+        if mentions is not None:
+            for (recipient_id,) in mentions.pop(_id):
+                addressbook.get_recipient_by_address(str(recipient_id))
+        get_members(db, addressbook, _id, versioninfo)
+
+
+def export_thread(
+    db,
+    thread,
+    addressbook,
+    exporter,
+    output_dir,
+    output_file,
+    versioninfo,
+    rows,
+    dump_options=None,
+    batch_size=None,
+):
+    """Populate a thread and write it to the given output file
+
+    With a batch size, the messages are streamed from the database to the
+    output file batch_size rows at a time (see stream_thread), instead of
+    populating the thread with all its messages first. The dump options are
+    passed on to html.dump_thread.
+
+    If statistics or the memory profile are enabled, they are recorded for
+    the thread (see stats.RunStats and memory.MemoryProfile)."""
+    thread_dir = os.path.dirname(output_file)
+    dump_options = dump_options or {}
+    with thread_stats(thread._id), thread_memory(thread._id, thread.sanename):
+        if batch_size:
+            with memory_stage(POPULATE), stage(FETCH):
+                messages, headers = stream_thread(
+                    db,
+                    thread,
+                    addressbook,
+                    exporter,
+                    thread_dir,
+                    versioninfo,
+                    batch_size=batch_size,
+                    mention_rows=None if rows is None else rows.mentions,
+                )
+            with memory_stage(DUMP):
+                dump_thread(
+                    thread,
+                    output_dir,
+                    output_file=output_file,
+                    messages=messages,
+                    headers=headers,
+                    **dump_options,
+                )
+            return
+        with memory_stage(POPULATE), stage(FETCH):
+            populate_thread(
+                db,
+                thread,
+                addressbook,
+                exporter,
+                thread_dir,
+                versioninfo=versioninfo,
+                rows=rows,
+            )
+        with memory_stage(DUMP):
+            dump_thread(
+                thread, output_dir, output_file=output_file, **dump_options
+            )
 
-    db.close()
+
+def process_backup(
+    backup_dir: Path,
+    output_dir: Path,
+    jobs: int = 1,
+    io_threads: int = 4,
+    attachment_mode: str = "copy",
+    media_store: bool = False,
+    incremental: bool = False,
+    sync: Optional[str] = None,
+    paginate=None,
+    thumbnail_size: Optional[int] = None,
+    template_cache: bool = False,
+    batch_size: Optional[int] = None,
+    working_copy: Optional[str] = None,
+    sql_stats: bool = False,
+    stats_file: Optional[str] = None,
+    memory_profile: Optional[int] = None,
+):
+    """Main functionality to convert database into HTML
+
+    With more than one job, the threads are exported in parallel by a pool
+    of worker processes. Attachments are exported by io_threads threads (in
+    each process) using the given mode (see attachments.place_file). With
+    media_store, attachments are stored once by their content hash in the
+    media directory of the output, instead of in each thread directory.
+
+    In incremental mode, threads that are unchanged since the previous
+    export to the output directory are skipped (see manifest.Manifest).
+    With a sync mode, threads are written to the same files as in the
+    previous export, and attachments that are already in the output
+    directory are only placed again if they changed (see
+    attachments.is_synced).
+    Large threads can be split into pages by month or by a number of
+    messages (see html.get_pages). With a thumbnail size, thumbnails of
+    large images are made by a pool of jobs processes after the export, or
+    of one process per CPU if the threads are exported serially.
+    With template_cache, the compiled templates are cached in the output
+    directory for later runs. With a batch size, threads are streamed from
+    the database to the output batch_size rows at a time, so that memory use
+    doesn't depend on the length of the threads (see stream_thread).
+
+    The database is only read. With a working copy ("memory" or "temp"),
+    it's copied first and the indexes that are missing are added to the
+    copy (see database.Database). Parallel workers can't share a copy in
+    memory, so a temporary file is used instead. With sql_stats, the time,
+    number of rows, and plan of every query are recorded and reported at
+    the end (see database.QueryStats). With a stats file, the time spent in
+    every stage of the export is recorded, overall and per thread, and
+    saved to the file as JSON with the throughput (see stats.RunStats).
+    With memory_profile, the memory used by every thread is traced and the
+    given number of threads with the highest peak is reported at the end
+    (see memory.MemoryProfile)."""
+    start, start_cpu = time.perf_counter(), time.process_time()
+    # The statistics and the database are cleaned up even if the export
+    # fails, so that they don't linger in the process
+    with contextlib.ExitStack() as cleanup:
+        run_stats = profile = None
+        if stats_file:
+            run_stats = enable_stats()
+            cleanup.callback(disable_stats)
+        if memory_profile:
+            profile = enable_memory_profile()
+            cleanup.callback(disable_memory_profile)
+
+        logger.info(f"This is signal2html version {__version__}")
+
+        # Verify backup and open database
+        db_file, versioninfo = check_backup(backup_dir)
+        if working_copy == "memory" and jobs > 1:
+            working_copy = "temp"
+        query_stats = QueryStats() if sql_stats else None
+        database = Database(
+            db_file, working_copy=working_copy, query_stats=query_stats
+        )
+        cleanup.callback(database.close)
+        cleanup.callback(clear_caches)
+        db = database.connection.cursor()
+
+        # Check if database is empty
+        qry = db.execute("SELECT COUNT(*) FROM sqlite_schema")
+        record = qry.fetchone()
+        if record == (0,):
+            raise DatabaseEmptyError()
+
+        # Get and index all contact and group names
+        with stage(ADDRESSBOOK):
+            addressbook = make_addressbook(db, versioninfo)
+
+        manifest = None
+        if incremental:
+            key = dict(
+                signal2html=__version__,
+                addressbook=addressbook.inputs_hash,
+                media_store=media_store,
+                paginate=paginate,
+                thumbnail_size=thumbnail_size,
+            )
+            manifest = Manifest(output_dir, key, get_thread_fingerprints(db))
+
+        sniff_cache_file = os.path.join(
+            output_dir, ".signal2html", "sniff.json"
+        )
+        exporter_options = dict(
+            max_workers=io_threads,
+            mode=attachment_mode,
+            sniff_cache=load_sniff_cache(sniff_cache_file),
+            sync=sync,
+            thumbnail_size=thumbnail_size,
+        )
+        dump_options = dict(paginate=paginate)
+        if template_cache:
+            dump_options["template_cache"] = os.path.join(
+                output_dir, ".signal2html", "templates"
+            )
+        if media_store:
+            exporter_options["media_dir"] = os.path.join(output_dir, "media")
+        cache_stats = CacheStats()
+        if jobs > 1:
+            from .parallel import export_threads
+
+            with stage(ADDRESSBOOK):
+                prepare_addressbook(db, addressbook, versioninfo)
+            report = export_threads(
+                plan_threads(
+                    db,
+                    addressbook,
+                    versioninfo,
+                    output_dir,
+                    manifest,
+                    stream=bool(batch_size),
+                    overwrite=sync is not None,
+                ),
+                jobs,
+                database.path,
+                addressbook,
+                backup_dir,
+                output_dir,
+                versioninfo,
+                exporter_options,
+                dump_options,
+                batch_size,
+                query_stats,
+                run_stats,
+                profile,
+                cache_stats,
+            )
+        else:
+            cache_start = get_cache_stats()
+            exporter = AttachmentExporter(backup_dir, **exporter_options)
+            try:
+                for t, rows, output_file in plan_threads(
+                    db,
+                    addressbook,
+                    versioninfo,
+                    output_dir,
+                    manifest,
+                    stream=bool(batch_size),
+                    overwrite=sync is not None,
+                ):
+                    export_thread(
+                        db,
+                        t,
+                        addressbook,
+                        exporter,
+                        output_dir,
+                        output_file,
+                        versioninfo,
+                        rows,
+                        dump_options,
+                        batch_size,
+                    )
+            finally:
+                with stage(ATTACHMENTS):
+                    report = exporter.close()
+            cache_stats.update(get_cache_stats().since(cache_start))
+        cache_stats.log()
+        if report.thumbnails:
+            report.errors.extend(
+                make_thumbnails(
+                    report.thumbnails,
+                    jobs=jobs if jobs > 1 else None,
+                    max_size=thumbnail_size,
+                )
+            )
+        report.log()
+        if report.sniffed:
+            sniff_cache = exporter_options["sniff_cache"]
+            sniff_cache.update(report.sniffed)
+            save_sniff_cache(sniff_cache_file, sniff_cache)
+        if manifest is not None:
+            manifest.save()
+        if query_stats is not None:
+            query_stats.log()
+        if profile is not None:
+            profile.log(memory_profile)
+
+    if run_stats is not None:
+        wall_time = time.perf_counter() - start
+        cpu_time = time.process_time() - start_cpu
+        if jobs > 1:
+            # Add the time of the worker processes
+            cpu_time += sum(t["cpu"] for t in run_stats.threads)
+            cpu_time += report.copy_cpu_time
+        save_stats(stats_file, run_stats.to_dict(wall_time, cpu_time, report))
+        logger.info(f"Saved statistics of the run to {stats_file}.")
@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+
+"""Access to the database of a backup
+
+The database is opened read-only, and it's never modified. Reading is tuned
+with a memory map and a large page cache. Optionally, the database is copied
+to a working copy (in memory or in a temporary file) with the SQLite backup
+API, where the indexes that the export relies on are added if the backup
+doesn't have them.
+
+Connections can be instrumented to collect statistics of the queries that
+are run, with their query plans (see QueryStats).
+
+License: See LICENSE file.
+
+"""
+
+import logging
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import weakref
+
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+
+from typing import Dict
+from typing import List
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of bytes of the database that are memory mapped
+MMAP_SIZE = 1 << 30
+
+# Size of the page cache of a connection in KiB
+CACHE_SIZE = 256 * 1024
+
+# Places for a working copy of the database
+WORKING_COPIES = ("memory", "temp")
+
+# Maximum length of the queries in the report of the query statistics
+QUERY_WIDTH = 100
+
+# Columns of the indexes that are needed to look up the messages, attachments,
+# and mentions of a thread, by table
+INDEXES = {
+    "sms": ("thread_id", "date_sent"),
+    "mms": ("thread_id", "date"),
+    "part": ("mid",),
+    "mention": ("thread_id",),
+}
+
+
+def get_uri(db_file, immutable=True) -> str:
+    """Get the URI to open a database file read-only
+
+    If immutable, SQLite doesn't lock the file or check it for changes. This
+    is not used if the database has a write-ahead log, as it would be
+    ignored."""
+    db_file = Path(db_file).resolve()
+    wal_file = db_file.with_name(db_file.name + "-wal")
+    if immutable and not wal_file.exists():
+        return db_file.as_uri() + "?mode=ro&immutable=1"
+    return db_file.as_uri() + "?mode=ro"
+
+
+def tune(conn: sqlite3.Connection):
+    """Set the pragmas of a connection for reading the database"""
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+
+
+@dataclass
+class QueryStats:
+    """Statistics of the queries run on instrumented connections
+
+    The statistics are kept by query template, which is the SQL of the query
+    with normalized whitespace (the parameters are not part of it). For
+    every execution, the time to run the query and fetch its rows is
+    recorded. The query plan of a template is captured the first time it is
+    run."""
+
+    times: Dict[str, List[float]] = field(default_factory=dict)
+    rows: Dict[str, int] = field(default_factory=dict)
+    plans: Dict[str, List[str]] = field(default_factory=dict)
+    explained: set = field(default_factory=set, repr=False)
+
+    def update(self, other: "QueryStats"):
+        """Add the statistics of another instance to this one"""
+        for template, times in other.times.items():
+            self.times.setdefault(template, []).extend(times)
+        for template, rows in other.rows.items():
+            self.rows[template] = self.rows.get(template, 0) + rows
+        for template, plan in other.plans.items():
+            self.plans.setdefault(template, plan)
+
+    def drain(self) -> "QueryStats":
+        """Return the statistics collected so far and start anew
+
+        Query plans are not captured again for templates that were seen
+        before."""
+        stats = QueryStats(self.times, self.rows, self.plans)
+        self.times, self.rows, self.plans = {}, {}, {}
+        return stats
+
+    def explain(self, conn: sqlite3.Connection, template: str, sql, args):
+        """Capture the query plan of a template if it wasn't yet"""
+        if template in self.explained:
+            return
+        self.explained.add(template)
+        if not template.upper().startswith(("SELECT", "WITH")):
+            return
+        cursor = sqlite3.Cursor(conn)
+        depths = {0: -1}
+        plan = []
+        for _id, parent, _, detail in cursor.execute(
+            f"EXPLAIN QUERY PLAN {sql}", *args
+        ):
+            depths[_id] = depths.get(parent, -1) + 1
+            plan.append("  " * depths[_id] + detail)
+        self.plans[template] = plan
+
+    def get_full_scans(self, template: str) -> List[str]:
+        """Get the steps of the query plan that scan a whole table"""
+        return [
+            step.strip()
+            for step in self.plans.get(template, [])
+            if step.strip().startswith("SCAN ")
+            and " USING " not in step
+            and "CONSTANT ROW" not in step
+        ]
+
+    def log(self):
+        """Log a report of the queries by total time with their plans"""
+        if not self.times:
+            return
+        lines = [
+            "SQL queries by total time:",
+            f"{'calls':>8} {'total ms':>10} {'p95 ms':>8} {'rows':>9}  query",
+        ]
+        scans = 0
+        by_total = sorted(self.times.items(), key=lambda item: -sum(item[1]))
+        for template, times in by_total:
+            p95 = sorted(times)[math.ceil(0.95 * len(times)) - 1]
+            query = template
+            if len(query) > QUERY_WIDTH:
+                query = query[: QUERY_WIDTH - 3] + "..."
+            lines.append(
+                f"{len(times):8d} {sum(times) * 1000:10.1f} "
+                f"{p95 * 1000:8.2f} {self.rows.get(template, 0):9d}  {query}"
+            )
+            lines.extend(
+                f"{'':39}{step}" for step in self.plans.get(template, [])
+            )
+            scans += bool(self.get_full_scans(template))
+        if scans:
+            lines.append(f"{scans} query template(s) scan a whole table.")
+        logger.info("\n".join(lines))
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records its queries in the QueryStats of its connection"""
+
+    def execute(self, sql, *args):
+        stats = self.connection.query_stats
+        self._template = " ".join(sql.split())
+        start = time.perf_counter()
+        super().execute(sql, *args)
+        self._times = stats.times.setdefault(self._template, [])
+        self._times.append(time.perf_counter() - start)
+        stats.explain(self.connection, self._template, sql, args)
+        return self
+
+    def _fetched(self, start, count):
+        self._times[-1] += time.perf_counter() - start
+        rows = self.connection.query_stats.rows
+        rows[self._template] = rows.get(self._template, 0) + count
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = super().fetchmany(*args)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0)
+            raise
+        self._fetched(start, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection that records statistics of the queries that are run"""
+
+    query_stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+
+def open_connection(
+    database, query_stats: Optional[QueryStats] = None, **kwargs
+) -> sqlite3.Connection:
+    """Open a connection, instrumented if query statistics are given"""
+    if query_stats is None:
+        return sqlite3.connect(database, **kwargs)
+    conn = sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
+    conn.query_stats = query_stats
+    return conn
+
+
+def connect(
+    db_file, immutable=True, query_stats: Optional[QueryStats] = None
+) -> sqlite3.Connection:
+    """Open a tuned read-only connection to a database file
+
+    If query statistics are given, the queries that are run on the
+    connection are recorded in them."""
+    conn = open_connection(
+        get_uri(db_file, immutable=immutable),
+        query_stats=query_stats,
+        uri=True,
+    )
+    tune(conn)
+    return conn
+
+
+def has_index(conn: sqlite3.Connection, table: str, columns) -> bool:
+    """Check whether a table has an index that starts with the columns"""
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        info = conn.execute(f"PRAGMA index_info({index[1]})").fetchall()
+        indexed = tuple(name for _, _, name in sorted(info))
+        if indexed[: len(columns)] == tuple(columns):
+            return True
+    return False
+
+
+def add_indexes(conn: sqlite3.Connection) -> List[str]:
+    """Add the indexes that are missing from the tables of the database
+
+    Tables that don't exist in this version of the database are skipped.
+    Returns the names of the indexes that were added."""
+    tables = {
+        name
+        for (name,) in conn.execute(
+            "SELECT name FROM sqlite_schema WHERE type = 'table'"
+        )
+    }
+    added = []
+    for table, columns in INDEXES.items():
+        if table not in tables or has_index(conn, table, columns):
+            continue
+        name = f"signal2html_{table}_{'_'.join(columns)}"
+        conn.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+        added.append(name)
+    if added:
+        conn.execute("ANALYZE")
+    conn.commit()
+    return added
+
+
+class Database:
+    """The database of a backup
+
+    Without a working copy, the connection reads the database file directly.
+    Otherwise, the database is copied to memory or to a temporary file,
+    where the missing indexes are added. The path is the file that other
+    processes should open (with connect), it's None for a copy in memory.
+    The temporary file is removed when the database is closed, or at exit
+    if it isn't. If query statistics are given, the connection records its
+    queries in them."""
+
+    def __init__(
+        self,
+        db_file: Path,
+        working_copy: Optional[str] = None,
+        query_stats: Optional[QueryStats] = None,
+    ):
+        if working_copy is not None and working_copy not in WORKING_COPIES:
+            raise ValueError(f"Unknown working copy: {working_copy}")
+        self._cleanup = None
+        self.path = db_file
+        if working_copy is None:
+            self.connection = connect(db_file, query_stats=query_stats)
+            return
+
+        logger.info(f"Copying the database to {working_copy}.")
+        if working_copy == "temp":
+            tmpdir = tempfile.mkdtemp(prefix="signal2html-")
+            self._cleanup = weakref.finalize(
+                self, shutil.rmtree, tmpdir, ignore_errors=True
+            )
+            self.path = Path(tmpdir) / "database.sqlite"
+            target = sqlite3.connect(os.fspath(self.path))
+        else:
+            self.path = None
+            target = open_connection(":memory:", query_stats=query_stats)
+        source = connect(db_file)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+        added = add_indexes(target)
+        if added:
+            logger.info(f"Added indexes: {', '.join(added)}.")
+        if working_copy == "temp":
+            target.close()
+            self.connection = connect(self.path, query_stats=query_stats)
+        else:
+            tune(target)
+            self.connection = target
+
+    def close(self):
+        """Close the connection and remove the working copy"""
+        self.connection.close()
+        if self._cleanup is not None:
+            self._cleanup()
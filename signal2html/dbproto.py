@@ -5,6 +5,10 @@
 
 These classes are used to extract values in the database encoded as protobuf messages.
 
+The messages are decoded with ``decode_message``, which uses a small decoder
+for the few wire types that occur in these messages and falls back to
+pure_protobuf for anything it does not handle.
+
 Signal protobuf definitions are defined in these directories:
 
     https://github.com/signalapp/Signal-Android/tree/master/libsignal/service/src/main/proto
@@ -13,11 +17,19 @@ Signal protobuf definitions are defined in these directories:
 License: See LICENSE file.
 """
 
+import dataclasses
+import functools
+
 from dataclasses import dataclass
 from enum import IntEnum
 
+import typing
+
+from typing import Any
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 from pure_protobuf.dataclasses_ import field
 from pure_protobuf.dataclasses_ import message
@@ -25,6 +37,9 @@ from pure_protobuf.dataclasses_ import optional_field
 from pure_protobuf.types import uint32
 from pure_protobuf.types import uint64
 
+from .stats import DECODE
+from .stats import stage
+
 
 @message
 @dataclass
@@ -120,3 +135,147 @@ class StructuredGroupV2State:
 class StructuredGroupDataV2:
     change: StructuredGroupV2Change = optional_field(2)
     state: StructuredGroupV2State = optional_field(3)
+
+
+# Wire types of the protobuf encoding
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+# Maximum number of nested messages kept by the decoder, such as the members
+# in the group state that is repeated in every group update
+MESSAGE_CACHE_SIZE = 8192
+
+# Only nested messages up to this size in bytes are cached, which bounds the
+# memory of the cache. Larger ones, such as the group state itself, differ
+# in every message anyway.
+MESSAGE_CACHE_MAX_BYTES = 512
+
+# Field number -> (name, type, repeated, varint), per message class
+_schemas: Dict[type, Dict[int, Tuple[str, Any, bool, bool]]] = {}
+
+
+def _get_schema(cls) -> Dict[int, Tuple[str, Any, bool, bool]]:
+    """Get the fields of a message class from its dataclass definition"""
+    schema = _schemas.get(cls)
+    if schema is not None:
+        return schema
+    schema = {}
+    hints = typing.get_type_hints(cls)
+    for f in dataclasses.fields(cls):
+        kind, repeated = hints[f.name], False
+        origin = getattr(kind, "__origin__", None)
+        if origin is list:
+            (kind,) = kind.__args__
+            repeated = True
+        elif origin is typing.Union:
+            kind = next(a for a in kind.__args__ if a is not type(None))
+        kind = getattr(kind, "__supertype__", kind)  # uint32, uint64
+        varint = kind is int or issubclass(kind, IntEnum)
+        schema[f.metadata["number"]] = (f.name, kind, repeated, varint)
+    _schemas[cls] = schema
+    return schema
+
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Read a varint at pos and return it with the position after it"""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _decode(cls, data: bytes):
+    """Decode a message of the given class
+
+    Raises ValueError, IndexError or TypeError on anything unexpected, such
+    as truncated data, unsupported wire types, or missing required fields.
+    """
+    schema = _get_schema(cls)
+    values = {f[0]: [] for f in schema.values() if f[2]}
+    pos, end = 0, len(data)
+    while pos < end:
+        # Keys, lengths and small numbers are mostly a single byte
+        key = data[pos]
+        if key < 0x80:
+            pos += 1
+        else:
+            key, pos = _read_varint(data, pos)
+        wire_type = key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == WIRE_LENGTH:
+            size = data[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size, pos = _read_varint(data, pos)
+            value = data[pos : pos + size]
+            pos += size
+        elif wire_type == WIRE_FIXED64:
+            value, pos = None, pos + 8
+        elif wire_type == WIRE_FIXED32:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"Unsupported wire type: {wire_type}")
+        if pos > end:
+            raise ValueError("Truncated message")
+
+        field = schema.get(key >> 3)
+        if field is None:
+            continue
+        name, kind, repeated, varint = field
+        if wire_type != (WIRE_VARINT if varint else WIRE_LENGTH):
+            raise ValueError(f"Unexpected wire type for {name}: {wire_type}")
+
+        if kind is str:
+            value = value.decode("utf-8")
+        elif varint:
+            if kind is not int:
+                value = kind(value)
+        elif kind is not bytes:
+            if len(value) <= MESSAGE_CACHE_MAX_BYTES:
+                value = _decode_nested(kind, value)
+            else:
+                value = _decode(kind, value)
+        if repeated:
+            values[name].append(value)
+        else:
+            values[name] = value
+    return cls(**values)
+
+
+@functools.lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+def _decode_nested(cls, data: bytes):
+    """Decode a small nested message, reusing the result for identical
+    bytes"""
+    return _decode(cls, data)
+
+
+def get_message_cache_info():
+    """Get the hits and misses of the cache of nested messages"""
+    return _decode_nested.cache_info()
+
+
+def clear_message_cache():
+    """Empty the cache of nested messages and reset its counters"""
+    _decode_nested.cache_clear()
+
+
+def decode_message(cls, data: bytes):
+    """Decode a protobuf message from the database into the given class
+
+    Falls back to pure_protobuf when the fast decoder fails, so that the
+    result and the errors raised are the same as those of ``cls.loads``.
+    Nested messages may be shared between results and must not be modified.
+    """
+    with stage(DECODE):
+        try:
+            return _decode(cls, data)
+        except (ValueError, IndexError, TypeError):
+            return cls.loads(data)
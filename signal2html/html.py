@@ -7,20 +7,42 @@ License: See LICENSE file.
 """
 
 import datetime as dt
+import functools
+import heapq
+import itertools
 import logging
+import os
+import re
 
+from operator import attrgetter
 from types import SimpleNamespace as ns
 
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
 from emoji import emoji_list
 from jinja2 import Environment
+from jinja2 import FileSystemBytecodeCache
 from jinja2 import PackageLoader
 from jinja2 import select_autoescape
 
 from .html_colors import get_color
 from .html_colors import list_colors
 from .linkify import linkify
+from .models import MessageRecord
 from .models import MMSMessageRecord
 from .models import Thread
+from .stats import FORMAT
+from .stats import LINKIFY
+from .stats import RENDER
+from .stats import WRITE
+from .stats import add_output_file
+from .stats import counted
+from .stats import stage
+from .stats import timed
 from .types import DisplayType
 from .types import get_named_message_type
 from .types import is_group_call
@@ -36,17 +58,117 @@ from .types import is_secure
 logger = logging.getLogger(__name__)
 
 
+# Size of the chunks in which a page is rendered and written (in template
+# output items and in characters, respectively)
+STREAM_BUFFER_SIZE = 64
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Characters that need handling in message bodies, other than emoji
+_SPECIAL_CHARS = re.compile("[&<>\ufffc]")
+
+_HTML_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+# Runs of characters that may contain emoji. Emoji consist of non-ASCII
+# characters, except for keycap sequences which start with one of [#*0-9].
+_EMOJI_CANDIDATES = re.compile(r"[#*0-9]*[^\x00-\x7f][#*0-9\x80-\U0010ffff]*")
+
+# Characters ignored when checking whether a message contains only emoji
+_NON_EMOJI_IGNORED = " \ufe0f"
+
+
 def is_all_emoji(body):
     """Check if a message is non-empty and only contains emoji"""
     body = body.replace(" ", "").replace("\ufe0f", "")
     return len(emoji_list(body)) == len(body) and len(body) > 0
 
 
+def _find_emoji(body: str) -> List[Tuple[int, str]]:
+    """Find the start position of all emoji in the body
+
+    This gives the same result as emoji_list, but only runs it on the parts
+    of the body that may contain emoji, as it is slow on long texts."""
+    emojis = []
+    for candidate in _EMOJI_CANDIDATES.finditer(body):
+        offset = candidate.start()
+        for e in emoji_list(candidate.group()):
+            emojis.append((e["match_start"] + offset, e["emoji"]))
+    return emojis
+
+
+def _format_message(body: str, mentions) -> Tuple[str, bool]:
+    """Format a message body in a single pass over the text.
+
+    Returns the formatted message and whether the message only contains
+    emoji (see is_all_emoji). The body is split into runs of plain text,
+    which are copied as-is, and the emoji, mentions, and HTML special
+    characters between them."""
+    emojis = _find_emoji(body)
+    n_emoji = len(emojis)
+    length = len(body)
+
+    parts = []
+    only_emoji = True
+    pos = 0
+    k = 0
+    while pos < length:
+        # Emoji starting before pos were skipped as part of a mention
+        while k < n_emoji and emojis[k][0] < pos:
+            k += 1
+        next_emoji = emojis[k][0] if k < n_emoji else length
+
+        match = _SPECIAL_CHARS.search(body, pos, next_emoji)
+        stop = next_emoji if match is None else match.start()
+        if stop > pos:
+            text = body[pos:stop]
+            parts.append(text)
+            only_emoji = only_emoji and not text.strip(_NON_EMOJI_IGNORED)
+            pos = stop
+
+        if match is not None:
+            only_emoji = False
+            c = match.group()
+            if c == "\ufffc":  # Object replacement character
+                mention = mentions.get(pos)
+                if mention:
+                    parts.append(
+                        "<span class='msg-mention'>@%s</span>"
+                        % format_message(mention.name)
+                    )
+                    # Not clear in what case the length is not 1
+                    pos += max(mention.length, 1)
+                else:
+                    parts.append(c)
+                    pos += 1
+            else:
+                parts.append(_HTML_ESCAPES[c])
+                pos += 1
+        elif k < n_emoji:
+            emoji = emojis[k][1]
+            parts.append("<span class='msg-emoji'>%s</span>" % emoji)
+            pos += len(emoji)
+            k += 1
+
+    all_emoji = only_emoji and bool(body.strip(_NON_EMOJI_IGNORED))
+    if all_emoji:
+        # If there are no characters to ignore, the emoji found above are the
+        # ones is_all_emoji would find. Otherwise, removing the ignored
+        # characters may join emoji, so we check again on the short message.
+        if any(c in body for c in _NON_EMOJI_IGNORED):
+            all_emoji = is_all_emoji(body)
+        else:
+            all_emoji = all(len(e) == 1 for _, e in emojis)
+
+    with stage(LINKIFY):
+        return linkify("".join(parts)), all_emoji
+
+
 def format_message(body, mentions=None):
     """Format message by processing all characters.
 
     - Wrap emoji in <span> for styling them
     - Escape special HTML chars
+    - Replace mentions by the name of the recipient
+    - Turn URLs into links
     """
     if body is None:
         return None
@@ -54,39 +176,7 @@ def format_message(body, mentions=None):
     if mentions is None:
         mentions = {}
 
-    emoji_pos = emoji_list(body)
-    new_body = ""
-    emoji_lookup = {p["match_start"]: p["emoji"] for p in emoji_pos}
-    skip = 0
-    for i, c in enumerate(body):
-        if skip > 0:
-            # Skip additional characters from multi-character emoji
-            skip = skip - 1
-        elif i in emoji_lookup:
-            new_body += "<span class='msg-emoji'>%s</span>" % emoji_lookup[i]
-            skip = len(emoji_lookup[i]) - 1
-        elif c == "&":
-            new_body += "&amp;"
-        elif c == "<":
-            new_body += "&lt;"
-        elif c == ">":
-            new_body += "&gt;"
-        elif c == "\ufffc":  # Object replacement character
-            mention = mentions.get(i)
-            if mention:
-                new_body += (
-                    "<span class='msg-mention'>@%s</span>"
-                    % format_message(mention.name)
-                )
-                skip = (
-                    mention.length - 1
-                )  # Not clear in what case this is not 1
-            else:
-                new_body += c
-        else:
-            new_body += c
-
-    new_body = linkify(new_body)
+    new_body, _ = _format_message(body, mentions)
     return new_body
 
 
@@ -145,77 +235,31 @@ def format_event_data_group_update(data):
     return event_data
 
 
-def dump_thread(thread: Thread, output_dir: str):
-    """Write a Thread instance to a HTML page in the output directory"""
+def _get_date_sent(msg) -> dt.datetime:
+    """Get the local time at which a message was sent"""
+    date_sent = dt.datetime.fromtimestamp(msg.dateSent // 1000)
+    return date_sent.replace(microsecond=(msg.dateSent % 1000) * 1000)
 
-    # Combine and sort the messages
-    messages = thread.mms + thread.sms
-    messages.sort(key=lambda mr: mr.dateSent)
 
-    # Find the template
-    env = Environment(
-        loader=PackageLoader("signal2html", "templates"),
-        autoescape=select_autoescape(["html", "xml"]),
-    )
-    template = env.get_template("thread.html")
-
-    # Create the message color CSS (depends on individuals)
-    group_color_css = ""
-    msg_css = ".msg-sender-%i { /* recipient id: %5s */ background: %s;}\n"
-    if thread.is_group:
-        group_recipients = set(m.addressRecipient for m in messages)
-        sender_idx = {r: k for k, r in enumerate(group_recipients)}
-        colors_used = []
-        group_colors = set(ar.color for ar in sender_idx)
-        for ar, idx in sender_idx.items():
-            if ar.isgroup:
-                continue
-
-            # ensure colors are unique, even if they're not in Signal
-            ar_color = ar.color
-            if ar_color in colors_used:
-                color = next(
-                    (c for c in list_colors() if not c in group_colors),
-                    None,
-                )
-                ar_color = ar.color if color is None else color
-            group_color_css += msg_css % (
-                idx,
-                ar.rid,
-                get_color(ar_color),
-            )
-            colors_used.append(ar.color)
-    else:
-        # Retrieve sender info from an incoming message, if any
-        firstInbox = next(
-            (m for m in messages if is_inbox_type(m._type)), None
-        )
-        if firstInbox:
-            clr = firstInbox.addressRecipient.color
-            clr = "teal" if clr is None else clr
-            group_color_css += msg_css % (
-                0,
-                firstInbox.addressRecipient.rid,
-                get_color(clr),
-            )
-
-    # Create a simplified dict for each message
+def _simple_messages(
+    thread: Thread, messages, sender_idx
+) -> Iterator[Dict[str, Any]]:
+    """Generate a simplified dict for each message of a thread, preceded by
+    a "date change" message whenever the date changes"""
     prev_date = None
-    simple_messages = []
     for msg in messages:
         if is_joined_type(msg._type):
             continue
 
         # Add a "date change" message when to mark the date
-        date_sent = dt.datetime.fromtimestamp(msg.dateSent // 1000)
-        date_sent = date_sent.replace(microsecond=(msg.dateSent % 1000) * 1000)
+        date_sent = _get_date_sent(msg)
         if prev_date is None or date_sent.date() != prev_date:
             prev_date = date_sent.date()
             out = {
                 "date_msg": True,
                 "body": date_sent.strftime("%a, %b %d, %Y"),
             }
-            simple_messages.append(out)
+            yield out
 
         # Handle event messages (calls, group changes)
         is_event = False
@@ -258,16 +302,17 @@ def dump_thread(thread: Thread, output_dir: str):
                 "attachments": [],
             }
 
-        # Clean up message body
+        # Clean up message body. Skip HTML/mentions clean-up if this is an
+        # event (formatting included in event)
         body = "" if msg.body is None else msg.body
-        if isinstance(msg, MMSMessageRecord):
-            all_emoji = not msg.quote and is_all_emoji(body)
-        else:
+        if is_event:
             all_emoji = is_all_emoji(body)
-
-        # Skip HTML/mentions clean-up if this is an event (formatting included in event)
-        if not is_event:
-            body = format_message(body, thread.mentions.get(msg._id))
+        else:
+            body, all_emoji = _format_message(
+                body, thread.mentions.get(msg._id) or {}
+            )
+        if isinstance(msg, MMSMessageRecord) and msg.quote:
+            all_emoji = False
 
         send_state = str(
             DisplayType.from_state(
@@ -321,10 +366,170 @@ def dump_thread(thread: Thread, output_dir: str):
                     }
                 )
 
-        simple_messages.append(out)
+        yield out
+
+
+def _recipient_order(recipient) -> Tuple[int, str]:
+    """Sort key of recipients by ID, numerically for numeric IDs"""
+    rid = str(recipient.rid)
+    return len(rid), rid
 
-    if not simple_messages:
-        return
+
+def _get_sender_colors(thread: Thread, messages) -> Tuple[str, dict]:
+    """Create the message color CSS (depends on individuals) and the index
+    of each sender in a group thread"""
+    group_color_css = ""
+    msg_css = ".msg-sender-%i { /* recipient id: %5s */ background: %s;}\n"
+    sender_idx = {}
+    if thread.is_group:
+        # Sort the senders by ID rather than by hash, as IDs of recipients
+        # that are created on the spot are strings, whose hash differs
+        # between processes
+        group_recipients = sorted(
+            set(m.addressRecipient for m in messages), key=_recipient_order
+        )
+        sender_idx = {r: k for k, r in enumerate(group_recipients)}
+        colors_used = []
+        group_colors = set(ar.color for ar in sender_idx)
+        for ar, idx in sender_idx.items():
+            if ar.isgroup:
+                continue
+
+            # ensure colors are unique, even if they're not in Signal
+            ar_color = ar.color
+            if ar_color in colors_used:
+                color = next(
+                    (c for c in list_colors() if not c in group_colors),
+                    None,
+                )
+                ar_color = ar.color if color is None else color
+            group_color_css += msg_css % (
+                idx,
+                ar.rid,
+                get_color(ar_color),
+            )
+            colors_used.append(ar.color)
+    else:
+        # Retrieve sender info from an incoming message, if any
+        firstInbox = next(
+            (m for m in messages if is_inbox_type(m._type)), None
+        )
+        if firstInbox:
+            clr = firstInbox.addressRecipient.color
+            clr = "teal" if clr is None else clr
+            group_color_css += msg_css % (
+                0,
+                firstInbox.addressRecipient.rid,
+                get_color(clr),
+            )
+    return group_color_css, sender_idx
+
+
+def merge_messages(mms, sms) -> Iterator[MessageRecord]:
+    """Merge the MMS and SMS messages of a thread by the date they were
+    sent, lazily. Both must be sorted by date, MMS messages come first on
+    the same date."""
+    return heapq.merge(mms, sms, key=attrgetter("dateSent"))
+
+
+def get_pages(messages, paginate) -> List[Dict[str, Any]]:
+    """Get the pages of the sorted messages of a thread, in one pass
+
+    With paginate="month" there is a page for every month with messages,
+    with a number it is the maximum number of messages per page. Returns a
+    list with the title, the number of messages, and the first and last
+    date of every page."""
+    if paginate == "month":
+        key = lambda m: _get_date_sent(m).strftime("%B %Y")
+    else:
+        size = int(paginate)
+        if size < 1:
+            raise ValueError(f"Invalid page size: {paginate}")
+        counter = itertools.count()
+        key = lambda m: f"Page {next(counter) // size + 1}"
+    pages = []
+    for title, page_messages in itertools.groupby(messages, key):
+        first = last = next(page_messages)
+        count = 1
+        for last in page_messages:
+            count += 1
+        pages.append(
+            {
+                "title": title,
+                "count": count,
+                "first": _get_date_sent(first),
+                "last": _get_date_sent(last),
+            }
+        )
+    return pages
+
+
+def get_page_filename(output_file, number) -> str:
+    """Get the filename of a page of a paginated thread"""
+    stem = os.path.splitext(os.path.basename(output_file))[0]
+    return f"{stem}_page{number}.html"
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment(bytecode_cache_dir=None) -> Environment:
+    """Get the Jinja environment to render the pages
+
+    The environment is created once per process, so that the templates are
+    loaded and compiled only once. The compiled templates can also be kept
+    in a bytecode cache directory for later runs. The templates are not
+    expected to change while running, so they aren't checked for updates."""
+    bytecode_cache = None
+    if bytecode_cache_dir is not None:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+    return Environment(
+        loader=PackageLoader("signal2html", "templates"),
+        autoescape=select_autoescape(["html", "xml"]),
+        auto_reload=False,
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def dump_thread(
+    thread: Thread,
+    output_dir: str,
+    output_file=None,
+    paginate=None,
+    template_cache=None,
+    messages=None,
+    headers=None,
+):
+    """Write a Thread instance to a HTML page in the output directory
+
+    If no output file is given, the path is chosen with Thread.get_path.
+
+    With pagination (see get_pages), the messages are written to separate
+    pages next to the output file, and the output file becomes an index of
+    the pages. Every page starts with a date and uses the sender colors of
+    the whole thread.
+
+    The template cache is an optional directory for compiled templates, see
+    get_environment.
+
+    The messages are those of the thread, unless an iterator of messages in
+    order of sending is given. It must come with a function that returns a
+    new iterator of the headers of the same messages (see MessageHeader),
+    for the passes that are made before the messages are written. The
+    messages are then consumed once, while they are written."""
+    if messages is None:
+
+        def headers():
+            return merge_messages(thread.mms, thread.sms)
+
+        messages = headers()
+    messages = counted(m for m in messages if not is_joined_type(m._type))
+
+    # Find the template
+    env = get_environment(template_cache)
+    template = env.get_template("thread.html")
+
+    with stage(FORMAT):
+        group_color_css, sender_idx = _get_sender_colors(thread, headers())
 
     if thread.is_group:
         count = len(thread.members)
@@ -332,13 +537,108 @@ def dump_thread(thread: Thread, output_dir: str):
     else:
         subtitle = thread.sanephone
 
-    html = template.render(
+    context = dict(
         thread_name=thread.name,
         thread_subtitle=subtitle,
-        messages=simple_messages,
         group_color_css=group_color_css,
         date_time_format="%b %d, %H:%M",
     )
-    output_file = thread.get_path(output_dir)
-    with open(output_file, "w", encoding="utf-8") as fp:
-        fp.write(html)
+
+    if paginate:
+        with stage(FORMAT):
+            pages = get_pages(
+                (h for h in headers() if not is_joined_type(h._type)),
+                paginate,
+            )
+        if not pages:
+            return
+        if output_file is None:
+            output_file = thread.get_path(output_dir)
+        else:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        _dump_pages(
+            env,
+            template,
+            thread,
+            messages,
+            pages,
+            sender_idx,
+            output_file,
+            context,
+        )
+        return
+
+    # Peek at the first message, no page is written for a thread without
+    # messages
+    simple_messages = timed(
+        _simple_messages(thread, messages, sender_idx), FORMAT
+    )
+    first = next(simple_messages, None)
+    if first is None:
+        return
+
+    stream = template.stream(
+        messages=itertools.chain([first], simple_messages), **context
+    )
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    if output_file is None:
+        output_file = thread.get_path(output_dir)
+    else:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    write_stream(stream, output_file)
+
+
+def _dump_pages(
+    env, template, thread, messages, pages, sender_idx, output_file, context
+):
+    """Write the pages of a paginated thread and the index page
+
+    The messages are consumed page by page, using the number of messages on
+    each page from get_pages."""
+    thread_dir = os.path.dirname(output_file)
+    index = os.path.basename(output_file)
+    for k, page in enumerate(pages, start=1):
+        page["filename"] = get_page_filename(output_file, k)
+
+    for k, page in enumerate(pages):
+        pagination = {
+            "title": page["title"],
+            "number": k + 1,
+            "count": len(pages),
+            "index": index,
+            "prev": pages[k - 1]["filename"] if k > 0 else None,
+            "next": pages[k + 1]["filename"] if k + 1 < len(pages) else None,
+        }
+        page_messages = itertools.islice(messages, page["count"])
+        stream = template.stream(
+            messages=timed(
+                _simple_messages(thread, page_messages, sender_idx), FORMAT
+            ),
+            pagination=pagination,
+            **context,
+        )
+        stream.enable_buffering(STREAM_BUFFER_SIZE)
+        write_stream(stream, os.path.join(thread_dir, page["filename"]))
+
+    stream = env.get_template("thread_index.html").stream(
+        pages=pages, **context
+    )
+    write_stream(stream, output_file)
+
+
+def write_stream(stream, output_file):
+    """Write a template stream to a file, without leaving a partial file
+    behind if rendering fails"""
+    try:
+        write = stage(WRITE)
+        with write, open(
+            output_file, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE
+        ) as fp, stage(RENDER):
+            for chunk in stream:
+                with write:
+                    fp.write(chunk)
+    except BaseException:
+        if os.path.exists(output_file):
+            os.unlink(output_file)
+        raise
+    add_output_file(output_file)
@@ -8,39 +8,63 @@ License: See LICENSE file
 
 import logging
 
+from typing import Iterable
+from typing import List
+
 from linkify_it import LinkifyIt
 from linkify_it.tlds import TLDS
 
 logger = logging.getLogger(__name__)
 
+# Compiling the linkifier with the full list of TLDs is expensive, so it is
+# done once when the module is loaded.
+LINKIFIER = LinkifyIt().tlds(TLDS)
+
+# Every link that can be matched contains at least one of these characters (a
+# dot in a domain name, a colon after a schema, the @ of an email address, or
+# the slashes of a protocol-relative link such as //localhost/path)
+_LINK_CHARS = (".", ":", "@", "/")
+
+
+def _may_contain_link(message: str) -> bool:
+    """Cheap test to skip messages that cannot contain a link"""
+    return any(c in message for c in _LINK_CHARS)
+
 
 def linkify(message: str) -> str:
     """Replace text URLs in message with HTML links"""
-    linkifier = LinkifyIt().tlds(TLDS)
+    if not _may_contain_link(message):
+        return message
 
     # Pre-test first for efficiency
-    if not linkifier.pretest(message):
+    if not LINKIFIER.pretest(message):
         return message
 
     # Test if a link is present
-    if not linkifier.test(message):
+    if not LINKIFIER.test(message):
         return message
 
     # Find links in message
-    matches = linkifier.match(message)
+    matches = LINKIFIER.match(message)
     if not matches:
         return message
 
     logger.debug(f"Replacing urls in message:\n{message}")
 
     # Construct new message
-    new_message = ""
+    parts = []
     idx = 0
     for match in matches:
-        new_message += message[idx : match.index]
-        new_message += f'<a href="{match.url}" target="_blank">{match.raw}</a>'
+        parts.append(message[idx : match.index])
+        parts.append(f'<a href="{match.url}" target="_blank">{match.raw}</a>')
         idx = match.last_index
-    new_message += message[idx:]
+    parts.append(message[idx:])
+    new_message = "".join(parts)
 
     logger.debug(f"Replaced urls in message:\n{new_message}")
     return new_message
+
+
+def linkify_many(messages: Iterable[str]) -> List[str]:
+    """Replace text URLs with HTML links in a number of messages"""
+    return [linkify(message) for message in messages]
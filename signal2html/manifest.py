@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""Manifest of an export, for incremental re-exports
+
+The manifest records a fingerprint and the output file of every exported
+thread. A thread whose fingerprint hasn't changed since the previous export
+(and whose page still exists) doesn't need to be exported again.
+
+License: See LICENSE file.
+
+"""
+
+import json
+import logging
+import os
+
+from typing import Dict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Version of the manifest format, a manifest with another version is ignored
+MANIFEST_VERSION = 1
+
+# Fingerprint of a thread without messages
+EMPTY_FINGERPRINT = [0, None, None, 0, None, None, 0]
+
+
+def get_thread_fingerprints(db) -> Dict[int, list]:
+    """Get the fingerprints of all threads with aggregate queries
+
+    The fingerprint of a thread consists of the number of messages and the
+    highest _id and date in the sms and mms tables, and the number of
+    attachments. Any message that is added or removed changes it."""
+    fingerprints = {}
+    for offset, table in ((0, "sms"), (3, "mms")):
+        qry = db.execute(
+            f"SELECT thread_id, COUNT(*), MAX(_id), MAX(date) FROM {table} "
+            "GROUP BY thread_id"
+        )
+        for thread_id, *aggregates in qry:
+            fp = fingerprints.setdefault(thread_id, list(EMPTY_FINGERPRINT))
+            fp[offset : offset + 3] = aggregates
+    qry = db.execute(
+        "SELECT m.thread_id, COUNT(*) FROM part p "
+        "JOIN mms m ON p.mid = m._id GROUP BY m.thread_id"
+    )
+    for thread_id, count in qry:
+        fp = fingerprints.setdefault(thread_id, list(EMPTY_FINGERPRINT))
+        fp[6] = count
+    return fingerprints
+
+
+class Manifest:
+    """Manifest of the threads in an output directory
+
+    The key identifies everything besides the messages that affects the
+    output, such as the version of signal2html, the addressbook, and the
+    export options. If the key of the stored manifest differs, all threads
+    are considered changed."""
+
+    def __init__(self, output_dir, key: dict, fingerprints: Dict[int, list]):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, ".signal2html", "manifest.json")
+        self.key = dict(key, version=MANIFEST_VERSION)
+        self.fingerprints = fingerprints
+        self.previous = self._load()
+        self.threads = {}
+
+    def _load(self) -> Dict[str, dict]:
+        """Load the threads of the stored manifest, if it matches our key"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as fp:
+                manifest = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring invalid manifest '{self.path}': {e}")
+            return {}
+        if not isinstance(manifest, dict) or manifest.get("key") != self.key:
+            logger.info("Manifest is outdated, exporting all threads.")
+            return {}
+        return manifest.get("threads", {})
+
+    def _fingerprint(self, thread_id) -> list:
+        return self.fingerprints.get(thread_id, EMPTY_FINGERPRINT)
+
+    def output_file(self, thread_id) -> Optional[str]:
+        """Get the output file of a thread in the previous export"""
+        entry = self.previous.get(str(thread_id))
+        if entry is None or entry["output_file"] is None:
+            return None
+        return os.path.join(self.output_dir, entry["output_file"])
+
+    def is_unchanged(self, thread_id) -> bool:
+        """Check whether a thread is unchanged since the previous export and
+        keep its entry if so"""
+        entry = self.previous.get(str(thread_id))
+        if entry is None or entry["fingerprint"] != self._fingerprint(
+            thread_id
+        ):
+            return False
+        output_file = self.output_file(thread_id)
+        if output_file is not None and not os.path.exists(output_file):
+            return False
+        self.threads[str(thread_id)] = entry
+        return True
+
+    def record(self, thread_id, output_file: Optional[str]):
+        """Record the output file of an exported thread, or None if the
+        thread has no page"""
+        if output_file is not None:
+            output_file = os.path.relpath(output_file, self.output_dir)
+        self.threads[str(thread_id)] = {
+            "fingerprint": self._fingerprint(thread_id),
+            "output_file": output_file,
+        }
+
+    def save(self):
+        """Write the manifest to the output directory"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump(
+                {"key": self.key, "threads": self.threads},
+                fp,
+                separators=(",", ":"),
+            )
+        os.replace(tmp, self.path)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""Memory profile of an export
+
+When enabled, the memory allocated by Python is traced with tracemalloc
+while every thread is exported. Tracing starts anew for each thread, so
+what it measures belongs to that thread. Snapshots are taken around
+populating the thread (or setting up the stream of its messages) and around
+writing it, which gives the peak and retained memory of both stages, and
+the places where the retained memory was allocated. The peak RSS of the
+process is recorded after every thread.
+
+Tracing makes the export considerably slower, it's meant for finding out
+how much memory large threads need.
+
+License: See LICENSE file.
+
+"""
+
+import contextlib
+import logging
+import sys
+import tracemalloc
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# Stages of the export of a thread that are profiled
+POPULATE = "populate"
+DUMP = "dump"
+
+# Number of allocation sites that are kept for every stage of a thread
+TOP_SITES = 5
+
+# Memory profile of the current process, if enabled
+_profile = None
+
+
+def get_peak_rss() -> Optional[int]:
+    """Get the peak resident set size of the process in bytes, if known"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def get_top_sites(snapshot, previous=None, limit=TOP_SITES) -> List[list]:
+    """Get the lines that allocated the most memory in a snapshot, or since
+    the previous snapshot, as [site, bytes, count]"""
+    snapshot = snapshot.filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    if previous is None:
+        stats = snapshot.statistics("lineno")
+        sizes = ((s.traceback, s.size, s.count) for s in stats)
+    else:
+        stats = snapshot.compare_to(previous, "lineno")
+        sizes = ((s.traceback, s.size_diff, s.count_diff) for s in stats)
+    top = []
+    for traceback, size, count in sizes:
+        if size <= 0 or len(top) == limit:
+            break
+        frame = traceback[0]
+        top.append([f"{frame.filename}:{frame.lineno}", size, count])
+    return top
+
+
+class MemoryProfile:
+    """Memory used per thread and per stage of the export
+
+    For every exported thread, a record is kept with the peak memory traced
+    in each stage, the memory retained at the end of it, the top allocation
+    sites of the retained memory, and the peak RSS of the process after the
+    thread."""
+
+    def __init__(self):
+        self.threads: List[Dict[str, Any]] = []
+        self._thread: Optional[Dict[str, Any]] = None
+        self._snapshot = None
+
+    def start_thread(self, thread_id: int, name: str):
+        """Start tracing the memory of a thread"""
+        tracemalloc.stop()
+        tracemalloc.start()
+        self._snapshot = None
+        self._thread = {"id": thread_id, "name": name, "stages": {}}
+
+    def end_stage(self, stage: str):
+        """Record the memory of a stage of the current thread"""
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        self._thread["stages"][stage] = {
+            "peak": peak,
+            "retained": current,
+            "top": get_top_sites(snapshot, self._snapshot),
+        }
+        self._snapshot = snapshot
+        # Before Python 3.9, the peak of a later stage includes this one
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+
+    def end_thread(self):
+        """Stop tracing the memory of the current thread"""
+        record = self._thread
+        self._thread = self._snapshot = None
+        tracemalloc.stop()
+        record["peak"] = max(
+            (s["peak"] for s in record["stages"].values()), default=0
+        )
+        record["rss"] = get_peak_rss()
+        self.threads.append(record)
+
+    def drain(self) -> "MemoryProfile":
+        """Return the records collected so far and start anew"""
+        profile = MemoryProfile()
+        profile.threads, self.threads = self.threads, []
+        return profile
+
+    def update(self, other: "MemoryProfile"):
+        """Add the records of another profile to this one"""
+        self.threads.extend(other.threads)
+
+    def log(self, limit: int):
+        """Log the peak RSS and the limit threads with the highest peak"""
+        rss = [t["rss"] for t in self.threads if t["rss"] is not None]
+        own = get_peak_rss()
+        lines = ["Memory profile:"]
+        if own is not None:
+            lines.append(f"Peak RSS of the main process: {own / 2**20:.1f} MB")
+        if rss:
+            lines.append(
+                f"Peak RSS while exporting: {max(rss) / 2**20:.1f} MB"
+            )
+        threads = sorted(self.threads, key=lambda t: -t["peak"])[:limit]
+        lines.append(f"{len(threads)} thread(s) with the highest peak:")
+        for t in threads:
+            line = f"  Thread {t['id']} ({t['name']}): "
+            line += f"peak {t['peak'] / 2**20:.1f} MB"
+            if t["rss"] is not None:
+                line += f", RSS after {t['rss'] / 2**20:.1f} MB"
+            lines.append(line)
+            for stage, s in t["stages"].items():
+                lines.append(
+                    f"    {stage}: peak {s['peak'] / 2**20:.1f} MB, "
+                    f"retained {s['retained'] / 2**20:.1f} MB"
+                )
+                lines.extend(
+                    f"      {size / 2**10:10.1f} KiB {count:8d}  {site}"
+                    for site, size, count in s["top"]
+                )
+        logger.info("\n".join(lines))
+
+
+def enable_memory_profile() -> MemoryProfile:
+    """Start profiling the memory of the threads in this process"""
+    global _profile
+    _profile = MemoryProfile()
+    return _profile
+
+
+def disable_memory_profile():
+    """Stop profiling the memory in this process"""
+    global _profile
+    _profile = None
+
+
+def get_memory_profile() -> Optional[MemoryProfile]:
+    """Get the memory profile of this process, if enabled"""
+    return _profile
+
+
+@contextlib.contextmanager
+def thread_memory(thread_id: int, name: str):
+    """Profile the memory of exporting a thread, if enabled"""
+    if _profile is None:
+        yield
+        return
+    _profile.start_thread(thread_id, name)
+    try:
+        yield
+    finally:
+        _profile.end_thread()
+
+
+@contextlib.contextmanager
+def memory_stage(stage: str):
+    """Record the memory of a stage of a thread, if enabled"""
+    yield
+    if _profile is not None:
+        _profile.end_stage(stage)
@@ -6,6 +6,9 @@ Models for storing Signal backup objects.
 These are heavily inspired by the database models of the Signal Android app, 
 but only the necessary fields are kept.
 
+The models of which there is one or more per message use __slots__ instead
+of a __dict__ per instance, to keep large threads small in memory.
+
 License: See LICENSE file.
 
 """
@@ -15,6 +18,7 @@ import os
 from abc import ABCMeta
 from dataclasses import dataclass
 from dataclasses import field
+from dataclasses import fields
 from datetime import datetime
 from re import sub
 from unicodedata import normalize
@@ -23,7 +27,38 @@ from typing import Dict
 from typing import List
 
 
-@dataclass
+def slotted(cls):
+    """Recreate a dataclass with __slots__ for its fields
+
+    This is what dataclass(slots=True) does on Python 3.10 and later. The
+    base classes must be slotted as well."""
+    names = tuple(f.name for f in fields(cls))
+    inherited = set()
+    for base in cls.__mro__[1:]:
+        inherited.update(getattr(base, "__slots__", ()))
+
+    namespace = dict(cls.__dict__)
+    namespace["__slots__"] = tuple(n for n in names if n not in inherited)
+    for name in names:
+        namespace.pop(name, None)  # defaults, these are kept by __init__
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+
+    # Frozen instances can't be restored by setattr when unpickling
+    def __getstate__(self):
+        return [getattr(self, name) for name in names]
+
+    def __setstate__(self, state):
+        for name, value in zip(names, state):
+            object.__setattr__(self, name, value)
+
+    namespace["__getstate__"] = __getstate__
+    namespace["__setstate__"] = __setstate__
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+@slotted
+@dataclass(frozen=True)
 class Recipient:
     rid: int
     name: str
@@ -36,6 +71,7 @@ class Recipient:
         return hash(self.rid)
 
 
+@slotted
 @dataclass
 class Mention:
     mention_id: int
@@ -43,6 +79,7 @@ class Mention:
     length: int
 
 
+@slotted
 @dataclass
 class Quote:
     _id: int
@@ -51,6 +88,7 @@ class Quote:
     mentions: Dict[int, Mention] = field(default_factory=lambda: {})
 
 
+@slotted
 @dataclass
 class Attachment:
     contentType: str
@@ -60,6 +98,7 @@ class Attachment:
     height: int
     quote: bool
     unique_id: str
+    thumbnail: str = None
 
 
 @dataclass
@@ -85,17 +124,17 @@ class GroupUpdateData:
     deleted_members: List[MemberInfo] = field(default_factory=list)
 
 
+@slotted
 @dataclass
 class DisplayRecord(metaclass=ABCMeta):
     addressRecipient: Recipient  # Recipient corresponding to address field
-    recipient: Recipient
     dateSent: int
     dateReceived: int
-    threadId: int
     body: str
     _type: int
 
 
+@slotted
 @dataclass
 class MessageRecord(DisplayRecord):
     _id: int
@@ -104,6 +143,17 @@ class MessageRecord(DisplayRecord):
     read_receipt_count: int
 
 
+@slotted
+@dataclass
+class MessageHeader:
+    """The sender, date and type of a message, without its content"""
+
+    addressRecipient: Recipient
+    dateSent: int
+    _type: int
+
+
+@slotted
 @dataclass
 class Reaction:
     recipient: Recipient
@@ -112,6 +162,7 @@ class Reaction:
     time_received: datetime
 
 
+@slotted
 @dataclass
 class MMSMessageRecord(MessageRecord):
     quote: Quote
@@ -120,6 +171,7 @@ class MMSMessageRecord(MessageRecord):
     viewed_receipt_count: int
 
 
+@slotted
 @dataclass
 class SMSMessageRecord(MessageRecord):
     pass
@@ -173,16 +225,25 @@ class Thread:
     def get_thread_dir(self, output_dir: str, make_dir=True) -> str:
         return os.path.dirname(self.get_path(output_dir, make_dir=make_dir))
 
-    def get_path(self, output_dir: str, make_dir=True) -> str:
+    def get_path(
+        self, output_dir: str, make_dir=True, reserved=None, overwrite=False
+    ) -> str:
         """Return a path for a thread and try to be clever about merging
-        contacts. Optionally create the contact directory."""
+        contacts. Optionally create the contact directory.
+
+        Paths in the reserved set are treated as if the file already exists.
+        With overwrite, existing files are assumed to be from a previous
+        export of the threads and only the reserved paths are avoided, so
+        that the threads get the same paths as in that export.
+        """
+        reserved = set() if reserved is None else reserved
         dirname = self.sanename
         # Use phone number to distinguish threads from the same contact,
         # except for groups, which do not have a phone number.
         filename = f"{self.sanename if self.is_group else self.sanephone}.html"
         path = os.path.join(output_dir, dirname, filename)
         i = 2
-        while os.path.exists(path):
+        while path in reserved or (not overwrite and os.path.exists(path)):
             if self.is_group:
                 dirname = f"{self.sanename}_{i}"
             else:
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""Parallel export of threads
+
+Threads are independent once the addressbook is built, so they can be
+populated and written by a pool of worker processes. Each worker opens its
+own read-only connection to the database and receives a copy of the
+addressbook when it starts.
+
+License: See LICENSE file.
+
+"""
+
+import logging
+import logging.handlers
+import multiprocessing
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+from typing import Optional
+
+from .attachments import AttachmentExporter
+from .attachments import ExportReport
+from .core import CacheStats
+from .core import export_thread
+from .core import get_cache_stats
+from .database import QueryStats
+from .database import connect
+from .memory import MemoryProfile
+from .memory import enable_memory_profile
+from .memory import get_memory_profile
+from .stats import ATTACHMENTS
+from .stats import RunStats
+from .stats import enable_stats
+from .stats import get_run_stats
+from .stats import stage
+
+logger = logging.getLogger(__name__)
+
+# State of a worker process, set by the pool initializer
+_worker = {}
+
+
+def _init_worker(
+    db_file,
+    addressbook,
+    backup_dir,
+    output_dir,
+    versioninfo,
+    exporter_options,
+    dump_options,
+    batch_size,
+    sql_stats,
+    run_stats,
+    memory_profile,
+    log_queue,
+    log_level,
+):
+    """Open the database and store the shared state in the worker"""
+    # Send log records to the main process, which handles them like its own
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+    if run_stats:
+        enable_stats()
+    if memory_profile:
+        enable_memory_profile()
+    query_stats = QueryStats() if sql_stats else None
+    db = connect(db_file, query_stats=query_stats).cursor()
+    addressbook.db = db
+    _worker.update(
+        query_stats=query_stats,
+        db=db,
+        addressbook=addressbook,
+        exporter=AttachmentExporter(backup_dir, **exporter_options),
+        output_dir=output_dir,
+        versioninfo=versioninfo,
+        dump_options=dump_options,
+        batch_size=batch_size,
+        cache_stats=get_cache_stats(),
+    )
+
+
+def _export_thread(thread, rows, output_file):
+    """Export a single thread in a worker process
+
+    Returns the report of the attachments exported for the thread, and the
+    statistics of its queries, of the run, and its memory profile if these
+    are collected, and the use of the caches of the worker since the
+    previous thread."""
+    export_thread(
+        _worker["db"],
+        thread,
+        _worker["addressbook"],
+        _worker["exporter"],
+        _worker["output_dir"],
+        output_file,
+        _worker["versioninfo"],
+        rows,
+        _worker["dump_options"],
+        _worker["batch_size"],
+    )
+    with stage(ATTACHMENTS):
+        report = _worker["exporter"].drain()
+    query_stats = _worker["query_stats"]
+    run_stats = get_run_stats()
+    profile = get_memory_profile()
+    cache_stats = get_cache_stats()
+    cache_delta = cache_stats.since(_worker["cache_stats"])
+    _worker["cache_stats"] = cache_stats
+    return (
+        report,
+        None if query_stats is None else query_stats.drain(),
+        None if run_stats is None else run_stats.drain(),
+        None if profile is None else profile.drain(),
+        cache_delta,
+    )
+
+
+def export_threads(
+    tasks,
+    jobs,
+    db_file,
+    addressbook,
+    backup_dir,
+    output_dir,
+    versioninfo,
+    exporter_options,
+    dump_options,
+    batch_size=None,
+    query_stats: Optional[QueryStats] = None,
+    run_stats: Optional[RunStats] = None,
+    memory_profile: Optional[MemoryProfile] = None,
+    cache_stats: Optional[CacheStats] = None,
+) -> ExportReport:
+    """Export threads in parallel using a pool of worker processes
+
+    The tasks are tuples of a thread, its rows, and its output file (see
+    core.plan_threads). With a batch size, the workers stream the threads
+    from the database (see core.export_thread). Only a limited number of
+    tasks is submitted ahead of the workers, to avoid holding the rows of
+    all threads in memory.
+
+    Returns the combined report of the attachments exported by the workers.
+    If query statistics, run statistics, a memory profile, or cache
+    statistics are given, those of the workers are added to them."""
+    context = multiprocessing.get_context()
+    log_queue = context.Queue()
+    log_listener = logging.handlers.QueueListener(
+        log_queue, *logging.getLogger().handlers, respect_handler_level=True
+    )
+    log_listener.start()
+    try:
+        return _run_pool(
+            tasks,
+            jobs,
+            context,
+            (query_stats, run_stats, memory_profile, cache_stats),
+            (
+                db_file,
+                addressbook,
+                backup_dir,
+                output_dir,
+                versioninfo,
+                exporter_options,
+                dump_options,
+                batch_size,
+                query_stats is not None,
+                run_stats is not None,
+                memory_profile is not None,
+                log_queue,
+                logging.getLogger().level,
+            ),
+        )
+    finally:
+        log_listener.stop()
+
+
+def _run_pool(tasks, jobs, context, collectors, initargs):
+    """Submit the tasks to the pool and wait for the results
+
+    The collectors receive the statistics that come with the report of
+    every thread, if these are collected."""
+    report = ExportReport()
+
+    def add_result(future):
+        thread_report, *thread_stats = future.result()
+        report.update(thread_report)
+        for collector, stats in zip(collectors, thread_stats):
+            if collector is not None and stats is not None:
+                collector.update(stats)
+
+    max_pending = 2 * jobs
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=initargs,
+    ) as pool:
+        pending = set()
+        try:
+            for thread, rows, output_file in tasks:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add_result(future)
+                pending.add(
+                    pool.submit(_export_thread, thread, rows, output_file)
+                )
+            for future in wait(pending).done:
+                add_result(future)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    return report
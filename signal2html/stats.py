@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+"""Statistics of an export run
+
+The wall time and CPU time of the stages of the export are recorded, overall
+and per thread, when enabled. Time is attributed to the innermost stage that
+is active, so that the stages add up without counting any time twice. For
+instance, the time spent reading messages from the database while a page is
+rendered counts towards the fetch stage and not towards the render stage.
+
+Stages are timed in the main thread of a process, the CPU time is that of
+the thread. Attachments are copied by I/O threads, which keep their own
+account in the ExportReport.
+
+License: See LICENSE file.
+
+"""
+
+import contextlib
+import json
+import os
+import time
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Stages of the export
+ADDRESSBOOK = "addressbook"
+FETCH = "fetch"
+DECODE = "decode"
+FORMAT = "format"
+LINKIFY = "linkify"
+RENDER = "render"
+WRITE = "write"
+ATTACHMENTS = "attachments"
+STAGES = (
+    ADDRESSBOOK,
+    FETCH,
+    DECODE,
+    FORMAT,
+    LINKIFY,
+    RENDER,
+    WRITE,
+    ATTACHMENTS,
+)
+
+# Statistics of the current process, if enabled
+_run = None
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def _now():
+    return time.perf_counter(), time.thread_time()
+
+
+class _Stage:
+    """Context manager that makes a stage the active one"""
+
+    __slots__ = ("stats", "name")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats._switch()
+        self.stats._stack.append(self.name)
+
+    def __exit__(self, *exc_info):
+        self.stats._switch()
+        self.stats._stack.pop()
+
+
+class RunStats:
+    """Wall and CPU time per stage of the export, overall and per thread
+
+    The totals are the times of all stages in seconds, as [wall, cpu]. For
+    every exported thread, a record is kept with the time of the export of
+    the thread and of its stages, and the number of messages and bytes that
+    were written."""
+
+    def __init__(self):
+        self.totals = {name: [0.0, 0.0] for name in STAGES}
+        self.threads: List[Dict[str, Any]] = []
+        self._stages = {name: _Stage(self, name) for name in STAGES}
+        self._stack: List[str] = []
+        self._mark = _now()
+        self._thread: Optional[Dict[str, Any]] = None
+
+    def _switch(self):
+        """Charge the time since the last switch to the active stage"""
+        now = _now()
+        if self._stack:
+            total = self.totals[self._stack[-1]]
+            total[0] += now[0] - self._mark[0]
+            total[1] += now[1] - self._mark[1]
+        self._mark = now
+
+    def start_thread(self, thread_id: int):
+        """Start the record of a thread"""
+        self._switch()
+        self._thread = {
+            "id": thread_id,
+            "messages": 0,
+            "bytes": 0,
+            "start": self._mark,
+            "totals": {k: list(v) for k, v in self.totals.items()},
+        }
+
+    def end_thread(self):
+        """Finish the record of the current thread"""
+        self._switch()
+        record = self._thread
+        self._thread = None
+        start_wall, start_cpu = record.pop("start")
+        before = record.pop("totals")
+        record["wall"] = self._mark[0] - start_wall
+        record["cpu"] = self._mark[1] - start_cpu
+        record["stages"] = {
+            name: {
+                "wall": self.totals[name][0] - before[name][0],
+                "cpu": self.totals[name][1] - before[name][1],
+            }
+            for name in STAGES
+        }
+        self.threads.append(record)
+
+    def add_messages(self, count: int):
+        if self._thread is not None:
+            self._thread["messages"] += count
+
+    def add_bytes(self, count: int):
+        if self._thread is not None:
+            self._thread["bytes"] += count
+
+    def drain(self) -> "RunStats":
+        """Return the statistics collected so far and start anew"""
+        self._switch()
+        stats = RunStats()
+        stats.totals, stats.threads = self.totals, self.threads
+        self.totals = {name: [0.0, 0.0] for name in STAGES}
+        self.threads = []
+        return stats
+
+    def update(self, other: "RunStats"):
+        """Add the statistics of another instance to this one"""
+        for name, (wall, cpu) in other.totals.items():
+            self.totals[name][0] += wall
+            self.totals[name][1] += cpu
+        self.threads.extend(other.threads)
+
+    def to_dict(self, wall_time, cpu_time, report) -> Dict[str, Any]:
+        """Get the statistics of a run as a dict for JSON
+
+        The throughput is computed from the wall time of the run and the
+        bytes of the pages and the attachments that were written."""
+        messages = sum(t["messages"] for t in self.threads)
+        html_bytes = sum(t["bytes"] for t in self.threads)
+        total_bytes = html_bytes + report.bytes_copied
+        return {
+            "wall_time": wall_time,
+            "cpu_time": cpu_time,
+            "threads": len(self.threads),
+            "messages": messages,
+            "html_bytes": html_bytes,
+            "attachment_bytes": report.bytes_copied,
+            "throughput": {
+                "messages_per_second": messages / wall_time,
+                "megabytes_per_second": total_bytes / 2**20 / wall_time,
+            },
+            "stages": {
+                name: {"wall": wall, "cpu": cpu}
+                for name, (wall, cpu) in self.totals.items()
+            },
+            "attachment_copy": {
+                "wall": report.copy_time,
+                "cpu": report.copy_cpu_time,
+            },
+            "per_thread": sorted(self.threads, key=lambda t: t["id"]),
+        }
+
+
+def enable_stats() -> RunStats:
+    """Start collecting statistics in this process"""
+    global _run
+    _run = RunStats()
+    return _run
+
+
+def disable_stats():
+    """Stop collecting statistics in this process"""
+    global _run
+    _run = None
+
+
+def get_run_stats() -> Optional[RunStats]:
+    """Get the statistics of this process, if enabled"""
+    return _run
+
+
+def stage(name: str):
+    """Get a context manager that times a stage, if enabled"""
+    if _run is None:
+        return _NULL_STAGE
+    return _run._stages[name]
+
+
+def timed(iterator, name: str):
+    """Time the production of the items of an iterator as a stage, if
+    enabled"""
+    if _run is None:
+        return iterator
+    return _timed(iter(iterator), _run._stages[name])
+
+
+def _timed(iterator, stage):
+    while True:
+        with stage:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def counted(iterator):
+    """Count the messages of an iterator for the current thread while they
+    are consumed, if enabled"""
+    if _run is None:
+        return iterator
+    return _counted(iterator, _run)
+
+
+def _counted(iterator, run):
+    for item in iterator:
+        run.add_messages(1)
+        yield item
+
+
+@contextlib.contextmanager
+def thread_stats(thread_id: int):
+    """Record the statistics of exporting a thread, if enabled"""
+    if _run is None:
+        yield
+        return
+    _run.start_thread(thread_id)
+    try:
+        yield
+    finally:
+        _run.end_thread()
+
+
+def add_output_file(filename):
+    """Add the size of a written file to the current thread, if enabled"""
+    if _run is not None:
+        _run.add_bytes(os.path.getsize(filename))
+
+
+def save_stats(filename, data: Dict[str, Any]):
+    """Save the statistics of a run as JSON"""
+    with open(filename, "w", encoding="utf-8") as fp:
+        json.dump(data, fp, indent=2)
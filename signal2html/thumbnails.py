@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""Thumbnails of image attachments
+
+Thumbnails are made after the threads are exported, from the attachments in
+the backup, by a pool of processes. This requires Pillow, which is an
+optional dependency.
+
+License: See LICENSE file.
+
+"""
+
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from typing import Dict
+from typing import List
+
+try:
+    from PIL import Image
+    from PIL import ImageOps
+except ImportError:
+    Image = None
+
+from .models import Attachment
+
+logger = logging.getLogger(__name__)
+
+# Default maximum width and height of thumbnails in pixels
+THUMBNAIL_SIZE = 320
+
+# Content types of the images for which thumbnails are made. Animated GIFs
+# are left alone.
+THUMBNAIL_TYPES = ("image/jpeg", "image/png", "image/webp")
+
+
+def has_pillow() -> bool:
+    """Check whether Pillow is available to make thumbnails"""
+    return Image is not None
+
+
+def needs_thumbnail(attachment: Attachment, max_size=THUMBNAIL_SIZE) -> bool:
+    """Check whether a thumbnail should be made for an attachment, using the
+    dimensions from the database. Images of unknown size get one."""
+    if attachment.contentType not in THUMBNAIL_TYPES:
+        return False
+    if not attachment.width or not attachment.height:
+        return True
+    return max(attachment.width, attachment.height) > max_size
+
+
+def get_thumbnail_path(path, max_size=THUMBNAIL_SIZE) -> str:
+    """Get the path of the thumbnail of an attachment (a file path or URL)
+    in the thumbnails directory next to the attachment
+
+    Thumbnails of different sizes are kept apart, so that changing the size
+    doesn't reuse thumbnails of the old size."""
+    head, tail = os.path.split(path)
+    name = os.path.splitext(tail)[0] + ".jpg"
+    return os.path.join(head, "thumbnails", str(max_size), name)
+
+
+def is_thumbnail_current(source, target) -> bool:
+    """Check whether the thumbnail exists and is newer than the source"""
+    try:
+        return os.stat(target).st_mtime >= os.stat(source).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def make_thumbnail(source, target, max_size=THUMBNAIL_SIZE):
+    """Downscale an image to fit in a square of max_size pixels and save it
+    as JPEG"""
+    with Image.open(source) as image:
+        image.draft("RGB", (max_size, max_size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        tmp = f"{target}.{os.getpid()}.tmp"
+        image.save(tmp, "JPEG", quality=80)
+    os.replace(tmp, target)
+
+
+def _make_thumbnails(tasks, max_size) -> List[str]:
+    """Make a batch of thumbnails and return the errors (in a worker)"""
+    errors = []
+    for target, source in tasks:
+        try:
+            make_thumbnail(source, target, max_size=max_size)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            errors.append(f"{source} (thumbnail): {e}")
+    return errors
+
+
+def make_thumbnails(
+    thumbnails: Dict[str, str],
+    jobs=None,
+    max_size=THUMBNAIL_SIZE,
+    batch_size=32,
+) -> List[str]:
+    """Make the thumbnails that are missing or outdated
+
+    The thumbnails are given as a dict of target path to source path. They
+    are made in batches by a pool of jobs processes, one per CPU by default.
+    A single batch is made in this process. Returns the errors that
+    occurred."""
+    tasks = [
+        (target, source)
+        for target, source in sorted(thumbnails.items())
+        if not is_thumbnail_current(source, target)
+    ]
+    if not tasks:
+        return []
+    logger.info(f"Making {len(tasks)} thumbnail(s).")
+    batches = [
+        tasks[i : i + batch_size] for i in range(0, len(tasks), batch_size)
+    ]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(batches))
+    if jobs <= 1:
+        results = (_make_thumbnails(batch, max_size) for batch in batches)
+        return [error for errors in results for error in errors]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(
+            _make_thumbnails, batches, [max_size] * len(batches)
+        )
+        return [error for errors in results for error in errors]
@@ -11,7 +11,28 @@ import argparse
 from pathlib import Path
 
 from . import __version__
+from .attachments import ATTACHMENT_MODES
+from .attachments import SYNC_MODES
+from .core import BATCH_SIZE
 from .core import process_backup
+from .database import WORKING_COPIES
+from .thumbnails import THUMBNAIL_SIZE
+from .thumbnails import has_pillow
+
+
+def parse_pagination(value):
+    """Parse the pagination option, either "month" or a number of messages"""
+    if value == "month":
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected 'month' or a positive number, got '{value}'"
+        )
+    return size
 
 
 def parse_args():
@@ -22,6 +43,142 @@ def parse_args():
     parser.add_argument(
         "-o", "--output-dir", help="Output directory", required=True, type=Path
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of processes to export threads in parallel",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--io-threads",
+        help="Number of threads to copy attachments (per process)",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--attachment-mode",
+        help=(
+            "How attachments are placed in the output directory: copied, "
+            "hard linked, symbolically linked, or cloned (reflink, which "
+            "falls back to a copy if the file system doesn't support it)"
+        ),
+        choices=ATTACHMENT_MODES,
+        default="copy",
+    )
+    parser.add_argument(
+        "--media-store",
+        help=(
+            "Store each attachment once in a shared media directory, named "
+            "by the hash of its content, instead of copying it into every "
+            "thread that contains it"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sync",
+        help=(
+            "Leave attachments that are already in the output directory "
+            "alone if they have the same size and modification time as in "
+            "the backup (mtime), or the same content (hash)"
+        ),
+        choices=SYNC_MODES,
+    )
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Skip threads that haven't changed since the previous export to "
+            "the output directory"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--paginate",
+        help=(
+            "Split threads into pages by month (month) or by a number of "
+            "messages, with an index page for each thread"
+        ),
+        metavar="{month,N}",
+        type=parse_pagination,
+    )
+    parser.add_argument(
+        "--thumbnails",
+        help=(
+            "Show thumbnails of large images that link to the originals "
+            "(requires Pillow). They are made after the export by --jobs "
+            "processes, or one per CPU by default"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--thumbnail-size",
+        help=f"Maximum width and height of thumbnails (default: {THUMBNAIL_SIZE})",
+        default=THUMBNAIL_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--template-cache",
+        help=(
+            "Keep the compiled templates in the output directory, so later "
+            "runs don't have to compile them again"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help=(
+            "Stream the messages of each thread from the database to the "
+            "output in batches, so memory use doesn't grow with the length "
+            "of the threads"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help=(
+            "Number of messages read at a time when streaming "
+            f"(default: {BATCH_SIZE})"
+        ),
+        default=BATCH_SIZE,
+        type=int,
+    )
+    parser.add_argument(
+        "--working-copy",
+        help=(
+            "Copy the database to memory or to a temporary file first, and "
+            "add the indexes it's missing there (the backup is never "
+            "modified)"
+        ),
+        choices=WORKING_COPIES,
+    )
+    parser.add_argument(
+        "--sql-stats",
+        help=(
+            "Report the number of calls, time, and rows of every database "
+            "query with its query plan at the end, to find slow queries"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stats",
+        help=(
+            "Save the wall and CPU time of every stage of the export, "
+            "overall and per thread, and the throughput to a JSON file"
+        ),
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--memory-profile",
+        help=(
+            "Trace the memory used by every thread and report the peak RSS "
+            "and the N threads with the highest peak with their top "
+            "allocation sites (default N: 10, slows down the export)"
+        ),
+        metavar="N",
+        nargs="?",
+        const=10,
+        type=int,
+    )
     parser.add_argument(
         "-V",
         "--version",
@@ -29,9 +186,42 @@ def parse_args():
         action="version",
         version=__version__,
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.thumbnails and not has_pillow():
+        parser.error(
+            "--thumbnails requires Pillow, install it with: "
+            "pip install signal2html[thumbnails]"
+        )
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive number")
+    if args.io_threads < 1:
+        parser.error("--io-threads must be a positive number")
+    if args.thumbnail_size < 1:
+        parser.error("--thumbnail-size must be a positive number")
+    if args.memory_profile is not None and args.memory_profile < 1:
+        parser.error("--memory-profile must be a positive number")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be a positive number")
+    return args
 
 
 def main():
     args = parse_args()
-    process_backup(args.input_dir, args.output_dir)
+    process_backup(
+        args.input_dir,
+        args.output_dir,
+        jobs=args.jobs,
+        io_threads=args.io_threads,
+        attachment_mode=args.attachment_mode,
+        media_store=args.media_store,
+        incremental=args.incremental,
+        sync=args.sync,
+        paginate=args.paginate,
+        thumbnail_size=args.thumbnail_size if args.thumbnails else None,
+        template_cache=args.template_cache,
+        batch_size=args.batch_size if args.stream else None,
+        working_copy=args.working_copy,
+        sql_stats=args.sql_stats,
+        stats_file=args.stats,
+        memory_profile=args.memory_profile,
+    )
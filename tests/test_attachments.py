@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from unittest import mock
+
+from signal2html.attachments import ATTACHMENT_MODES
+from signal2html.attachments import AttachmentExporter
+from signal2html.attachments import ExportReport
+from signal2html.attachments import get_content_type_extension
+from signal2html.attachments import is_synced
+from signal2html.attachments import load_sniff_cache
+from signal2html.attachments import place_file
+from signal2html.attachments import save_sniff_cache
+from signal2html.models import Attachment
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+def make_attachment(content_type="image/png"):
+    return Attachment(
+        contentType=content_type,
+        fileName=None,
+        voiceNote=False,
+        width=1,
+        height=1,
+        quote=False,
+        unique_id=123,
+    )
+
+
+class TestAttachmentExporter(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self._tmpdir.name, "backup")
+        self.thread_dir = os.path.join(self._tmpdir.name, "output", "thread")
+        os.makedirs(self.backup_dir)
+        with open(
+            os.path.join(self.backup_dir, "Attachment_1_123.bin"), "wb"
+        ) as fp:
+            fp.write(PNG_HEADER)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_export(self):
+        exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+        a = make_attachment()
+        exporter.submit(a, 1, 123, self.thread_dir)
+        exporter.wait_for_filenames()
+        self.assertEqual(a.fileName, "./attachments/Attachment_1_123.png")
+        self.assertEqual(exporter.close().errors, [])
+        target = os.path.join(
+            self.thread_dir, "attachments", "Attachment_1_123.png"
+        )
+        with open(target, "rb") as fp:
+            self.assertEqual(fp.read(), PNG_HEADER)
+
+    def test_export_content_type(self):
+        # The extension follows the content type without reading the file
+        exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+        a = make_attachment(content_type="image/jpeg")
+        with mock.patch("filetype.guess") as guess:
+            exporter.submit(a, 1, 123, self.thread_dir)
+            report = exporter.close()
+        guess.assert_not_called()
+        self.assertEqual(a.fileName, "./attachments/Attachment_1_123.jpg")
+        self.assertEqual(report.sniffed, {})
+
+    def test_export_sniff_cache(self):
+        source = os.path.join(self.backup_dir, "Attachment_1_123.bin")
+        stat = os.stat(source)
+        exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+        a = make_attachment(content_type="application/octet-stream")
+        exporter.submit(a, 1, 123, self.thread_dir)
+        report = exporter.close()
+        self.assertEqual(a.fileName, "./attachments/Attachment_1_123.png")
+        entry = [stat.st_size, stat.st_mtime_ns, "png"]
+        self.assertEqual(report.sniffed, {"1_123": entry})
+
+        # A cached extension is used without reading the file
+        cache = {"1_123": [stat.st_size, stat.st_mtime_ns, "gif"]}
+        exporter = AttachmentExporter(
+            self.backup_dir, max_workers=2, sniff_cache=cache
+        )
+        a = make_attachment(content_type=None)
+        with mock.patch("filetype.guess") as guess:
+            exporter.submit(a, 1, 123, self.thread_dir)
+            report = exporter.close()
+        guess.assert_not_called()
+        self.assertEqual(a.fileName, "./attachments/Attachment_1_123.gif")
+        self.assertEqual(report.sniffed, {})
+
+        # A changed file is sniffed again
+        cache = {"1_123": [stat.st_size + 1, stat.st_mtime_ns, "gif"]}
+        exporter = AttachmentExporter(
+            self.backup_dir, max_workers=2, sniff_cache=cache
+        )
+        a = make_attachment(content_type=None)
+        exporter.submit(a, 1, 123, self.thread_dir)
+        report = exporter.close()
+        self.assertEqual(a.fileName, "./attachments/Attachment_1_123.png")
+        self.assertEqual(cache, {"1_123": entry})
+
+    def test_export_thumbnail(self):
+        exporter = AttachmentExporter(self.backup_dir, thumbnail_size=100)
+        a = make_attachment()
+        a.width = 1000
+        exporter.submit(a, 1, 123, self.thread_dir)
+        report = exporter.close()
+        self.assertEqual(
+            a.thumbnail, "./attachments/thumbnails/100/Attachment_1_123.jpg"
+        )
+        target = os.path.join(
+            self.thread_dir,
+            "attachments",
+            "thumbnails",
+            "100",
+            "Attachment_1_123.jpg",
+        )
+        source = os.path.join(self.backup_dir, "Attachment_1_123.bin")
+        self.assertEqual(report.thumbnails, {os.path.abspath(target): source})
+
+    def test_export_missing(self):
+        exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+        a = make_attachment()
+        with self.assertLogs("signal2html.attachments", level="WARNING"):
+            exporter.submit(a, 2, 456, self.thread_dir)
+            exporter.wait_for_filenames()
+        self.assertIsNone(a.fileName)
+        self.assertEqual(exporter.close().errors, [])
+
+    def test_export_error(self):
+        # Block the attachments directory with a file
+        os.makedirs(self.thread_dir)
+        open(os.path.join(self.thread_dir, "attachments"), "w").close()
+
+        exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+        a = make_attachment()
+        exporter.submit(a, 1, 123, self.thread_dir)
+        errors = exporter.close().errors
+        self.assertEqual(len(errors), 1)
+        self.assertIn("Attachment_1_123.bin", errors[0])
+
+    def test_export_unexpected_error(self):
+        # Errors other than OSError are recorded too, while naming the file
+        # and while placing it
+        for target, error in (
+            ("filetype.get_type", ValueError("bad type")),
+            ("signal2html.attachments.place_file", RuntimeError("failed")),
+        ):
+            with self.subTest(target=target):
+                exporter = AttachmentExporter(self.backup_dir, max_workers=2)
+                with mock.patch(target, side_effect=error):
+                    exporter.submit(make_attachment(), 1, 123, self.thread_dir)
+                    errors = exporter.close().errors
+                self.assertEqual(len(errors), 1)
+                self.assertIn(str(error), errors[0])
+
+
+class TestContentTypeExtension(unittest.TestCase):
+    def test_get_content_type_extension(self):
+        self.assertEqual(get_content_type_extension("image/jpeg"), "jpg")
+        self.assertEqual(get_content_type_extension("Video/MP4"), "mp4")
+        self.assertEqual(
+            get_content_type_extension("audio/mpeg; charset=binary"), "mp3"
+        )
+        self.assertIsNone(get_content_type_extension(None))
+        self.assertIsNone(get_content_type_extension(""))
+        self.assertIsNone(
+            get_content_type_extension("application/octet-stream")
+        )
+        self.assertIsNone(get_content_type_extension("text/x-signal-plain"))
+
+
+class TestSniffCache(unittest.TestCase):
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cache", "sniff.json")
+            self.assertEqual(load_sniff_cache(path), {})
+            cache = {"1_123": [10, 20, "png"]}
+            save_sniff_cache(path, cache)
+            self.assertEqual(load_sniff_cache(path), cache)
+
+            with open(path, "w") as fp:
+                fp.write("{")
+            with self.assertLogs("signal2html.attachments", "WARNING"):
+                self.assertEqual(load_sniff_cache(path), {})
+
+
+class TestMediaStore(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.backup_dir = os.path.join(self._tmpdir.name, "backup")
+        self.output_dir = os.path.join(self._tmpdir.name, "output")
+        self.media_dir = os.path.join(self.output_dir, "media")
+        os.makedirs(self.backup_dir)
+        for name in ("Attachment_1_123.bin", "Attachment_2_456.bin"):
+            with open(os.path.join(self.backup_dir, name), "wb") as fp:
+                fp.write(PNG_HEADER)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_deduplicate(self):
+        exporter = AttachmentExporter(
+            self.backup_dir, max_workers=2, media_dir=self.media_dir
+        )
+        a = make_attachment()
+        b = make_attachment()
+        exporter.submit(a, 1, 123, os.path.join(self.output_dir, "alice"))
+        exporter.submit(b, 2, 456, os.path.join(self.output_dir, "bob"))
+        exporter.wait_for_filenames()
+        digest = hashlib.sha256(PNG_HEADER).hexdigest()
+        self.assertEqual(a.fileName, f"../media/{digest}.png")
+        self.assertEqual(b.fileName, a.fileName)
+
+        report = exporter.close()
+        self.assertEqual(report.errors, [])
+        self.assertEqual(report.stored, 1)
+        self.assertEqual(report.deduplicated, 1)
+        self.assertEqual(report.bytes_saved, len(PNG_HEADER))
+        self.assertEqual(report.bytes_copied, len(PNG_HEADER))
+        self.assertGreater(report.copy_time, 0)
+        self.assertEqual(os.listdir(self.media_dir), [f"{digest}.png"])
+
+    def test_existing(self):
+        # Files stored by a previous run are not written again
+        for _ in range(2):
+            exporter = AttachmentExporter(
+                self.backup_dir, max_workers=2, media_dir=self.media_dir
+            )
+            exporter.submit(
+                make_attachment(), 1, 123, os.path.join(self.output_dir, "a")
+            )
+            report = exporter.close()
+        self.assertEqual(report.stored, 0)
+        self.assertEqual(report.deduplicated, 1)
+
+
+class TestExportReport(unittest.TestCase):
+    def test_update(self):
+        report = ExportReport(errors=["a"], stored=1)
+        report.update(ExportReport(["b"], 2, 3, 4))
+        self.assertEqual(report, ExportReport(["a", "b"], 3, 3, 4))
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self._tmpdir.name, "source.bin")
+        with open(self.source, "wb") as fp:
+            fp.write(PNG_HEADER)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_is_synced(self):
+        for mode in ATTACHMENT_MODES:
+            with self.subTest(mode=mode):
+                target = os.path.join(self._tmpdir.name, f"{mode}.png")
+                self.assertFalse(is_synced(self.source, target, mode))
+                place_file(self.source, target, mode=mode)
+                self.assertTrue(is_synced(self.source, target, mode))
+                self.assertTrue(is_synced(self.source, target, mode, "hash"))
+
+    def test_is_synced_changed(self):
+        target = os.path.join(self._tmpdir.name, "target.png")
+        place_file(self.source, target)
+
+        # Same size but different content and modification time
+        with open(target, "wb") as fp:
+            fp.write(PNG_HEADER[::-1])
+        os.utime(target, (0, 0))
+        self.assertFalse(is_synced(self.source, target))
+        self.assertFalse(is_synced(self.source, target, sync="hash"))
+
+        # The modification time is restored but the content differs
+        shutil.copystat(self.source, target)
+        self.assertTrue(is_synced(self.source, target))
+        self.assertFalse(is_synced(self.source, target, sync="hash"))
+
+    def test_export_sync(self):
+        backup_dir = self._tmpdir.name
+        thread_dir = os.path.join(self._tmpdir.name, "thread")
+        os.rename(self.source, os.path.join(backup_dir, "Attachment_1_2.bin"))
+        for unchanged in (0, 1):
+            exporter = AttachmentExporter(backup_dir, sync="mtime")
+            exporter.submit(make_attachment(), 1, 2, thread_dir)
+            report = exporter.close()
+            self.assertEqual(report.errors, [])
+            self.assertEqual(report.unchanged, unchanged)
+            self.assertEqual(
+                report.bytes_copied, 0 if unchanged else len(PNG_HEADER)
+            )
+
+    def test_export_after_links(self):
+        backup_dir = self._tmpdir.name
+        thread_dir = os.path.join(self._tmpdir.name, "thread")
+        source = os.path.join(backup_dir, "Attachment_1_2.bin")
+        os.rename(self.source, source)
+        for mode in ("symlink", "reflink"):
+            exporter = AttachmentExporter(backup_dir, mode=mode, sync="mtime")
+            exporter.submit(make_attachment(), 1, 2, thread_dir)
+            self.assertEqual(exporter.close().errors, [])
+        with open(source, "rb") as fp:
+            self.assertEqual(fp.read(), PNG_HEADER)
+
+
+class TestPlaceFile(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self._tmpdir.name, "source.bin")
+        with open(self.source, "wb") as fp:
+            fp.write(PNG_HEADER)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_place_file(self):
+        for mode in ATTACHMENT_MODES:
+            with self.subTest(mode=mode):
+                target = os.path.join(self._tmpdir.name, f"{mode}.png")
+                # Placing the file twice replaces the existing target
+                place_file(self.source, target, mode=mode)
+                place_file(self.source, target, mode=mode)
+                with open(target, "rb") as fp:
+                    self.assertEqual(fp.read(), PNG_HEADER)
+                self.assertEqual(os.path.islink(target), mode == "symlink")
+
+    def test_place_file_over_link(self):
+        # Switching from links to copies must not write through the links
+        for link_mode in ("hardlink", "symlink"):
+            for mode in ("copy", "reflink"):
+                with self.subTest(link_mode=link_mode, mode=mode):
+                    target = os.path.join(self._tmpdir.name, "target.png")
+                    place_file(self.source, target, mode=link_mode)
+                    place_file(self.source, target, mode=mode)
+                    self.assertFalse(os.path.islink(target))
+                    self.assertFalse(os.path.samefile(self.source, target))
+                    with open(self.source, "rb") as fp:
+                        self.assertEqual(fp.read(), PNG_HEADER)
+                    with open(target, "rb") as fp:
+                        self.assertEqual(fp.read(), PNG_HEADER)
+                    os.unlink(target)
+
+    def test_place_file_unknown_mode(self):
+        target = os.path.join(self._tmpdir.name, "target.png")
+        with self.assertRaises(ValueError):
+            place_file(self.source, target, mode="move")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import tempfile
+import unittest
+import uuid
+import weakref
+
+from pathlib import Path
+from unittest import mock
+
+from signal2html.core import BulkReader
+from signal2html.core import CacheStats
+from signal2html.core import ThreadBatches
+from signal2html.core import clear_caches
+from signal2html.core import fetch_batches
+from signal2html.core import get_cache_stats
+from signal2html.core import get_group_update_data_v2
+from signal2html.core import get_member_by_raw_uuid
+from signal2html.core import get_mentions
+from signal2html.core import get_message_headers
+from signal2html.core import get_mms_records
+from signal2html.core import get_sms_records
+from signal2html.core import get_visible_threads
+from signal2html.core import has_visible_messages
+from signal2html.core import index_parts
+from signal2html.core import plan_threads
+from signal2html.core import process_backup
+from signal2html.core import stream_mms_records
+from signal2html.core import stream_sms_records
+from signal2html.database import Database
+from signal2html.dbproto import StructuredDecryptedMember
+from signal2html.dbproto import StructuredDecryptedString
+from signal2html.dbproto import StructuredGroupDataV2
+from signal2html.dbproto import StructuredGroupV2Change
+from signal2html.dbproto import StructuredGroupV2State
+from signal2html.dbproto import StructuredMemberRole
+from signal2html.exceptions import DatabaseEmptyError
+from signal2html.memory import get_memory_profile
+from signal2html.models import Recipient
+from signal2html.models import Thread
+from signal2html.stats import get_run_stats
+from signal2html.versioninfo import VersionInfo
+
+
+class TestThreadBatches(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.execute(
+            "CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id INTEGER)"
+        )
+        self.conn.executemany(
+            "INSERT INTO sms VALUES (?, ?)",
+            [(1, 3), (2, 1), (3, None), (4, 3), (5, 5), (6, 1)],
+        )
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_pop(self):
+        batches = ThreadBatches(
+            self.conn.execute(
+                "SELECT thread_id, _id FROM sms ORDER BY thread_id, _id"
+            )
+        )
+        self.assertEqual(batches.pop(1), [(2,), (6,)])
+        self.assertEqual(batches.pop(2), [])
+        self.assertEqual(batches.pop(3), [(1,), (4,)])
+        # Thread 5 is skipped
+        self.assertEqual(batches.pop(6), [])
+        self.assertEqual(batches.pop(7), [])
+
+
+class TestIndexParts(unittest.TestCase):
+    def test_index_parts(self):
+        rows = [(1, 10, "image/png"), (1, 11, "video/mp4"), (4, 12, None)]
+        self.assertEqual(
+            index_parts(rows),
+            {1: [(10, "image/png"), (11, "video/mp4")], 4: [(12, None)]},
+        )
+        self.assertEqual(index_parts([]), {})
+
+
+class FakeAddressbook:
+    def __init__(self, recipients):
+        self.recipients = {r.uuid: r for r in recipients}
+
+    def get_recipient_by_uuid(self, text_uuid):
+        return self.recipients.get(text_uuid)
+
+
+class TestGroupUpdateData(unittest.TestCase):
+    def test_cached_members(self):
+        uuids = [uuid.UUID(int=i) for i in range(1, 4)]
+        addressbook = FakeAddressbook(
+            [Recipient(1, "Alice", "blue", False, "+1", str(uuids[0]))]
+        )
+        members = [
+            StructuredDecryptedMember(
+                uuid=u.bytes, role=StructuredMemberRole.MEMBER_ROLE_DEFAULT
+            )
+            for u in uuids
+        ]
+        before = get_cache_stats()
+        for rev in range(1, 6):
+            data = StructuredGroupDataV2(
+                change=StructuredGroupV2Change(
+                    by=uuids[0].bytes,
+                    new_title=StructuredDecryptedString(value=f"Rev {rev}"),
+                ),
+                state=StructuredGroupV2State(
+                    title=f"Rev {rev}", rev=rev, members=members
+                ),
+            )
+            update = get_group_update_data_v2(data.dumps(), addressbook, rev)
+            self.assertEqual(update.group_name, f"Rev {rev}")
+            self.assertEqual(update.change_by.name, "Alice")
+            self.assertEqual(
+                [m.name for m in update.members],
+                ["Alice", str(uuids[1]), str(uuids[2])],
+            )
+        counts = get_cache_stats().since(before).counts
+        # Members and names are decoded and looked up once
+        for name in ("member names", "nested messages"):
+            self.assertGreaterEqual(counts[name][0], 12)
+
+        # Clearing the caches releases the addressbook
+        ref = weakref.ref(addressbook)
+        del addressbook, update
+        clear_caches()
+        self.assertIsNone(ref())
+        self.assertEqual(
+            get_cache_stats().counts,
+            {"member names": [0, 0], "nested messages": [0, 0]},
+        )
+
+    def test_cache_stats(self):
+        stats = CacheStats({"member names": [1, 2]})
+        stats.update(CacheStats({"member names": [3, 4], "other": [5, 6]}))
+        self.assertEqual(
+            stats.counts, {"member names": [4, 6], "other": [5, 6]}
+        )
+        later = CacheStats({"member names": [10, 6], "other": [5, 7]})
+        self.assertEqual(
+            later.since(stats).counts,
+            {"member names": [6, 0], "other": [0, 1]},
+        )
+
+    def test_invalid_uuid(self):
+        addressbook = FakeAddressbook([])
+        for mid in (1, 2):
+            with self.assertLogs("signal2html.core", "WARNING") as cm:
+                self.assertIsNone(
+                    get_member_by_raw_uuid(b"abc", "member", addressbook, mid)
+                )
+            self.assertIn(f"message {mid}", cm.output[0])
+
+
+class FakeExporter:
+    def submit(self, attachment, _id, unique_id, thread_dir):
+        attachment.fileName = f"{_id}_{unique_id}"
+
+    def wait_for_filenames(self):
+        pass
+
+
+class FakeRecipients:
+    def get_recipient_by_address(self, address):
+        return Recipient(int(address), address, "blue", False, address, "")
+
+
+class FakeGroups:
+    def get_recipient_by_address(self, address):
+        return Recipient(int(address), "Friends", "blue", True, "", "")
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(":memory:")
+        self.conn.executescript(
+            """
+            CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id, address,
+                date, date_sent, body, type, delivery_receipt_count,
+                read_receipt_count);
+            CREATE TABLE mms (_id INTEGER PRIMARY KEY, thread_id, address,
+                date, date_received, body, quote_id, quote_author,
+                quote_body, quote_mentions, msg_box, reactions,
+                delivery_receipt_count, read_receipt_count,
+                viewed_receipt_count);
+            CREATE TABLE part (_id INTEGER PRIMARY KEY, mid, ct, unique_id,
+                voice_note, width, height, quote);
+            CREATE TABLE mention (_id INTEGER PRIMARY KEY, thread_id,
+                message_id, recipient_id, range_start, range_length);
+            """
+        )
+        # Messages of thread 1 out of order of date, thread 2 only has a
+        # message of the joined type (4)
+        self.conn.executemany(
+            "INSERT INTO sms VALUES (?, ?, 5, ?, ?, 'Hi', ?, 0, 0)",
+            [(1, 1, 30, 30, 20), (2, 1, 10, 10, 20), (3, 2, 40, 40, 4)],
+        )
+        self.conn.executemany(
+            "INSERT INTO mms VALUES "
+            "(?, 1, 6, ?, ?, NULL, NULL, NULL, NULL, NULL, 20, NULL, 0, 0, 0)",
+            [(1, 20, 20), (2, 10, 10), (3, 50, 50), (4, 20, 20)],
+        )
+        self.conn.executemany(
+            "INSERT INTO part VALUES (?, ?, 'image/png', ?, 0, 1, 1, 0)",
+            [(1, 3, 11), (2, 2, 12), (3, 3, 13), (4, 4, 14)],
+        )
+        self.conn.executemany(
+            "INSERT INTO mention VALUES (?, ?, ?, ?, ?, 1)",
+            [
+                (1, 2, 3, 7, 0),
+                (2, 1, 3, 5, 4),
+                (3, 1, 1, 6, 0),
+                (4, 1, 3, 6, 9),
+            ],
+        )
+        self.db = self.conn.cursor()
+        self.thread = Thread(_id=1, recipient=None)
+        self.versioninfo = VersionInfo(110)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_fetch_batches(self):
+        cursor = self.conn.execute("SELECT _id FROM mms ORDER BY _id")
+        self.assertEqual(
+            list(fetch_batches(cursor, 3)), [[(1,), (2,), (3,)], [(4,)]]
+        )
+
+    def test_stream_records(self):
+        addressbook = FakeRecipients()
+        for batch_size in (1, 2, 100):
+            self.assertEqual(
+                list(
+                    stream_sms_records(
+                        self.db, self.thread, addressbook, batch_size
+                    )
+                ),
+                get_sms_records(self.db, self.thread, addressbook),
+            )
+            streamed = list(
+                stream_mms_records(
+                    self.db,
+                    self.thread,
+                    addressbook,
+                    FakeExporter(),
+                    "thread",
+                    self.versioninfo,
+                    batch_size,
+                )
+            )
+            expected = get_mms_records(
+                self.db,
+                self.thread,
+                addressbook,
+                FakeExporter(),
+                "thread",
+                self.versioninfo,
+            )
+            self.assertEqual(streamed, expected)
+        self.assertEqual([m._id for m in streamed], [2, 1, 4, 3])
+        self.assertEqual(
+            [[a.fileName for a in m.attachments] for m in streamed],
+            [["2_12"], [], ["4_14"], ["1_11", "3_13"]],
+        )
+
+    def test_message_headers(self):
+        headers = get_message_headers(self.db, self.thread, FakeRecipients())
+        self.assertEqual(
+            [(h.addressRecipient.rid, h.dateSent) for h in headers],
+            [(6, 10), (5, 10), (6, 20), (6, 20), (5, 30), (6, 50)],
+        )
+
+    def test_visible_threads(self):
+        reader = BulkReader(self.db, self.versioninfo)
+        self.assertEqual(get_visible_threads(self.db), {1})
+        self.assertTrue(has_visible_messages(reader.get(1)))
+        self.assertFalse(has_visible_messages(reader.get(2)))
+
+    def test_plan_threads_overwrite(self):
+        self.conn.execute(
+            "CREATE TABLE thread (_id INTEGER PRIMARY KEY, thread_recipient_id)"
+        )
+        self.conn.executemany(
+            "INSERT INTO thread VALUES (?, ?)", [(1, 7), (2, 8)]
+        )
+        with tempfile.TemporaryDirectory() as output_dir:
+
+            def plan(overwrite):
+                threads = plan_threads(
+                    self.db,
+                    FakeGroups(),
+                    self.versioninfo,
+                    output_dir,
+                    overwrite=overwrite,
+                )
+                return [os.path.relpath(f, output_dir) for _, _, f in threads]
+
+            first = plan(False)
+            self.assertEqual(
+                first,
+                [
+                    os.path.join(d, "Friends.html")
+                    for d in ("Friends", "Friends_2")
+                ],
+            )
+            for path in first:
+                os.makedirs(os.path.join(output_dir, os.path.dirname(path)))
+                open(os.path.join(output_dir, path), "w").close()
+
+            # Without overwrite, the groups are placed next to the files of
+            # the previous export
+            self.assertEqual(plan(True), first)
+            self.assertEqual(
+                plan(False),
+                [
+                    os.path.join(d, "Friends.html")
+                    for d in ("Friends_3", "Friends_4")
+                ],
+            )
+
+    def test_bulk_mentions(self):
+        addressbook = FakeRecipients()
+        for messages in (True, False):
+            reader = BulkReader(self.db, self.versioninfo, messages=messages)
+            for thread_id in (1, 2, 3):
+                rows = reader.get(thread_id)
+                self.assertEqual(rows.sms is None, not messages)
+                self.assertEqual(
+                    get_mentions(
+                        self.db,
+                        addressbook,
+                        thread_id,
+                        self.versioninfo,
+                        rows=rows.mentions,
+                    ),
+                    get_mentions(
+                        self.db, addressbook, thread_id, self.versioninfo
+                    ),
+                )
+        mentions = get_mentions(self.db, addressbook, 1, self.versioninfo)
+        self.assertEqual(sorted(mentions), [1, 3])
+        self.assertEqual(sorted(mentions[3]), [4, 9])
+        self.assertEqual(mentions[3][4].name, "5")
+        self.assertEqual(
+            get_mentions(self.db, addressbook, 1, VersionInfo(23)), {}
+        )
+
+
+class TestProcessBackup(unittest.TestCase):
+    def test_cleanup_on_error(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup_dir = Path(tmpdir)
+            sqlite3.connect(backup_dir / "database.sqlite").close()
+            with open(backup_dir / "DatabaseVersion.sbf", "w") as fp:
+                fp.write("version:110")
+
+            databases = []
+
+            def open_database(*args, **kwargs):
+                databases.append(Database(*args, **kwargs))
+                return databases[-1]
+
+            with mock.patch("signal2html.core.Database", open_database):
+                with self.assertRaises(DatabaseEmptyError):
+                    process_backup(
+                        backup_dir,
+                        backup_dir / "output",
+                        working_copy="temp",
+                        stats_file=os.path.join(tmpdir, "stats.json"),
+                        memory_profile=1,
+                    )
+
+            # The working copy is removed and the statistics are disabled
+            (database,) = databases
+            self.assertFalse(os.path.exists(database.path))
+            self.assertIsNone(get_run_stats())
+            self.assertIsNone(get_memory_profile())
+
+
+if __name__ == "__main__":
+    unittest.main()
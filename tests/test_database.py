@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from signal2html.database import Database
+from signal2html.database import QueryStats
+from signal2html.database import add_indexes
+from signal2html.database import connect
+from signal2html.database import get_uri
+from signal2html.database import has_index
+from signal2html.database import open_connection
+
+
+class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmpdir.name, "database.sqlite")
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(
+            """
+            CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id, date_sent);
+            CREATE TABLE mms (_id INTEGER PRIMARY KEY, thread_id, date);
+            CREATE INDEX mms_thread_date_index ON mms (thread_id, date);
+            CREATE TABLE part (_id INTEGER PRIMARY KEY, mid);
+            INSERT INTO sms VALUES (1, 1, 10), (2, 2, 20);
+            """
+        )
+        conn.commit()
+        conn.close()
+        with open(self.db_file, "rb") as fp:
+            self.content = fp.read()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_get_uri(self):
+        self.assertTrue(get_uri(self.db_file).endswith("?mode=ro&immutable=1"))
+        self.assertTrue(
+            get_uri(self.db_file, immutable=False).endswith("?mode=ro")
+        )
+        open(self.db_file + "-wal", "wb").close()
+        self.assertTrue(get_uri(self.db_file).endswith("?mode=ro"))
+
+    def test_read_only(self):
+        conn = connect(self.db_file)
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM sms")
+        conn.close()
+
+    def test_add_indexes(self):
+        conn = sqlite3.connect(":memory:")
+        conn.execute("CREATE TABLE sms (_id, thread_id, date_sent)")
+        conn.execute("CREATE TABLE part (_id, mid)")
+        conn.execute("CREATE INDEX part_mid_index ON part (mid, _id)")
+        self.assertFalse(has_index(conn, "sms", ("thread_id", "date_sent")))
+        self.assertTrue(has_index(conn, "part", ("mid",)))
+        self.assertEqual(
+            add_indexes(conn), ["signal2html_sms_thread_id_date_sent"]
+        )
+        self.assertTrue(has_index(conn, "sms", ("thread_id", "date_sent")))
+        self.assertEqual(add_indexes(conn), [])
+
+    def test_working_copy(self):
+        for working_copy in (None, "memory", "temp"):
+            with self.subTest(working_copy=working_copy):
+                database = Database(self.db_file, working_copy=working_copy)
+                path = database.path
+                self.assertEqual(
+                    database.connection.execute(
+                        "SELECT thread_id FROM sms ORDER BY _id"
+                    ).fetchall(),
+                    [(1,), (2,)],
+                )
+                indexed = has_index(
+                    database.connection, "sms", ("thread_id", "date_sent")
+                )
+                self.assertEqual(indexed, working_copy is not None)
+                if working_copy == "temp":
+                    self.assertNotEqual(path, self.db_file)
+                    self.assertTrue(os.path.exists(path))
+                database.close()
+                if working_copy == "temp":
+                    self.assertFalse(os.path.exists(path))
+
+        # The backup itself is never modified
+        with open(self.db_file, "rb") as fp:
+            self.assertEqual(fp.read(), self.content)
+
+        with self.assertRaises(ValueError):
+            Database(self.db_file, working_copy="disk")
+
+
+class TestQueryStats(unittest.TestCase):
+    def test_instrumented_connection(self):
+        stats = QueryStats()
+        conn = open_connection(":memory:", query_stats=stats)
+        conn.execute("CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id)")
+        conn.executemany("INSERT INTO sms VALUES (?, ?)", [(1, 1), (2, 1)])
+        query = "SELECT _id FROM sms\n WHERE thread_id = ?"
+        template = "SELECT _id FROM sms WHERE thread_id = ?"
+        self.assertEqual(list(conn.execute(query, (1,))), [(1,), (2,)])
+        cursor = conn.cursor()
+        self.assertEqual(cursor.execute(query, (1,)).fetchone(), (1,))
+        self.assertEqual(cursor.fetchmany(5), [(2,)])
+        self.assertEqual(conn.execute(query, (2,)).fetchall(), [])
+
+        self.assertEqual(len(stats.times[template]), 3)
+        self.assertEqual(stats.rows[template], 4)
+        self.assertEqual(stats.get_full_scans(template), ["SCAN sms"])
+        self.assertNotIn("CREATE TABLE sms", " ".join(stats.plans))
+        with self.assertLogs("signal2html.database") as logs:
+            stats.log()
+        self.assertIn("1 query template(s) scan", logs.output[0])
+        conn.close()
+
+    def test_update(self):
+        stats = QueryStats(
+            times={"a": [1.0]}, rows={"a": 1}, plans={"a": ["SCAN x"]}
+        )
+        stats.explained.add("a")
+        other = stats.drain()
+        self.assertEqual(stats.times, {})
+        self.assertIn("a", stats.explained)
+        stats.times["a"] = [2.0]
+        stats.rows["a"] = 3
+        stats.update(other)
+        self.assertEqual(stats.times, {"a": [2.0, 1.0]})
+        self.assertEqual(stats.rows, {"a": 4})
+        self.assertEqual(stats.plans, {"a": ["SCAN x"]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+import uuid
+
+from signal2html.dbproto import StructuredDecryptedMember
+from signal2html.dbproto import StructuredDecryptedString
+from signal2html.dbproto import StructuredGroupCall
+from signal2html.dbproto import StructuredGroupDataV1
+from signal2html.dbproto import StructuredGroupDataV2
+from signal2html.dbproto import StructuredGroupMember
+from signal2html.dbproto import StructuredGroupV2Change
+from signal2html.dbproto import StructuredGroupV2State
+from signal2html.dbproto import StructuredMemberRole
+from signal2html.dbproto import StructuredMention
+from signal2html.dbproto import StructuredMentions
+from signal2html.dbproto import StructuredReaction
+from signal2html.dbproto import StructuredReactions
+from signal2html.dbproto import _decode
+from signal2html.dbproto import decode_message
+from signal2html.dbproto import get_message_cache_info
+
+
+def make_messages(rng):
+    """Make one message of each class with random contents"""
+
+    def text():
+        return rng.choice(["", "Hi", "👍", "Group été", "x" * 200])
+
+    def member():
+        return StructuredDecryptedMember(
+            uuid=uuid.UUID(int=rng.getrandbits(128)).bytes,
+            role=rng.choice(list(StructuredMemberRole)),
+        )
+
+    def number(bits):
+        return rng.choice([0, 1, 127, 128, rng.getrandbits(bits)])
+
+    return [
+        StructuredReactions(
+            reactions=[
+                StructuredReaction(
+                    what=text(),
+                    who=number(64),
+                    time_sent=number(64),
+                    time_received=number(64),
+                )
+                for _ in range(rng.randint(0, 5))
+            ]
+        ),
+        StructuredMentions(
+            mentions=[
+                StructuredMention(
+                    start=number(32),
+                    length=number(32),
+                    who_uuid=str(uuid.UUID(int=rng.getrandbits(128))),
+                )
+                for _ in range(rng.randint(0, 5))
+            ]
+        ),
+        StructuredGroupCall(by=text(), when=number(64)),
+        StructuredGroupDataV1(
+            group_name=text(),
+            phone_members=[f"+{number(32)}" for _ in range(rng.randint(0, 5))],
+            members=[
+                StructuredGroupMember(uuid=text(), phone=text())
+                for _ in range(rng.randint(0, 5))
+            ],
+        ),
+        StructuredGroupDataV2(
+            change=StructuredGroupV2Change(
+                by=uuid.UUID(int=rng.getrandbits(128)).bytes,
+                new_members=[member() for _ in range(rng.randint(0, 3))],
+                deleted_members=[
+                    member().uuid for _ in range(rng.randint(0, 3))
+                ],
+                new_title=StructuredDecryptedString(value=text()),
+            ),
+            state=StructuredGroupV2State(
+                title=text(),
+                rev=number(32),
+                members=[member() for _ in range(rng.randint(0, 10))],
+            ),
+        ),
+    ]
+
+
+def load(cls, data):
+    """Decode a message, returning the exception type on failure"""
+    try:
+        return cls.loads(data)
+    except Exception as e:
+        return type(e)
+
+
+class TestDecodeMessage(unittest.TestCase):
+    def test_valid_messages(self):
+        rng = random.Random(1234)
+        for _ in range(200):
+            for msg in make_messages(rng):
+                data = msg.dumps()
+                self.assertEqual(_decode(type(msg), data), msg)
+                self.assertEqual(decode_message(type(msg), data), msg)
+
+    def test_unknown_fields(self):
+        call = StructuredGroupCall(by="abc", when=123)
+        unknown = (
+            b"\x08\x96\x01"  # varint, field 1
+            b"\x21"
+            + bytes(8)  # fixed64, field 4
+            + b"\x2d"
+            + bytes(4)  # fixed32, field 5
+            + b"\x32\x02ab"  # length-delimited, field 6
+        )
+        data = unknown + call.dumps() + unknown
+        self.assertEqual(_decode(StructuredGroupCall, data), call)
+
+    def test_differential(self):
+        """Compare with pure_protobuf on damaged messages"""
+        rng = random.Random(5678)
+        for _ in range(200):
+            for msg in make_messages(rng):
+                cls, data = type(msg), msg.dumps()
+                if not data:
+                    continue
+                damaged = [
+                    data[: rng.randrange(len(data))],
+                    data + bytes([rng.randrange(256)]),
+                ]
+                for _ in range(3):
+                    mutated = bytearray(data)
+                    mutated[rng.randrange(len(data))] = rng.randrange(256)
+                    damaged.append(bytes(mutated))
+                for blob in damaged:
+                    expected = load(cls, blob)
+                    try:
+                        result = decode_message(cls, blob)
+                    except Exception as e:
+                        result = type(e)
+                    self.assertEqual(result, expected, msg=blob)
+
+    def test_cache_small_nested(self):
+        # Only nested messages up to MESSAGE_CACHE_MAX_BYTES are cached
+        for title, cached in (("Small", 1), ("x" * 1000, 0)):
+            with self.subTest(cached=cached):
+                data = StructuredGroupDataV2(
+                    change=StructuredGroupV2Change(
+                        by=uuid.uuid4().bytes,
+                        new_title=StructuredDecryptedString(
+                            value=str(uuid.uuid4())
+                        ),
+                    ),
+                    state=StructuredGroupV2State(title=title, rev=1),
+                ).dumps()
+                before = get_message_cache_info().misses
+                decoded = decode_message(StructuredGroupDataV2, data)
+                self.assertEqual(decoded.state.title, title)
+                misses = get_message_cache_info().misses - before
+                # The change and its title are small and new
+                self.assertEqual(misses, 2 + cached)
+
+    def test_wrong_wire_type(self):
+        # field 1 (start) encoded as a string
+        data = b"\x0a\x01A"
+        with self.assertRaises(ValueError):
+            _decode(StructuredMention, data)
+        with self.assertRaises(ValueError):
+            decode_message(StructuredMention, data)
+
+
+if __name__ == "__main__":
+    unittest.main()
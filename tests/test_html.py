@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from jinja2 import Environment
+
+from signal2html.html import _format_message
+from signal2html.html import _get_date_sent
+from signal2html.html import _get_sender_colors
+from signal2html.html import dump_thread
+from signal2html.html import format_message
+from signal2html.html import get_environment
+from signal2html.html import get_pages
+from signal2html.html import is_all_emoji
+from signal2html.html import merge_messages
+from signal2html.html import write_stream
+from signal2html.models import Mention
+from signal2html.models import Recipient
+from signal2html.models import SMSMessageRecord
+from signal2html.models import Thread
+
+
+class TestFormatMessage(unittest.TestCase):
+    _CASES = [
+        ("", ""),
+        (
+            "Hello <b>world</b> & you",
+            "Hello &lt;b&gt;world&lt;/b&gt; &amp; you",
+        ),
+        (
+            "Look \U0001f600 here",
+            "Look <span class='msg-emoji'>\U0001f600</span> here",
+        ),
+        (
+            "\U0001f600 \U0001f600",
+            "<span class='msg-emoji'>\U0001f600</span> "
+            "<span class='msg-emoji'>\U0001f600</span>",
+        ),
+        (
+            "2️⃣ www.example.com",
+            "<span class='msg-emoji'>2️⃣</span> "
+            '<a href="http://www.example.com" target="_blank">'
+            "www.example.com</a>",
+        ),
+    ]
+
+    def test_format_message(self):
+        for message, expected in self._CASES:
+            with self.subTest(message=message):
+                self.assertEqual(expected, format_message(message))
+
+    def test_format_message_none(self):
+        self.assertIsNone(format_message(None))
+
+    def test_format_message_mentions(self):
+        mentions = {3: Mention(mention_id=1, name="<Bob>", length=1)}
+        self.assertEqual(
+            "Hi <span class='msg-mention'>@&lt;Bob&gt;</span>! ￼",
+            format_message("Hi ￼! ￼", mentions),
+        )
+
+    def test_all_emoji(self):
+        bodies = [
+            "",
+            " ",
+            "abc",
+            "\U0001f600",
+            "\U0001f600 \U0001f600",
+            "\U0001f44d\U0001f3fd",
+            "\U0001f44d \U0001f3fd",
+            "❤️",
+            "\U0001f600 a",
+            "\U0001f600 <",
+        ]
+        for body in bodies:
+            with self.subTest(body=body):
+                _, all_emoji = _format_message(body, {})
+                self.assertEqual(is_all_emoji(body), all_emoji)
+
+
+class TestWriteStream(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.output_file = os.path.join(self._tmpdir.name, "page.html")
+        self.template = Environment().from_string(
+            "{% for m in messages %}<p>{{ m() }}</p>{% endfor %}"
+        )
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_write_stream(self):
+        messages = (lambda i=i: i for i in range(3))
+        write_stream(self.template.stream(messages=messages), self.output_file)
+        with open(self.output_file, "r", encoding="utf-8") as fp:
+            self.assertEqual(fp.read(), "<p>0</p><p>1</p><p>2</p>")
+
+    def test_write_stream_error(self):
+        def fail():
+            raise RuntimeError("render error")
+
+        stream = self.template.stream(messages=[lambda: 0, fail])
+        with self.assertRaises(RuntimeError):
+            write_stream(stream, self.output_file)
+        self.assertFalse(os.path.exists(self.output_file))
+
+
+def make_thread(dates):
+    recipient = Recipient(1, "Alice", "blue", False, "+31600000000", "")
+    sms = [
+        SMSMessageRecord(
+            addressRecipient=recipient,
+            dateSent=date,
+            dateReceived=date,
+            body=f"Message {k}",
+            _type=20 | 0x800000,
+            _id=k,
+            data=None,
+            delivery_receipt_count=0,
+            read_receipt_count=0,
+        )
+        for k, date in enumerate(dates)
+    ]
+    return Thread(_id=1, recipient=recipient, sms=sms)
+
+
+class TestMergeMessages(unittest.TestCase):
+    def test_merge_messages(self):
+        thread = make_thread([1, 3, 3, 5])
+        thread.mms = make_thread([2, 3, 6]).sms
+        mms_ids = set(map(id, thread.mms))
+        merged = [
+            (m.dateSent, id(m) in mms_ids)
+            for m in merge_messages(thread.mms, thread.sms)
+        ]
+        # MMS messages come first on the same date, as with a stable sort
+        self.assertEqual(
+            merged,
+            [
+                (1, False),
+                (2, True),
+                (3, True),
+                (3, False),
+                (3, False),
+                (5, False),
+                (6, True),
+            ],
+        )
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        # Two messages in January 2021 and three in March 2021 (around noon,
+        # so the month doesn't depend on the time zone)
+        day = 24 * 3600 * 1000
+        jan = 1610107200000
+        mar = 1615204800000
+        self.thread = make_thread(
+            [jan, jan + day, mar, mar + day, mar + 2 * day]
+        )
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_get_pages(self):
+        messages = self.thread.sms
+
+        def page(title, page_messages):
+            return {
+                "title": title,
+                "count": len(page_messages),
+                "first": _get_date_sent(page_messages[0]),
+                "last": _get_date_sent(page_messages[-1]),
+            }
+
+        self.assertEqual(
+            get_pages(messages, "month"),
+            [
+                page("January 2021", messages[:2]),
+                page("March 2021", messages[2:]),
+            ],
+        )
+        self.assertEqual(
+            get_pages(iter(messages), 2),
+            [
+                page("Page 1", messages[:2]),
+                page("Page 2", messages[2:4]),
+                page("Page 3", messages[4:]),
+            ],
+        )
+        self.assertEqual(get_pages([], "month"), [])
+        with self.assertRaises(ValueError):
+            get_pages(messages, 0)
+
+    def test_dump_thread_paginated(self):
+        output_file = os.path.join(self._tmpdir.name, "Alice", "alice.html")
+        dump_thread(
+            self.thread, self._tmpdir.name, output_file, paginate="month"
+        )
+        self.assertEqual(
+            sorted(os.listdir(os.path.dirname(output_file))),
+            ["alice.html", "alice_page1.html", "alice_page2.html"],
+        )
+        with open(output_file, "r", encoding="utf-8") as fp:
+            index = fp.read()
+        self.assertIn('href="alice_page2.html">March 2021</a>', index)
+        self.assertIn("3 messages", index)
+
+        page = os.path.join(self._tmpdir.name, "Alice", "alice_page2.html")
+        with open(page, "r", encoding="utf-8") as fp:
+            html = fp.read()
+        self.assertIn('href="alice_page1.html">&larr; Previous', html)
+        self.assertNotIn("Next &rarr;", html)
+        self.assertNotIn("Message 1", html)
+        self.assertIn("Message 4", html)
+        # Every page starts with a date
+        self.assertLess(html.index("msg-date-change"), html.index("Message 2"))
+
+
+class TestSenderColors(unittest.TestCase):
+    def test_sender_order(self):
+        group = Recipient(1, "Friends", "blue", True, "", "")
+        thread = Thread(_id=1, recipient=group)
+        rids = ["10", 2, "9", 2]
+        messages = [
+            SMSMessageRecord(
+                addressRecipient=Recipient(rid, "", "red", False, "", ""),
+                dateSent=k,
+                dateReceived=k,
+                body="",
+                _type=20 | 0x800000,
+                _id=k,
+                data=None,
+                delivery_receipt_count=0,
+                read_receipt_count=0,
+            )
+            for k, rid in enumerate(rids)
+        ]
+        css, sender_idx = _get_sender_colors(thread, messages)
+        self.assertEqual([r.rid for r in sender_idx], [2, "9", "10"])
+        self.assertEqual(list(sender_idx.values()), [0, 1, 2])
+        self.assertEqual(
+            [line.split("*/")[0] for line in css.splitlines()],
+            [
+                ".msg-sender-0 { /* recipient id:     2 ",
+                ".msg-sender-1 { /* recipient id:     9 ",
+                ".msg-sender-2 { /* recipient id:    10 ",
+            ],
+        )
+
+
+class TestEnvironment(unittest.TestCase):
+    def test_shared_environment(self):
+        self.assertIs(get_environment(), get_environment())
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, "cache")
+            env = get_environment(cache_dir)
+            self.assertIsNot(env, get_environment())
+            env.get_template("thread.html")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            get_environment.cache_clear()
+
+
+if __name__ == "__main__":
+    unittest.main()
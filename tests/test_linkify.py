@@ -4,6 +4,7 @@
 import unittest
 
 from signal2html.linkify import linkify
+from signal2html.linkify import linkify_many
 
 
 class TestLinkify(unittest.TestCase):
@@ -33,6 +34,10 @@ class TestLinkify(unittest.TestCase):
             "Lorem ipsum test@example.com etc.",
             'Lorem ipsum <a href="mailto:test@example.com" target="_blank">test@example.com</a> etc.',
         ),
+        (
+            "Lorem ipsum //localhost/dolor",
+            'Lorem ipsum <a href="//localhost/dolor" target="_blank">//localhost/dolor</a>',
+        ),
     ]
 
     def test_linkify(self):
@@ -40,6 +45,15 @@ class TestLinkify(unittest.TestCase):
             with self.subTest(message=message):
                 self.assertEqual(expected, linkify(message))
 
+    def test_linkify_no_link_chars(self):
+        message = "Lorem ipsum dolor sit amet"
+        self.assertIs(message, linkify(message))
+
+    def test_linkify_many(self):
+        messages = [message for message, _ in self._CASES]
+        expected = [expected for _, expected in self._CASES]
+        self.assertEqual(expected, linkify_many(messages))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from signal2html.manifest import EMPTY_FINGERPRINT
+from signal2html.manifest import Manifest
+from signal2html.manifest import get_thread_fingerprints
+
+
+class TestThreadFingerprints(unittest.TestCase):
+    def test_get_thread_fingerprints(self):
+        conn = sqlite3.connect(":memory:")
+        conn.executescript(
+            """
+            CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id, date);
+            CREATE TABLE mms (_id INTEGER PRIMARY KEY, thread_id, date);
+            CREATE TABLE part (_id INTEGER PRIMARY KEY, mid);
+            INSERT INTO sms VALUES (1, 1, 100), (2, 1, 50), (3, 2, 70);
+            INSERT INTO mms VALUES (1, 2, 80), (2, 3, 90);
+            INSERT INTO part VALUES (1, 1), (2, 1), (3, 2);
+            """
+        )
+        self.assertEqual(
+            get_thread_fingerprints(conn.cursor()),
+            {
+                1: [2, 2, 100, 0, None, None, 0],
+                2: [1, 3, 70, 1, 1, 80, 2],
+                3: [0, None, None, 1, 2, 90, 1],
+            },
+        )
+        conn.close()
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.output_dir = self._tmpdir.name
+        self.output_file = os.path.join(self.output_dir, "Alice", "a.html")
+        os.makedirs(os.path.dirname(self.output_file))
+        open(self.output_file, "w").close()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def make_manifest(self, fingerprints, key=None):
+        return Manifest(self.output_dir, key or {"a": 1}, fingerprints)
+
+    def test_unchanged(self):
+        manifest = self.make_manifest({1: [1, 1, 10, 0, None, None, 0]})
+        self.assertFalse(manifest.is_unchanged(1))
+        self.assertIsNone(manifest.output_file(1))
+        manifest.record(1, self.output_file)
+        manifest.record(2, None)
+        manifest.save()
+
+        manifest = self.make_manifest({1: [1, 1, 10, 0, None, None, 0]})
+        self.assertEqual(manifest.output_file(1), self.output_file)
+        self.assertTrue(manifest.is_unchanged(1))
+        self.assertTrue(manifest.is_unchanged(2))
+        self.assertFalse(manifest.is_unchanged(3))
+
+    def test_changed(self):
+        manifest = self.make_manifest({})
+        manifest.record(1, self.output_file)
+        manifest.save()
+
+        # A new message
+        manifest = self.make_manifest({1: [1, 1, 10, 0, None, None, 0]})
+        self.assertFalse(manifest.is_unchanged(1))
+        self.assertEqual(manifest.output_file(1), self.output_file)
+
+        # A different key
+        manifest = self.make_manifest({}, key={"a": 2})
+        self.assertFalse(manifest.is_unchanged(1))
+        self.assertIsNone(manifest.output_file(1))
+
+        # A deleted page
+        os.unlink(self.output_file)
+        manifest = self.make_manifest({1: EMPTY_FINGERPRINT})
+        self.assertFalse(manifest.is_unchanged(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
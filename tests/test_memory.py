@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import tracemalloc
+import unittest
+
+from signal2html.memory import DUMP
+from signal2html.memory import POPULATE
+from signal2html.memory import disable_memory_profile
+from signal2html.memory import enable_memory_profile
+from signal2html.memory import get_memory_profile
+from signal2html.memory import memory_stage
+from signal2html.memory import thread_memory
+
+SIZE = 1 << 20
+
+
+class TestMemoryProfile(unittest.TestCase):
+    def tearDown(self):
+        disable_memory_profile()
+
+    def test_disabled(self):
+        with thread_memory(1, "Alice"), memory_stage(POPULATE):
+            self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(get_memory_profile())
+
+    def test_thread_memory(self):
+        profile = enable_memory_profile()
+        with thread_memory(1, "Alice"):
+            with memory_stage(POPULATE):
+                kept = bytearray(SIZE)
+            with memory_stage(DUMP):
+                dropped = bytearray(2 * SIZE)
+                del dropped
+        self.assertFalse(tracemalloc.is_tracing())
+        del kept
+
+        (record,) = profile.threads
+        self.assertEqual(record["name"], "Alice")
+        populate, dump = record["stages"][POPULATE], record["stages"][DUMP]
+        self.assertGreaterEqual(populate["retained"], SIZE)
+        self.assertGreaterEqual(populate["peak"], SIZE)
+        self.assertGreaterEqual(record["peak"], 2 * SIZE)
+        self.assertLess(dump["retained"], 2 * SIZE)
+        site, size, count = populate["top"][0]
+        self.assertIn(__file__, site)
+        self.assertGreaterEqual(size, SIZE)
+
+        other = profile.drain()
+        self.assertEqual(profile.threads, [])
+        with thread_memory(2, "Bob"), memory_stage(POPULATE):
+            pass
+        profile.update(other)
+        self.assertEqual([t["id"] for t in profile.threads], [2, 1])
+        with self.assertLogs("signal2html.memory") as logs:
+            profile.log(1)
+        self.assertIn("Thread 1 (Alice)", logs.output[0])
+        self.assertNotIn("Thread 2 (Bob)", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import base64
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import unittest
+import uuid
+
+from pathlib import Path
+from unittest import mock
+
+from signal2html.core import process_backup
+from signal2html.dbproto import StructuredDecryptedMember
+from signal2html.dbproto import StructuredDecryptedString
+from signal2html.dbproto import StructuredGroupDataV2
+from signal2html.dbproto import StructuredGroupV2Change
+from signal2html.dbproto import StructuredGroupV2State
+from signal2html.dbproto import StructuredMemberRole
+
+SCHEMA = """
+CREATE TABLE thread (_id INTEGER PRIMARY KEY, thread_recipient_id);
+CREATE TABLE recipient (_id INTEGER PRIMARY KEY, group_id, uuid, phone,
+    system_display_name, profile_joined_name, color);
+CREATE TABLE groups (_id INTEGER PRIMARY KEY, group_id, title, members);
+CREATE TABLE sms (_id INTEGER PRIMARY KEY, thread_id, address, date,
+    date_sent, body, type, delivery_receipt_count, read_receipt_count);
+CREATE TABLE mms (_id INTEGER PRIMARY KEY, thread_id, address, date,
+    date_received, body, quote_id, quote_author, quote_body,
+    quote_mentions, msg_box, reactions, delivery_receipt_count,
+    read_receipt_count, viewed_receipt_count);
+CREATE TABLE part (_id INTEGER PRIMARY KEY, mid, ct, unique_id,
+    voice_note, width, height, quote);
+CREATE TABLE mention (_id INTEGER PRIMARY KEY, thread_id, message_id,
+    recipient_id, range_start, range_length);
+"""
+
+INCOMING = 20 | 0x800000
+GROUP_UPDATE_V2 = 0x10000 | 0x80000 | INCOMING
+DATE = 1600000000000
+ALICE = uuid.UUID(int=1)
+
+
+def make_group_update(title):
+    members = [
+        StructuredDecryptedMember(
+            uuid=u.bytes, role=StructuredMemberRole.MEMBER_ROLE_DEFAULT
+        )
+        for u in (ALICE, uuid.UUID(int=2))
+    ]
+    data = StructuredGroupDataV2(
+        change=StructuredGroupV2Change(
+            by=ALICE.bytes, new_title=StructuredDecryptedString(value=title)
+        ),
+        state=StructuredGroupV2State(title=title, rev=2, members=members),
+    )
+    return base64.b64encode(data.dumps()).decode()
+
+
+def make_backup(backup_dir):
+    """Make a backup with two groups of the same title, and senders that
+    are missing from the recipient table"""
+    with open(os.path.join(backup_dir, "DatabaseVersion.sbf"), "w") as fp:
+        fp.write("databaseVersion:110")
+    conn = sqlite3.connect(os.path.join(backup_dir, "database.sqlite"))
+    conn.executescript(SCHEMA)
+    conn.executemany(
+        "INSERT INTO recipient VALUES (?, ?, ?, ?, ?, NULL, 'blue')",
+        [
+            (1, None, str(ALICE), "+31600000001", "Alice"),
+            (2, None, None, "+31600000002", "Bob"),
+            (3, "__signal_group__v2!01", None, None, None),
+            (4, "__signal_group__v2!02", None, None, None),
+        ],
+    )
+    conn.executemany(
+        "INSERT INTO groups VALUES (?, ?, 'Friends', '1,2')",
+        [(1, "__signal_group__v2!01"), (2, "__signal_group__v2!02")],
+    )
+    conn.executemany(
+        "INSERT INTO thread VALUES (?, ?)", [(1, 2), (2, 3), (3, 4)]
+    )
+    conn.executemany(
+        "INSERT INTO sms VALUES (?, 1, 2, ?, ?, ?, ?, 0, 0)",
+        [(1, DATE, DATE, "Hi www.example.com", INCOMING)],
+    )
+    # Senders 98 and 99 are not in the recipient table
+    conn.executemany(
+        "INSERT INTO mms VALUES "
+        "(?, ?, ?, ?, ?, ?, NULL, NULL, NULL, NULL, ?, NULL, 0, 0, 0)",
+        [
+            (1, 2, 1, DATE + 1, DATE + 1, "Hello", INCOMING),
+            (2, 2, 99, DATE + 2, DATE + 2, "Who am I?", INCOMING),
+            (
+                3,
+                2,
+                1,
+                DATE + 3,
+                DATE + 3,
+                make_group_update("A"),
+                GROUP_UPDATE_V2,
+            ),
+            (4, 3, 98, DATE + 4, DATE + 4, "Me neither", INCOMING),
+            (
+                5,
+                3,
+                1,
+                DATE + 5,
+                DATE + 5,
+                make_group_update("B"),
+                GROUP_UPDATE_V2,
+            ),
+        ],
+    )
+    conn.execute(
+        "INSERT INTO part VALUES (1, 1, 'image/png', 123, 0, 10, 10, 0)"
+    )
+    conn.commit()
+    conn.close()
+    with open(os.path.join(backup_dir, "Attachment_1_123.bin"), "wb") as fp:
+        fp.write(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32)
+
+
+def read_tree(root):
+    """Get the files below a directory with their content"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != ".signal2html"]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path, "rb") as fp:
+                files[os.path.relpath(path, root)] = fp.read()
+    return files
+
+
+class TestExportThreads(unittest.TestCase):
+    def test_same_output_as_serial(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backup_dir = Path(tmpdir) / "backup"
+            os.makedirs(backup_dir)
+            make_backup(backup_dir)
+
+            # Missing recipients get a random color
+            random.seed(1)
+            process_backup(backup_dir, Path(tmpdir) / "serial", jobs=1)
+            serial = read_tree(Path(tmpdir) / "serial")
+            self.assertIn(os.path.join("Friends", "Friends.html"), serial)
+            self.assertIn(os.path.join("Friends_2", "Friends.html"), serial)
+
+            # The addressbook is pickled for the workers with spawn
+            for method in multiprocessing.get_all_start_methods():
+                with self.subTest(method=method):
+                    output_dir = Path(tmpdir) / method
+                    context = multiprocessing.get_context(method)
+                    random.seed(1)
+                    with mock.patch(
+                        "multiprocessing.get_context", return_value=context
+                    ):
+                        process_backup(backup_dir, output_dir, jobs=2)
+                    self.assertEqual(read_tree(output_dir), serial)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from signal2html.attachments import ExportReport
+from signal2html.stats import DECODE
+from signal2html.stats import FETCH
+from signal2html.stats import RENDER
+from signal2html.stats import counted
+from signal2html.stats import disable_stats
+from signal2html.stats import enable_stats
+from signal2html.stats import stage
+from signal2html.stats import thread_stats
+from signal2html.stats import timed
+
+
+def produce(items):
+    for item in items:
+        with stage(DECODE):
+            time.sleep(0.01)
+        yield item
+
+
+class TestStats(unittest.TestCase):
+    def tearDown(self):
+        disable_stats()
+
+    def test_disabled(self):
+        items = iter([1, 2])
+        self.assertIs(timed(items, FETCH), items)
+        self.assertIs(counted(items), items)
+        with stage(FETCH), thread_stats(1):
+            pass
+
+    def test_nested_stages(self):
+        stats = enable_stats()
+        with thread_stats(3):
+            with stage(FETCH):
+                time.sleep(0.02)
+                with stage(DECODE):
+                    time.sleep(0.02)
+            with stage(RENDER):
+                items = list(counted(timed(produce("ab"), FETCH)))
+        self.assertEqual(items, ["a", "b"])
+
+        fetch, decode = stats.totals[FETCH][0], stats.totals[DECODE][0]
+        self.assertGreaterEqual(fetch, 0.02)
+        self.assertLess(fetch, 0.035)
+        self.assertGreaterEqual(decode, 0.04)
+        self.assertLess(stats.totals[RENDER][0], 0.015)
+
+        (record,) = stats.threads
+        self.assertEqual(record["id"], 3)
+        self.assertEqual(record["messages"], 2)
+        self.assertEqual(record["stages"][DECODE]["wall"], decode)
+        self.assertGreaterEqual(record["wall"], fetch + decode)
+
+    def test_update(self):
+        stats = enable_stats()
+        with thread_stats(1), stage(FETCH):
+            time.sleep(0.01)
+        other = stats.drain()
+        self.assertEqual(stats.threads, [])
+        self.assertEqual(stats.totals[FETCH], [0.0, 0.0])
+        with thread_stats(2), stage(FETCH):
+            time.sleep(0.01)
+        stats.update(other)
+
+        report = ExportReport(bytes_copied=2**20)
+        data = stats.to_dict(2.0, 1.0, report)
+        self.assertEqual([t["id"] for t in data["per_thread"]], [1, 2])
+        self.assertGreaterEqual(data["stages"][FETCH]["wall"], 0.02)
+        self.assertEqual(data["throughput"]["megabytes_per_second"], 0.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
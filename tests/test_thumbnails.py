@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from signal2html.models import Attachment
+from signal2html.thumbnails import get_thumbnail_path
+from signal2html.thumbnails import has_pillow
+from signal2html.thumbnails import make_thumbnails
+from signal2html.thumbnails import needs_thumbnail
+
+
+def make_attachment(content_type, width, height):
+    return Attachment(
+        contentType=content_type,
+        fileName=None,
+        voiceNote=False,
+        width=width,
+        height=height,
+        quote=False,
+        unique_id=123,
+    )
+
+
+class TestThumbnails(unittest.TestCase):
+    def test_needs_thumbnail(self):
+        self.assertTrue(needs_thumbnail(make_attachment("image/jpeg", 0, 0)))
+        self.assertTrue(
+            needs_thumbnail(make_attachment("image/png", 4000, 3000))
+        )
+        self.assertFalse(
+            needs_thumbnail(make_attachment("image/png", 200, 100))
+        )
+        self.assertFalse(
+            needs_thumbnail(make_attachment("image/gif", 4000, 3000))
+        )
+        self.assertFalse(
+            needs_thumbnail(make_attachment("video/mp4", 4000, 3000))
+        )
+
+    def test_get_thumbnail_path(self):
+        self.assertEqual(
+            get_thumbnail_path("./attachments/Attachment_1_2.png"),
+            "./attachments/thumbnails/320/Attachment_1_2.jpg",
+        )
+        self.assertEqual(
+            get_thumbnail_path("./attachments/Attachment_1_2.png", 100),
+            "./attachments/thumbnails/100/Attachment_1_2.jpg",
+        )
+
+    @unittest.skipUnless(has_pillow(), "requires Pillow")
+    def test_make_thumbnails(self):
+        from PIL import Image
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, "Attachment_1_2.bin")
+            Image.new("RGBA", (1000, 500), "red").save(source, "PNG")
+            broken = os.path.join(tmpdir, "Attachment_3_4.bin")
+            with open(broken, "wb") as fp:
+                fp.write(b"not an image")
+
+            target = os.path.join(tmpdir, "thumbnails", "a.jpg")
+            thumbnails = {
+                target: source,
+                os.path.join(tmpdir, "thumbnails", "b.jpg"): broken,
+            }
+            errors = make_thumbnails(thumbnails, max_size=100)
+            self.assertEqual(len(errors), 1)
+            self.assertIn(broken, errors[0])
+            with Image.open(target) as image:
+                self.assertEqual(image.size, (100, 50))
+                self.assertEqual(image.format, "JPEG")
+
+            # Thumbnails that are up to date are not made again
+            self.assertEqual(make_thumbnails({target: source}), [])
+
+            # Several batches are made by a pool of processes
+            os.unlink(target)
+            errors = make_thumbnails(
+                thumbnails, jobs=2, max_size=100, batch_size=1
+            )
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(os.path.exists(target))
+
+
+if __name__ == "__main__":
+    unittest.main()